@@ -1,6 +1,12 @@
 import run_w2k
 import make_klist_band as kb
 import analyze_w2k as anal
+import symmetry_w2k as sym
+import store_w2k as st
+import scheduler_w2k as sc
+import octree_w2k as oc
+import ledger_w2k as lg
+import telemetry_w2k as tm
 import datetime as dt
 import subprocess as sp
 import numpy as np
@@ -12,55 +18,121 @@ w2k.parallel = 1
 w2k.set_parallel(w2k.parallel)
 w2k.spol = 1
 w2k.spin_ls = ["up"]
+w2k.telemetry = tm.Telemetry(w2k.case_path + "telemetry.jsonl")
 w2k.print_parameters()
+spag = 1  # 0: band energies from case.energy without spaghetti
 
 
-def mapall():  # calculate all BZ coarsely
+def start_jobs():  # stop handler and job ledger, opened on the first run
+    lg.install_stop_handler()
+    if w2k.ledger is None:
+        w2k.ledger = lg.Ledger(w2k.case_path + "ledger.sqlite")
+
+
+def band_file(bdir, name):  # spin up band file written by run_band
+    return bdir + name + "up" + (".bands.agr" if spag else ".energy")
+
+
+def load_band(path):  # energy(band, k) in eV from Ef
+    return anal.load_bands(path, None if spag else w2k.get_ef())
+
+
+def mapall(max_k=2000, workers=1, ops=None):  # calculate all BZ coarsely
+    start_jobs()
     outfol = w2k.case_path + "mapall/"
 
     sp.call(["mkdir", "-p", outfol + "klist/"])
     sp.call(["mkdir", "-p", outfol + "data/"])
-    t_st = dt.datetime.now()
     nx = 100
     ny = 100
     nz = 100
-    c = 0
-    for kz in range(nz + 1):
-        for ky in range(ny + 1):
-            name = "map_kz" + str(kz) + "_ky" + str(ky)
-            kb.main(
-                w2k.filepath(".klist_band"),
-                kmeshx=nx + 1,
-                kpath=[[0, ky / ny, kz / nz], [1, ky / ny, kz / nz]],
-                index_ls=[],
+    lines = []
+    if ops is not None:  # only irreducible grid points, in chunks of max_k
+        irr, gmap = sym.irreducible_grid(nx, ops)
+        counts = []
+        for i, s in enumerate(range(0, irr.shape[0], max_k)):
+            name = "irr_" + str(i)
+            kb.write_klist(
+                outfol + "klist/" + name + ".klist_band", irr[s : s + max_k], nx
             )
-            sp.call(
-                [
-                    "cp",
-                    w2k.filepath(".klist_band"),
-                    outfol + "klist/" + name + ".klist_band",
-                ]
-            )
-            w2k.run_band(outfol + "data/", name)
-            t_n = dt.datetime.now()
-            c += 1
-            print("finish : " + str((t_n - t_st) / c * (ny + 1) * (nz + 1) + t_st))
+            lines.append([name, outfol + "klist/" + name + ".klist_band"])
+            counts.append(min(max_k, irr.shape[0] - s))
+        np.savez(outfol + "irr.npz", k=irr, map=gmap, n=nx, counts=counts)
+        print("irreducible k : " + str(irr.shape[0]) + " / " + str(gmap.size))
+        per = 1
+    else:
+        kpaths = []
+        for kz in range(nz + 1):
+            for ky in range(ny + 1):
+                name = "map_kz" + str(kz) + "_ky" + str(ky)
+                kpaths.append([[0, ky / ny, kz / nz], [1, ky / ny, kz / nz]])
+                lines.append([name, outfol + "klist/" + name + ".klist_band"])
+        kb.main_many([l[1] for l in lines], nx + 1, kpaths)
+        per = max(1, max_k // (nx + 1))
+        if os.path.exists(outfol + "irr.npz"):
+            os.remove(outfol + "irr.npz")
+
+    if workers > 1:  # one batch per job, run in cloned case directories
+        sch = sc.BandScheduler(w2k, workers)
+        jobs = [
+            sch.batch_job(outfol + "data/", lines[i : i + per], max_k=max_k, spag=spag)
+            for i in range(0, len(lines), per)
+        ]
+        try:
+            sch.run(jobs)
+        finally:
+            sch.cleanup()
+    else:
+        w2k.run_band_batch(outfol + "data/", lines, max_k, spag=spag)
 
 
 def make_3Dband_npy():
+    irrmap = w2k.case_path + "mapall/irr.npz"
     anal.make_3Dband_array(
         [101, 101],
         "up",
         w2k.case_path + "mapall/data/",
         w2k.case_path + "mapall/data.npy",
+        irrmap=irrmap if os.path.exists(irrmap) else "",
+        ext=".bands.agr" if spag else ".energy",
+        ef=None if spag else w2k.get_ef(),
     )
 
 
+def map_store():  # band store of mapall, only new lines are ingested
+    outfol = w2k.case_path + "mapall/"
+    fl = sorted(f for f in os.listdir(outfol + "klist/") if ".klist_band" in f)
+    store = st.BandStore(outfol + "store/")
+    n = 0
+    for f in fl:
+        for spin in w2k.spin_ls:
+            name = f[:-11] + spin
+            path = outfol + "data/" + name + (".bands.agr" if spag else ".energy")
+            if store.has(name) or not os.path.exists(path):
+                continue
+            if spag:
+                e, w = anal.load_agr(path, cache=0)  # the store is the cache
+            else:
+                e, w = load_band(path), None
+            k = kb.klist_points(outfol + "klist/" + f)
+            if e.ndim < 2 or e.shape[1] != k.shape[0]:
+                print("ERROR: wrong data in " + path)
+                continue
+            store.append_band(name, k, e, w, 1 if spin == "dn" else 0)
+            n += 1
+    store.close()
+    print("ingested " + str(n) + " files, " + str(len(store)) + " k points in store")
+    return store
+
+
 def get_NLlist_coarse(ba_l):  # get coarse NL list between selected band
+    if os.path.exists(w2k.case_path + "mapall/irr.npz"):  # unfolded in data.npy
+        nls = anal.get_NL_list(w2k.case_path + "mapall/data.npy", ba_l, 0.015)
+        nls = {ba: nls[ba] / 100 for ba in ba_l}
+    else:  # only the two bands of each line are read from the store
+        nls = anal.get_NL_store(map_store(), ba_l, 0.015)
     for ba in ba_l:
-        nl = anal.get_NL_list(w2k.case_path + "mapall/data.npy", ba, 0.015)
-        nl = rmv_data_xyz_sym(nl)
-        nl = nl / 100
+        nl = rmv_data_xyz_sym(nls[ba])
         print(nl)
         print(nl.shape)
         np.save(w2k.case_path + "mapall/NL_" + str(ba) + ".npy", nl)
@@ -74,83 +146,35 @@ def rmv_data_xyz_sym(ar):  # reduce k points according to xyz symmetry
 
 
 def make_klist_NL(ba_ls):  # make .klist_band files
-    def vec2int(vec):
-        val = round(vec[0]) + round(vec[1]) * 10000 + round(vec[2]) * 10000**2
-        return val
+    def vec2int(vec):  # pack rounded (N, 3) coordinates into int64 keys
+        vec = np.rint(vec).astype(np.int64)
+        return vec[:, 0] + vec[:, 1] * 10000 + vec[:, 2] * 10000**2
 
     def int2vec(val):
-        vec = [
-            np.mod(val, 10000),
-            np.floor(np.mod(val, 10000**2) / 10000),
-            np.floor(val / 10000**2),
-        ]
-        vec = [int(round(i)) for i in vec]
-        return vec
+        return np.stack([val % 10000, val // 10000 % 10000, val // 10000**2], -1)
 
     for ba in ba_ls:
-        nldir = w2k.case_path + "NLs/NL_" + str(ba) + "/"
         nl = np.load(w2k.case_path + "mapall/NL_" + str(ba) + ".npy")
-        nl = list(nl)
         km = 900  # maximum number of k points in each .klist_band file
         d = 5000  # density of BZ for fine NL calculation
         fn = 1  # initial value of .klist_band file index
-        klist_all = set([])  # initialize set of klist
-        k_all = 0  # counter of all k points
 
         # fine kmesh
-        dkx_ls = range(-30, 31)
-        dky_ls = range(-25, 26, 5)
-        dkz_ls = range(-25, 26, 5)
-
-        prog = 0
-        cp = 0
-        nn = 0
-        nt = dt.datetime.now().second
-        pdens = 1
-
-        for rkp in nl:
-            for dkz in dkz_ls:
-                for dky in dky_ls:
-                    for dkx in dkx_ls:
-                        kx = rkp[0] * d + dkx
-                        ky = rkp[1] * d + dky
-                        kz = rkp[2] * d + dkz
-                        kl_app = vec2int([kx, ky, kz])
-                        if not kl_app in klist_all:
-                            if kx >= 0 and kx <= d:
-                                if ky >= 0 and ky <= d:
-                                    if kz >= 0 and kz <= d:
-                                        if kx + ky + kz <= d * 3 / 2:
-                                            klist_all.add(kl_app)
-                        k_all += 1
-                        prog += 1
-                        nn = np.floor(
-                            prog
-                            / (len(nl) * len(dkx_ls) * len(dky_ls) * len(dkz_ls))
-                            * 100
-                            * pdens
-                            * 100
-                        ) / (pdens * 100)
-                        nsec = dt.datetime.now().second
-                        if np.floor(nn * pdens) / pdens > cp or (
-                            (float(nsec) % 20) == 0 and nsec != nt
-                        ):
-                            nt = dt.datetime.now().second
-                            cp = (
-                                np.floor(
-                                    prog
-                                    / (
-                                        len(nl)
-                                        * len(dkx_ls)
-                                        * len(dky_ls)
-                                        * len(dkz_ls)
-                                    )
-                                    * 100
-                                    * pdens
-                                )
-                                / pdens
-                            )
-                            print(str(dt.datetime.now()) + " : " + str(nn) + " %")
+        dk = np.meshgrid(range(-30, 31), range(-25, 26, 5), range(-25, 26, 5))
+        dk = np.stack([v.ravel() for v in dk], -1)
+        k_all = nl.shape[0] * dk.shape[0]  # counter of all k points
+
+        keys = [np.zeros(0, dtype=np.int64)]
+        step = max(1, 2**22 // dk.shape[0])  # coarse points per broadcast
+        for i in range(0, nl.shape[0], step):
+            kp = nl[i : i + step, None, :] * d + dk[None, :, :]
+            kp = kp.reshape(-1, 3)
+            inside = np.all((kp >= 0) & (kp <= d), axis=1)
+            inside &= kp.sum(axis=1) <= d * 3 / 2
+            keys.append(np.unique(vec2int(kp[inside])))
+            prog = str(min(i + step, nl.shape[0])) + " / " + str(nl.shape[0])
+            print(str(dt.datetime.now()) + " : " + prog)
+        klist_all = np.unique(np.concatenate(keys))
 
         print(len(klist_all), k_all)
 
@@ -158,74 +182,94 @@ def make_klist_NL(ba_ls):  # make .klist_band files
 
         sp.call(["mkdir", "-p", kbout])
 
-        if os.path.exists(nldir + "NL" + str(ba) + "_k_data.npy"):
-            data_k = np.load(nldir + "NL" + str(ba) + "_k_data.npy")
-            data_k = set([vec2int(v * d) for v in list(data_k)])
-            klist_all = klist_all - data_k
+        data_k = nl_store(ba).read("k")[0]
+        if data_k is not None:
+            data_k = vec2int(data_k.reshape(-1, 3) * d)
+            klist_all = np.setdiff1d(klist_all, data_k, assume_unique=False)
 
             print(len(klist_all))
 
-        klist_out = []
-        for kp in klist_all:
-            if len(klist_out) > km:
-                np.save(kbout + "klist_" + str(fn), np.array(klist_out))
-                kb.sonomama(
-                    kbout + "klist_" + str(fn) + ".klist_band", klist_out, 5000, 0
-                )
-                klist_out = []
-                fn += 1
-
-            klist_out.append([i / d for i in int2vec(kp)])
-
-
-def calc_NL_from_klists(ba_ls):  # calculate band dispersion
-    stop = 0
-    for ba in ba_ls:
-        if stop:
-            break
-        nldir = w2k.case_path + "NLs/NL_" + str(ba) + "/"
-        bdir = nldir + "band/"
-        kdir = nldir + "klist/"
-        sp.call(["mkdir", "-p", bdir])
-        fl = os.listdir(kdir)
-        fl = [f for f in fl if ".klist_band" in f]
-        fl.sort()
-
-        c = 0
-        t_st = dt.datetime.now()
+        for i in range(0, len(klist_all), km):
+            klist_out = int2vec(klist_all[i : i + km])
+            np.save(kbout + "klist_" + str(fn), klist_out / d)
+            kb.write_klist(kbout + "klist_" + str(fn) + ".klist_band", klist_out, d)
+            fn += 1
 
-        fl = [f for f in fl if not os.path.exists(bdir + f[:-11] + "up.bands.agr")]
 
-        for kbf in fl:
-            if os.path.exists(w2k.case_path + "stop.txt"):
-                print("stop.txt FILE DETECTED.")
-                sp.call(["rm", w2k.case_path + "stop.txt"])
-                stop = 1
+def calc_NL_from_klists(ba_ls, workers=1):  # calculate band dispersion
+    start_jobs()
+    # one scheduler for all bands, the case is copied only once
+    sch = sc.BandScheduler(w2k, workers) if workers > 1 else None
+    try:
+        for ba in ba_ls:
+            if lg.stop_requested():
                 break
-            sp.call(["cp", kdir + kbf, w2k.filepath(".klist_band")])
-            w2k.run_band(bdir, kbf[:-11])
-            t_n = dt.datetime.now()
-            c += 1
-            print("")
-            print("FINISH: " + str((t_n - t_st) / c * len(fl) + t_st))
-            print(
-                "IF YOU WANT TO STOP THIS SCRIPT, MAKE stop.txt FILE IN "
-                + w2k.case_path
+            nldir = w2k.case_path + "NLs/NL_" + str(ba) + "/"
+            bdir = nldir + "band/"
+            kdir = nldir + "klist/"
+            sp.call(["mkdir", "-p", bdir])
+            fl = os.listdir(kdir)
+            fl = [f for f in fl if ".klist_band" in f]
+            fl.sort()
+
+            c = 0
+            t_st = dt.datetime.now()
+
+            # also outputs from before the ledger, run_band skips the recorded ones
+            fl = [f for f in fl if not os.path.exists(band_file(bdir, f[:-11]))]
+
+            if sch is not None:
+                jobs = [sch.band_job(kdir + f, bdir, f[:-11], spag=spag) for f in fl]
+                sch.run(jobs)
+                continue
+
+            for kbf in fl:
+                if lg.stop_requested(w2k.case_path + "stop.txt"):
+                    break
+                sp.call(["cp", kdir + kbf, w2k.filepath(".klist_band")])
+                try:
+                    w2k.run_band(bdir, kbf[:-11], spag=spag)
+                except RuntimeError as e:  # recorded as failed, redone on the next call
+                    print("ERROR : " + str(e))
+                t_n = dt.datetime.now()
+                c += 1
+                print("")
+                print("FINISH: " + str((t_n - t_st) / c * len(fl) + t_st))
+                print(
+                    "IF YOU WANT TO STOP THIS SCRIPT, MAKE stop.txt FILE IN "
+                    + w2k.case_path
+                    + " OR SEND SIGTERM"
+                )
+                print("")
+    finally:
+        if sch is not None:  # the copies of the case are not needed any more
+            sch.cleanup()
+
+
+def nl_store(ba):  # append-only store of fine NL data of band ba
+    nldir = w2k.case_path + "NLs/NL_" + str(ba) + "/"
+    store = st.ChunkStore(nldir + "store/")
+    if len(store.manifest["chunks"]) == 0:
+        if os.path.exists(nldir + "NL" + str(ba) + "_k_data.npy"):  # old layout
+            store.append(
+                "NL" + str(ba) + "_data",
+                k=np.load(nldir + "NL" + str(ba) + "_k_data.npy"),
+                e=np.load(nldir + "NL" + str(ba) + "_e_data.npy"),
+                g=np.load(nldir + "NL" + str(ba) + "_g_data.npy"),
             )
-            print("")
+            kdir = nldir + "klist/"
+            fl = sorted(os.listdir(kdir)) if os.path.isdir(kdir) else []
+            for f in fl:  # band files already in the old arrays, not parsed again
+                if f.endswith(".npy") and os.path.exists(
+                    band_file(nldir + "band/", f[:-4])
+                ):
+                    store.append(f[:-4])
+            store.flush()
+    return store
 
 
 def get_NLlist_fine(ba_ls):  # get fine NL list between selected band
-    def sym_xyz(arr, ax):
-        narr = arr.copy()
-        narr[:, np.mod(ax, 3)] = arr[:, np.mod(ax + 1, 3)]
-        narr[:, np.mod(ax + 1, 3)] = arr[:, np.mod(ax, 3)]
-        return narr
-
-    def sym_0(arr, ax):
-        narr = arr.copy()
-        narr[:, ax] = arr[:, ax] * -1
-        return narr
+    ops = sym.read_struct_ops(w2k.filepath(".struct"))
 
     for ba in ba_ls:
         nldir = w2k.case_path + "NLs/NL_" + str(ba) + "/"
@@ -236,78 +280,39 @@ def get_NLlist_fine(ba_ls):  # get fine NL list between selected band
         fl = [f[:-4] for f in fl if ".npy" in f]
         fl.sort()
 
-        if os.path.exists(nldir + "NL" + str(ba) + "_k_data.npy"):
-            out_k = np.load(nldir + "NL" + str(ba) + "_k_data.npy")
-            out_e = np.load(nldir + "NL" + str(ba) + "_e_data.npy")
-            out_g = np.load(nldir + "NL" + str(ba) + "_g_data.npy")
-        else:
-            out_k = np.zeros((0, 3))
-            out_e = np.zeros((0))
-            out_g = np.zeros((0))
+        store = nl_store(ba)
 
-        for f in fl:
+        for f in fl:  # ingest only band files not in the store yet
+            if store.has(f) or not os.path.exists(band_file(bdir, f)):
+                continue
             print(f)
             kp = np.load(kdir + f + ".npy")
-            eng, _ = anal.load_agr(bdir + f + "up.bands.agr")
+            eng = load_band(band_file(bdir, f))
             eng_1 = eng[ba - 1]
             eng_2 = eng[ba]
             eng_d = eng_2 - eng_1
             eng_a = (eng_2 + eng_1) / 2
             if eng_d.shape[0] == kp.shape[0]:
-                out_k = np.concatenate([out_k, kp])
-                out_e = np.concatenate([out_e, eng_a])
-                out_g = np.concatenate([out_g, eng_d])
+                store.append(f, k=kp, e=eng_a, g=eng_d)
             else:
                 print("ERROR: wrong data in " + f)
-
-        np.save(nldir + "NL" + str(ba) + "_k_data.npy", out_k)
-        np.save(nldir + "NL" + str(ba) + "_e_data.npy", out_e)
-        np.save(nldir + "NL" + str(ba) + "_g_data.npy", out_g)
+        store.close()
 
         cutoff = 0.001  # degenerate cutoff parameter
 
-        out_e_1 = out_e
-        out_k_1 = out_k
-        out_g_1 = out_g
-
-        out_e = []
-        out_g = []
-        out_k = []
-
-        for i in range(out_k_1.shape[0]):  # extract degenerate points with cutoff
-            if out_g_1[i] < cutoff:
-                out_e.append(out_e_1[i])
-                out_k.append(out_k_1[i])
-                out_g.append(out_g_1[i])
-
-        out_k = np.array(out_k)
-        out_e = np.array(out_e)
-        out_g = np.array(out_g)
-
-        # symmetrize
-        out_k1 = np.concatenate([out_k, sym_xyz(out_k, 0)])
-        out_e1 = np.concatenate([out_e, out_e])
-        out_g1 = np.concatenate([out_g, out_g])
-
-        out_k = np.concatenate([out_k1, sym_xyz(out_k1, 1)])
-        out_e = np.concatenate([out_e1, out_e1])
-        out_g = np.concatenate([out_g1, out_g1])
-
-        out_k1 = np.concatenate([out_k, sym_xyz(out_k, 2)])
-        out_e1 = np.concatenate([out_e, out_e])
-        out_g1 = np.concatenate([out_g, out_g])
-
-        out_k = np.concatenate([out_k1, sym_0(out_k1, 0)])
-        out_e = np.concatenate([out_e1, out_e1])
-        out_g = np.concatenate([out_g1, out_g1])
+        out_k, out_e, out_g = store.read("k", "e", "g")
+        if out_k is None:
+            print("no data in " + store.path)
+            continue
 
-        out_k1 = np.concatenate([out_k, sym_0(out_k, 1)])
-        out_e1 = np.concatenate([out_e, out_e])
-        out_g1 = np.concatenate([out_g, out_g])
+        # extract degenerate points with cutoff
+        deg = out_g < cutoff
+        out_k = out_k[deg]
+        out_e = out_e[deg]
+        out_g = out_g[deg]
 
-        out_k = np.concatenate([out_k1, sym_0(out_k1, 2)])
-        out_e = np.concatenate([out_e1, out_e1])
-        out_g = np.concatenate([out_g1, out_g1])
+        # symmetrize with the point group operations of case.struct
+        out_k, (out_e, out_g) = sym.unfold(out_k, ops, [out_e, out_g])
 
         np.save(nldir + "NL" + str(ba) + "_k.npy", out_k)
         wave = iw.IgorWave(out_k, name="NL" + str(ba) + "_k")
@@ -322,8 +327,47 @@ def get_NLlist_fine(ba_ls):  # get fine NL list between selected band
         wave.save(nldir + "NL" + str(ba) + "_g.ibw")
 
 
+def band_evaluator(ba, outfol, max_k=2000):  # octree evaluator running WIEN2k
+    sp.call(["mkdir", "-p", outfol + "klist/"])
+    sp.call(["mkdir", "-p", outfol + "band/"])
+
+    def evaluate(kint, d):
+        if lg.stop_requested():  # the octree state is saved, run again to resume
+            raise KeyboardInterrupt("stop requested")
+        name = "oct_" + str(len(os.listdir(outfol + "klist/")))
+        path = outfol + "klist/" + name + ".klist_band"
+        kb.write_klist(path, kint, d)
+        w2k.run_band_batch(outfol + "band/", [[name, path]], max_k, spag=spag)
+        eng = load_band(band_file(outfol + "band/", name))
+        if len(eng.shape) < 2 or eng.shape[1] != kint.shape[0]:
+            raise RuntimeError("wrong data in " + name)
+        return (eng[ba] + eng[ba - 1]) / 2, eng[ba] - eng[ba - 1]
+
+    return evaluate
+
+
+def refine_NL(ba_ls, depth=6, lipschitz=10.0):  # adaptive search from coarse NL list
+    start_jobs()
+    ops = sym.read_struct_ops(w2k.filepath(".struct"))
+
+    for ba in ba_ls:
+        nldir = w2k.case_path + "NLs/NL_" + str(ba) + "/"
+        tree = oc.Octree(nldir + "octree/", 100, depth, 0.001, lipschitz)
+        if tree.rounds == 0 and tree.queue.shape[0] == 0:
+            nl = np.load(w2k.case_path + "mapall/NL_" + str(ba) + ".npy")
+            tree.seed(np.rint(nl * 100))
+        tree.run(band_evaluator(ba, nldir + "octree/"))
+
+        out_k, out_e, out_g = tree.hits()
+        out_k, (out_e, out_g) = sym.unfold(out_k, ops, [out_e, out_g])
+        for v, x in [["k", out_k], ["e", out_e], ["g", out_g]]:
+            np.save(nldir + "NL" + str(ba) + "_oct_" + v + ".npy", x)
+            wave = iw.IgorWave(x, name="NL" + str(ba) + "_oct_" + v)
+            wave.save(nldir + "NL" + str(ba) + "_oct_" + v + ".ibw")
+
+
 if __name__ == "__main__":
-    mapall()
+    mapall(ops=sym.read_struct_ops(w2k.filepath(".struct")))
     make_3Dband_npy()
     get_NLlist_coarse([30, 31])
     make_klist_NL([30, 31])
@@ -2,87 +2,385 @@ import numpy as np
 import subprocess as sp
 from igorwriter import IgorWave
 import os
+import re
+import hashlib
+import io
+import json
+import warnings
+from concurrent import futures
+import energy_w2k
+
+_AGR_MARK = re.compile(r"^[ \t]*([#&@])(.*)$", re.M)
+_AGR_ROW = re.compile(r"^[ \t]*\S+[ \t]+\S+[ \t]+\S+[ \t]*$", re.M)  # 3 columns
+
+
+def _agr_rows(block, path, ba):  # parse numeric block of one band into (k, 3) array
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", DeprecationWarning)
+            vals = np.fromstring(block, sep=" ")
+        # bulk parse only if every non-blank line is a row of 3 columns, any other
+        # line adds values beyond 3 per row
+        n = len(_AGR_ROW.findall(block))
+        if vals.size == 3 * n:
+            return vals.reshape(-1, 3)
+    except (ValueError, DeprecationWarning):
+        pass
+
+    rows = []  # fall back to line by line parse to report broken lines
+    for line in block.splitlines():
+        ls = line.split()
+        if len(ls) == 0:
+            continue
+        try:
+            lsf = [float(l) for l in ls]
+        except ValueError:
+            print("Wrong Data in " + path + " # bandindex: " + str(ba))
+            continue
+        if len(lsf) == 3:
+            rows.append(lsf)
+        else:
+            print("Wrong Data in " + path + " # bandindex: " + str(ba))
+    return np.array(rows).reshape(-1, 3)
+
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "w2k_scripts")
+CACHE_MAX_BYTES = 4 * 1024**3  # evict least recently used entries above this size
+CACHE_ON = 1  # 1: load_agr / load_dos use the binary cache, 0: always parse text
+_cache_total = None  # bytes in CACHE_DIR, counted once per process
+
+
+def set_cache(path=None, max_bytes=None, on=None):
+    """load_agr / load_dos のキャッシュ設定を変更する.
+
+    Args:
+        path (str, optional): キャッシュディレクトリ.
+        max_bytes (int, optional): キャッシュ全体の上限サイズ (byte).
+        on (int, optional): 1: キャッシュ有効, 0: 無効.
+    """
+    global CACHE_DIR, CACHE_MAX_BYTES, CACHE_ON, _cache_total
+    if path is not None:
+        CACHE_DIR = path
+        _cache_total = None
+    if max_bytes is not None:
+        CACHE_MAX_BYTES = max_bytes
+    if on is not None:
+        CACHE_ON = on
+
+
+def _cache_name(path, kind):  # (prefix for every version of path, entry file name)
+    st = os.stat(path)
+    head = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    state = hashlib.sha1((str(st.st_size) + "-" + str(st.st_mtime_ns)).encode())
+    return head, head + "_" + state.hexdigest()[:12] + "." + kind + ".npy"
+
+
+def _cache_load(path, kind):
+    head, name = _cache_name(path, kind)
+    cpath = os.path.join(CACHE_DIR, name)
+    try:
+        arr = np.load(cpath, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    os.utime(cpath)  # mark as recently used for eviction
+    return arr
+
+
+def _cache_save(path, kind, arr):
+    global _cache_total
+    head, name = _cache_name(path, kind)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        cur = os.path.join(CACHE_DIR, head + "." + kind + ".cur")  # current entry name
+        if os.path.exists(cur):  # drop the entry of the older version of the file
+            with open(cur, "r") as f:
+                old = f.read().strip()
+            if old and old != name:
+                _cache_remove(old)
+        tmp = os.path.join(CACHE_DIR, name + "." + str(os.getpid()) + ".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, arr)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, os.path.join(CACHE_DIR, name))
+        with open(cur, "w") as f:
+            f.write(name)
+        if _cache_total is None:  # one listing per process, then a running total
+            _cache_total = _cache_size()
+        else:
+            _cache_total += size
+        if _cache_total > CACHE_MAX_BYTES:
+            _cache_evict()
+    except OSError as e:  # cache is optional, loading must not fail because of it
+        print("cache not saved : " + str(e))
+
+
+def _cache_remove(name):
+    global _cache_total
+    try:
+        size = os.path.getsize(os.path.join(CACHE_DIR, name))
+        os.remove(os.path.join(CACHE_DIR, name))
+    except OSError:
+        return
+    if _cache_total is not None:
+        _cache_total -= size
+
+
+def _cache_size():
+    return sum(
+        os.path.getsize(os.path.join(CACHE_DIR, f))
+        for f in os.listdir(CACHE_DIR)
+        if f.endswith(".npy")
+    )
+
+
+def _cache_evict():
+    global _cache_total
+    ent = []
+    for f in os.listdir(CACHE_DIR):
+        if f.endswith(".npy"):
+            st = os.stat(os.path.join(CACHE_DIR, f))
+            ent.append((st.st_mtime, st.st_size, f))
+    ent.sort()
+    total = sum(e[1] for e in ent)
+    for _, size, f in ent:
+        if total <= CACHE_MAX_BYTES:
+            break
+        os.remove(os.path.join(CACHE_DIR, f))
+        total -= size
+    _cache_total = total
+
+
+def clear_cache(path=None):
+    """キャッシュを削除する.
+
+    Args:
+        path (str, optional): 指定したファイルのキャッシュのみ削除する. 指定しない場合は全て削除.
+    """
+    global _cache_total
+    if not os.path.isdir(CACHE_DIR):
+        return
+    _cache_total = None
+    if path is None:
+        head = ""
+    else:
+        head = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16] + "_"
+    for f in os.listdir(CACHE_DIR):
+        if f.startswith(head) and (f.endswith(".npy") or f.endswith(".cur")):
+            os.remove(os.path.join(CACHE_DIR, f))
 
 
-def load_agr(path):  # output: ndarray energy(band,kx), weight(band,kx)
-    if not path.endswith(".agr"):
-        return 0
+def _parse_agr(path, band_range=None):  # list of (bandindex, (k, 3) rows)
     with open(path, "r") as f:
-        lines = f.readlines()
+        text = f.read()
+
+    # find block boundaries once, numeric text between them is parsed in bulk
+    blocks = []
     ba = 1
-    ba_ls = [i for i in range(1, 600)]
-    eng = []
-    wei = []
-    n = 0
-    l = 0
-    for line in lines:
-        line = line.lstrip()
-        if line.startswith("@"):
-            pass
-        elif line.startswith("#"):
-            if line.startswith("# bandindex:"):
-                if ba in ba_ls:
-                    eng.append([])
-                    wei.append([])
-        elif line.startswith("&"):
-            if ba in ba_ls:
-                n += 1
+    inside = 0
+    pos = 0
+    for m in _AGR_MARK.finditer(text):
+        if inside:
+            blocks[-1][1].append(text[pos : m.start()])
+        pos = m.end()
+        if m.group(1) == "#":
+            if m.group(2).startswith(" bandindex:"):
+                inside = 1
+                blocks.append((ba, []))
+        elif m.group(1) == "&":
+            inside = 0
             ba += 1
-        elif len(line) > 0:
-            if ba in ba_ls:
-                ls = line.split()
-                try:
-                    lsf = [float(l) for l in ls]
-                except ValueError:
-                    print("Wrong Data in " + path + " # bandindex: " + str(ba))
-                if len(lsf) == 3:
-                    eng[n].append(lsf[1])
-                    wei[n].append(lsf[2])
-                else:
+    if inside:
+        blocks[-1][1].append(text[pos:])
+
+    if band_range is not None:
+        blocks = [b for b in blocks if band_range[0] <= b[0] <= band_range[1]]
+
+    return [(b[0], _agr_rows("\n".join(b[1]), path, b[0])) for b in blocks]
+
+
+def load_agr(
+    path, band_range=None, e_window=None, cache=1
+):  # output: ndarray energy(band,kx), weight(band,kx)
+    """spaghettiの.agrファイルからバンドエネルギーと重みを読み込む.
+
+    キャッシュが有効な場合, 初回は全バンドを読み込んでバイナリで保存し,
+    2回目以降はファイルのサイズと更新時刻が同じであればそれをmemmapで返す.
+
+    Args:
+        path (str): .agrファイルのパス
+        band_range (Tuple[int, int], optional): 読み込むbandindexの範囲 (両端を含む, 1始まり).
+        e_window (Tuple[float, float], optional): この範囲に1点でも入るバンドのみ残す.
+        cache (int, optional): 0でキャッシュを使わない. デフォルト値=1.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: energy(band,kx), weight(band,kx)
+    """
+    if not path.endswith(".agr"):
+        return 0
+
+    cache = cache and CACHE_ON
+    if cache:
+        # layout: [energy|weight, band, 0: bandindex / 1: k points]
+        arr = _cache_load(path, "agr")
+        if arr is None:
+            data = _parse_agr(path)
+            if len(data) == 0:
+                return np.array([]), np.array([])
+            nk = max(d.shape[0] for _, d in data)
+            arr = np.full((2, len(data), nk + 1), np.nan)
+            for n, (ba, d) in enumerate(data):
+                if d.shape[0] < nk:
                     print("Wrong Data in " + path + " # bandindex: " + str(ba))
-        l += 1
-    energy = np.array(eng)
-    weight = np.array(wei)
+                arr[:, n, 0] = ba
+                arr[0, n, 1 : d.shape[0] + 1] = d[:, 1]
+                arr[1, n, 1 : d.shape[0] + 1] = d[:, 2]
+            _cache_save(path, "agr", arr)
+
+        sel = np.ones(arr.shape[1], dtype=bool)
+        if band_range is not None:
+            sel &= (arr[0, :, 0] >= band_range[0]) & (arr[0, :, 0] <= band_range[1])
+        if e_window is not None:
+            e = arr[0, :, 1:]
+            sel &= np.any((e >= e_window[0]) & (e <= e_window[1]), axis=1)
+        if np.all(sel):
+            return arr[0, :, 1:], arr[1, :, 1:]
+        if not np.any(sel):
+            return np.array([]), np.array([])
+        return arr[0, sel, 1:], arr[1, sel, 1:]
+
+    data = _parse_agr(path, band_range)
+
+    if e_window is not None:
+        data = [
+            (ba, d)
+            for ba, d in data
+            if np.any((d[:, 1] >= e_window[0]) & (d[:, 1] <= e_window[1]))
+        ]
+
+    if len(data) == 0:
+        return np.array([]), np.array([])
+
+    nk = max(d.shape[0] for _, d in data)
+    energy = np.empty((len(data), nk))
+    weight = np.empty((len(data), nk))
+    for n, (ba, d) in enumerate(data):
+        if d.shape[0] < nk:
+            print("Wrong Data in " + path + " # bandindex: " + str(ba))
+            energy[n, d.shape[0] :] = np.nan
+            weight[n, d.shape[0] :] = np.nan
+        energy[n, : d.shape[0]] = d[:, 1]
+        weight[n, : d.shape[0]] = d[:, 2]
     return energy, weight
 
 
-def load_dos(path):
+def load_dos(path, cache=1):
+    """.dosNeVファイルを読み込む.
+
+    Returns:
+        np.ndarray: ヘッダの列名 (ENERGY, total, ...) をフィールドに持つ構造化配列
+    """
     if not ".dos" in path:
         return 0
 
     if not os.path.isfile(path):
         return 0
 
-    with open(path, "r") as f:
-        lines = f.readlines()
-
-    ind = lines[2].split()
-    del lines[0:3]
-    del ind[0]
-
-    dos = {}
+    cache = cache and CACHE_ON
+    if cache:
+        dos = _cache_load(path, "dos")
+        if dos is not None:
+            return dos
 
-    for i in ind:
-        dos[i] = []
+    with open(path, "r") as f:
+        head = [f.readline() for _ in range(3)]
+        text = f.read()
+
+    ind = head[2].split()[1:]
+    names = []
+    for i in ind:  # structured array needs unique field names
+        n = i
+        while n in names:
+            n += "_"
+        names.append(n)
+
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", DeprecationWarning)
+            vals = np.fromstring(text, sep=" ")
+    except (ValueError, DeprecationWarning):
+        vals = np.zeros(1)
+    nrow = text.strip().count("\n") + 1
+    if vals.size == nrow * len(ind):
+        vals = vals.reshape(-1, len(ind))
+    else:  # ragged lines, read the named columns only
+        vals = np.loadtxt(io.StringIO(text), usecols=range(len(ind)), ndmin=2)
+    dos = np.ascontiguousarray(vals).view([(n, "f8") for n in names])[:, 0]
+
+    if cache:
+        _cache_save(path, "dos", dos)
 
-    for l in lines:
-        ll = l.split()
-        for i in range(len(ind)):
-            dos[ind[i]].append(float(ll[i]))
+    return dos
 
-    for i in ind:
-        dos[i] = np.array(dos[i])
 
-    return dos
+def voxelize(vol, agr, e_s, e_e, e_st, ky, wei=None, mode="binary"):
+    """バンド配列 agr(band,kx) をまとめて vol(e,kx,ky) の ky 断面に書き込む.
+
+    Args:
+        vol (np.ndarray): 書き込み先 (e_n, kx_n, ky_n)
+        agr (np.ndarray): energy(band,kx)
+        e_s (float): エネルギー始点
+        e_e (float): エネルギー終点
+        e_st (float): エネルギーステップ
+        ky (int): 書き込む ky index
+        wei (np.ndarray, optional): weight(band,kx). mode="weight" で使用.
+        mode (str, optional): "binary": 1を立てる, "count": 点数を数える, "weight": weightの和 (vol は浮動小数点).
+    """
+    if agr.ndim < 2 or agr.size == 0:
+        return
+    kx = np.broadcast_to(np.arange(agr.shape[1]), agr.shape)
+    m = (agr >= e_s) & (agr <= e_e) & (kx < vol.shape[1])
+    ve = np.rint((agr[m] - e_s) / e_st).astype(np.intp)
+    kx = kx[m]
+    inside = ve < vol.shape[0]
+    ve = ve[inside]
+    kx = kx[inside]
+    if mode == "binary":
+        vol[ve, kx, ky] = 1
+    elif mode == "count":
+        np.add.at(vol, (ve, kx, ky), 1)
+    elif mode == "weight":
+        if not np.issubdtype(vol.dtype, np.floating):
+            raise ValueError("mode weight needs a float vol, not " + str(vol.dtype))
+        np.add.at(vol, (ve, kx, ky), wei[m][inside])
+    else:
+        raise ValueError("unknown mode : " + str(mode))
 
 
 def make_vox_vol(
-    e_s, e_e, e_st, kx_n, ky_n, datafol, filename, spin=1
+    e_s,
+    e_e,
+    e_st,
+    kx_n,
+    ky_n,
+    datafol,
+    filename,
+    spin=1,
+    mode="binary",
+    dtype=np.float64,
 ):  # spin 1: on, 0: off
+    """.agrファイル群から (e, kx, ky) のボクセルデータを作る.
+
+    Args:
+        mode (str, optional): "binary", "count", "weight" (.agr第3列の和). デフォルト値="binary".
+        dtype (optional): 出力の型. np.float32 や np.uint8 でメモリを節約できる.
+            mode="weight" では浮動小数点の型のみ.
+    """
+    if mode == "weight" and not np.issubdtype(dtype, np.floating):
+        raise ValueError("mode weight needs a float dtype, not " + str(np.dtype(dtype)))
     e_n = int(round((e_e - e_s) / e_st) + 1)
 
-    vol0 = np.zeros((e_n, kx_n, ky_n))
-    vol1 = np.zeros((e_n, kx_n, ky_n))
+    vol0 = np.zeros((e_n, kx_n, ky_n), dtype=dtype)
+    vol1 = np.zeros((e_n, kx_n, ky_n), dtype=dtype)
 
     if spin:
         spin_ls = ["up", "dn"]
@@ -92,17 +390,11 @@ def make_vox_vol(
     for ky in range(ky_n):
         for s in spin_ls:
             datapath = datafol + filename + str(ky) + s + ".bands.agr"
-            agr, wei = load_agr(datapath)
-            for band in range(agr.shape[0]):
-                for kx in range(agr.shape[1]):
-                    if agr[band, kx] >= e_s and agr[band, kx] <= e_e:
-                        ve = int(round((agr[band, kx] - e_s) / e_st))
-                        if s == "up":
-                            vol0[ve, kx, ky] = 1
-                        elif s == "dn":
-                            vol1[ve, kx, ky] = 1
-                        else:
-                            vol0[ve, kx, ky] = 1
+            agr, wei = load_agr(datapath, e_window=(e_s, e_e))
+            if s == "dn":
+                voxelize(vol1, agr, e_s, e_e, e_st, ky, wei, mode)
+            else:
+                voxelize(vol0, agr, e_s, e_e, e_st, ky, wei, mode)
 
     if spin:
         return vol0, vol1, {"Offset": e_s, "Delta": e_st, "Size": e_n}
@@ -110,7 +402,68 @@ def make_vox_vol(
         return vol0, {"Offset": e_s, "Delta": e_st, "Size": e_n}
 
 
-def make_3Dband_array(kml, spin, dfpath, savepath):  # kml: [knumber y, knumber z]
+def agr_shape(path):  # output: (band, kx) of .agr file without parsing the numbers
+    if CACHE_ON:
+        arr = _cache_load(path, "agr")
+        if arr is not None:
+            return arr.shape[1], arr.shape[2] - 1
+    with open(path, "r") as f:
+        text = f.read()
+    nb = 0
+    nk = 0
+    pos = -1
+    for m in _AGR_MARK.finditer(text):
+        if m.group(1) == "#" and m.group(2).startswith(" bandindex:"):
+            nb += 1
+            if nb == 1:
+                pos = m.end()
+        elif m.group(1) == "&" and nb == 1 and pos >= 0:
+            nk = len([l for l in text[pos : m.start()].split("\n") if l.strip()])
+            pos = -1
+    return nb, nk
+
+
+def load_bands(path, ef=None):
+    """.agrファイルまたは run_band(spag=0) の.energyファイルからバンドエネルギーを読み込む.
+
+    Args:
+        path (str): .agrまたは.energyファイルのパス
+        ef (float, optional): .energyの場合のFermi Energy (Ry). 指定した場合は.agrと同じ E - ef (eV).
+
+    Returns:
+        np.ndarray: energy(band, kx)
+    """
+    if path.endswith(".agr"):
+        return load_agr(path)[0]
+    return energy_w2k.load_energy(path, trim=0, ef=ef)[1]
+
+
+def band_shape(path):  # output: (band, kx) of .agr or .energy file
+    if path.endswith(".agr"):
+        return agr_shape(path)
+    return load_bands(path).shape
+
+
+def make_3Dband_array(
+    kml, spin, dfpath, savepath, nband=0, mmap=1, irrmap="", ext=".bands.agr", ef=None
+):  # kml: [knumber y, knumber z]
+    """.agrファイル群から (kz, ky, band, kx) のバンド配列を作り.npyに保存する.
+
+    最大バンド数を先に決めて出力を確保し, 各ラインをその場に書き込む.
+    バンド数が足りないラインはNaNで埋める.
+
+    Args:
+        nband (int, optional): 最大バンド数. 0の場合はファイルを走査して決める.
+        mmap (int, optional): 1: .npyをmemmapとして直接書き込む, 0: メモリ上で作ってから保存.
+        irrmap (str, optional): 既約点で計算した場合の irr.npz のパス.
+            指定した場合は dfpath の irr_<i> を読み込み, index対応で全格子に展開する. kml は使わない.
+        ext (str, optional): ".bands.agr" または run_band(spag=0) の ".energy". デフォルト値=".bands.agr".
+        ef (float, optional): ".energy" の場合のFermi Energy (Ry). load_bands を参照.
+    """
+    if irrmap:
+        _make_3Dband_irr(spin, dfpath, savepath, nband, mmap, irrmap, ext, ef)
+        return
+
     dims = len(kml) + 1
     kmy = kml[0]
 
@@ -119,182 +472,348 @@ def make_3Dband_array(kml, spin, dfpath, savepath):  # kml: [knumber y, knumber
     else:
         kmz = 1
 
+    def agrpath(kz, ky):
+        return dfpath + "map_kz" + str(kz) + "_ky" + str(ky) + spin + ext
+
+    nk = 0
+    if nband <= 0:
+        for kz in range(kmz):
+            for ky in range(kmy):
+                nb, n = band_shape(agrpath(kz, ky))
+                nband = max(nband, nb)
+                nk = max(nk, n)
+    else:
+        nk = band_shape(agrpath(0, 0))[1]
+
+    full = (kmz, kmy, nband, nk)
+    shape = tuple(n for n in full if n != 1)  # same as np.squeeze of the full array
+
+    if not savepath.endswith(".npy"):
+        savepath += ".npy"
+    if mmap:
+        ch = np.lib.format.open_memmap(savepath, mode="w+", dtype=float, shape=shape)
+    else:
+        ch = np.empty(shape)
+    vol = ch.reshape(full)
+
     for kz in range(kmz):
         print(str(kz) + " / " + str(kmz - 1))
+        vol[kz] = np.nan
         for ky in range(kmy):
-            path = dfpath + "map_kz" + str(kz) + "_ky" + str(ky) + spin + ".bands.agr"
-            agr, wei = load_agr(path)
+            agr = load_bands(agrpath(kz, ky), ef)
             if len(agr.shape) < 2:
                 print(agr.shape)
-            agrv = np.expand_dims(agr, 0)
-            agrv = np.expand_dims(agrv, 0)
+                continue
+            vol[kz, ky, : agr.shape[0], : agr.shape[1]] = agr[:nband, :nk]
 
-            if ky == 0:
-                vol = agrv
-            else:
-                if vol.shape[2] > agrv.shape[2]:
-                    nans = np.empty(
-                        (
-                            agrv.shape[0],
-                            agrv.shape[1],
-                            vol.shape[2] - agrv.shape[2],
-                            agrv.shape[3],
-                        )
-                    )
-                    nans[:] = np.nan
-                    agrv = np.append(agrv, nans, axis=2)
-                elif vol.shape[2] < agrv.shape[2]:
-                    nans = np.empty(
-                        (
-                            vol.shape[0],
-                            vol.shape[1],
-                            agrv.shape[2] - vol.shape[2],
-                            vol.shape[3],
-                        )
-                    )
-                    nans[:] = np.nan
-                    vol = np.append(vol, nans, axis=2)
-
-                vol = np.concatenate([vol, agrv], 1)
-
-        if kz == 0:
-            ch = vol
-        else:
-            if vol.shape[2] > ch.shape[2]:
-                nans = np.empty(
-                    (ch.shape[0], ch.shape[1], vol.shape[2] - ch.shape[2], ch.shape[3])
-                )
-                nans[:] = np.nan
-                ch = np.append(ch, nans, axis=2)
-            elif vol.shape[2] < ch.shape[2]:
-                nans = np.empty(
-                    (
-                        vol.shape[0],
-                        vol.shape[1],
-                        ch.shape[2] - vol.shape[2],
-                        vol.shape[3],
-                    )
-                )
-                nans[:] = np.nan
-                vol = np.append(vol, nans, axis=2)
-
-            ch = np.concatenate([ch, vol], 0)
-
-    del vol
-    ch = np.squeeze(ch)
-    np.save(savepath, ch)
-
-
-def get_NL_list(npypath, bandindex, cutoff):
-    ch = np.load(npypath)
-    print("npy data loaded")
-    ba1 = bandindex - 1
-    ba2 = bandindex
-    if len(ch.shape) == 4:
-        ch = np.transpose(ch, (2, 3, 1, 0))
-        if ch.shape[0] >= ba2:
-            dif = ch[ba2, :, :, :] - ch[ba1, :, :, :]
-            NL_list = np.where((dif < cutoff))
-            NL_list = np.array(NL_list).T
+    if mmap:
+        ch.flush()
+    else:
+        np.save(savepath, ch)
+    del vol, ch
+
+
+def _make_3Dband_irr(spin, dfpath, savepath, nband, mmap, irrmap, ext, ef):
+    with np.load(irrmap) as z:
+        gmap = z["map"]
+        counts = z["counts"]
+
+    def agrpath(i):
+        return dfpath + "irr_" + str(i) + spin + ext
+
+    if nband <= 0:
+        nband = max(band_shape(agrpath(i))[0] for i in range(len(counts)))
+
+    # energies of all irreducible points, (band, point)
+    ene = np.full((nband, int(np.sum(counts))), np.nan)
+    off = 0
+    for i, c in enumerate(counts):
+        agr = load_bands(agrpath(i), ef)
+        if len(agr.shape) < 2:
+            print(agr.shape)
         else:
-            print("Bandindex out of range")
-            print(ch.shape)
-            NL_list = 0
+            if agr.shape[1] != c:
+                print("Wrong Data in " + agrpath(i) + " : " + str(agr.shape[1]) + " k")
+            nb = min(nband, agr.shape[0])
+            n = min(c, agr.shape[1])  # never into the columns of the next file
+            ene[:nb, off : off + n] = agr[:nb, :n]
+        off += c
+
+    full = (gmap.shape[0], gmap.shape[1], nband, gmap.shape[2])
+    shape = tuple(n for n in full if n != 1)
+
+    if not savepath.endswith(".npy"):
+        savepath += ".npy"
+    if mmap:
+        ch = np.lib.format.open_memmap(savepath, mode="w+", dtype=float, shape=shape)
     else:
-        print("3D band .npy data required")
-        NL_list = 0
+        ch = np.empty(shape)
+    vol = ch.reshape(full)
+
+    for kz in range(full[0]):
+        vol[kz] = ene[:, gmap[kz]].transpose(
+            1, 0, 2
+        )  # (band, ky, kx) -> (ky, band, kx)
+
+    if mmap:
+        ch.flush()
+    else:
+        np.save(savepath, ch)
+    del vol, ch
+
+
+def get_NL_list(npypath, bandindex, cutoff, gap=0, chunk=4096):
+    """バンド bandindex と bandindex+1 の差が cutoff 未満の (kx, ky, kz) index を取得する.
 
-    return NL_list
+    .npyはmemmapで開き, (kz, ky) ラインを chunk 本ずつ, 必要なバンドだけ読み込む.
 
+    Args:
+        npypath (str): make_3Dband_array で作った (kz, ky, band, kx) の.npy
+        bandindex (int or List[int]): バンド番号. リストの場合は一度の走査で全て処理する.
+        cutoff (float): 縮退判定のエネルギー差
+        gap (int, optional): 1の場合, 各点のエネルギー差も返す. デフォルト値=0.
+        chunk (int, optional): 一度に読み込む (kz, ky) ライン数.
 
-def make_3Dband_ibw(npypath, savepath, name, e_s, e_e):
-    ch = np.load(npypath)
+    Returns:
+        np.ndarray: (N, 3) の index. gap=1 の場合は (index, 差) のタプル.
+        bandindex がリストの場合は {bandindex: 上記} の辞書.
+    """
+    ch = np.load(npypath, mmap_mode="r")
+    print("npy data loaded")
+    if len(ch.shape) != 4:
+        print("3D band .npy data required")
+        return 0
+
+    ba_ls = [bandindex] if np.isscalar(bandindex) else list(bandindex)
+    nz, ny, nb, nx = ch.shape
+    out = {}
+    for ba in ba_ls:
+        if ba < 1 or nb <= ba:
+            print("Bandindex out of range")
+            print(ch.shape)
+            out[ba] = 0
+        else:
+            out[ba] = ([], [], [], [])
+    ok = [ba for ba in ba_ls if not np.isscalar(out[ba])]
+
+    if len(ok) > 0:
+        need = sorted(set(ok) | set(ba - 1 for ba in ok))  # band slabs to read
+        pos = {b: i for i, b in enumerate(need)}
+        lines = ch.reshape(nz * ny, nb, nx)
+        for i0 in range(0, nz * ny, chunk):
+            block = lines[i0 : i0 + chunk][:, need, :]
+            for ba in ok:
+                dif = block[:, pos[ba], :] - block[:, pos[ba - 1], :]
+                l, kx = np.nonzero(dif < cutoff)
+                o = out[ba]
+                o[0].append(kx)
+                o[1].append((i0 + l) % ny)
+                o[2].append((i0 + l) // ny)
+                o[3].append(dif[l, kx])
+
+    for ba in ok:
+        kx, ky, kz, dif = [np.concatenate(v) for v in out[ba]]
+        order = np.lexsort((kz, ky, kx))  # same order as np.where on (kx, ky, kz)
+        NL_list = np.array([kx[order], ky[order], kz[order]]).T
+        out[ba] = (NL_list, dif[order]) if gap else NL_list
+
+    if np.isscalar(bandindex):
+        return out[bandindex]
+    return out
+
+
+def get_NL_store(store, bandindex, cutoff, gap=0, spin=0):
+    """get_NL_list と同じ判定を store_w2k.BandStore に対して行う.
+
+    必要なバンドの列だけを query で1度に読み込むので, 全格子の.npyを作らずに済む.
+
+    Args:
+        store (store_w2k.BandStore): k点ラインを取り込んだストア
+        bandindex (int or List[int]): バンド番号 (get_NL_list と同じ)
+        cutoff (float): 縮退判定のエネルギー差
+        gap (int, optional): 1の場合, 各点のエネルギー差も返す. デフォルト値=0.
+        spin (int, optional): 0: up または spin無し, 1: dn. デフォルト値=0.
+
+    Returns:
+        np.ndarray: (N, 3) のk点座標. gap=1 の場合は (k点, 差) のタプル.
+        bandindex がリストの場合は {bandindex: 上記} の辞書.
+    """
+    ba_ls = [bandindex] if np.isscalar(bandindex) else list(bandindex)
+    b0 = max(0, min(ba_ls) - 1)
+    k, e, _, _ = store.query(band_range=[b0, max(ba_ls) + 1], spin=spin)
+    out = {}
+    for ba in ba_ls:
+        if k is None or ba < 1 or e.shape[1] <= ba - b0:
+            print("Bandindex out of range")
+            out[ba] = 0
+            continue
+        dif = e[:, ba - b0] - e[:, ba - 1 - b0]
+        m = dif < cutoff
+        order = np.lexsort((k[m, 2], k[m, 1], k[m, 0]))
+        out[ba] = (k[m][order], dif[m][order]) if gap else k[m][order]
+
+    if np.isscalar(bandindex):
+        return out[bandindex]
+    return out
+
+
+def _mirror(n):  # index of concatenate([flip(x), delete(x, 0)]) along one axis
+    return np.abs(np.arange(-(n - 1), n))
+
+
+def _save_band_ibw(npypath, ba, out, wname, e_s, e_e):
+    ch = np.load(npypath, mmap_mode="r")
+    if len(ch.shape) == 3:  # (ky, band, kx) -> (kx, ky)
+        b = np.asarray(ch[:, ba, :]).T
+    else:  # (kz, ky, band, kx) -> (kx, ky, kz)
+        b = np.asarray(ch[:, :, ba, :]).transpose(2, 1, 0)
+    if not (np.amax(b) >= e_s and np.amin(b) <= e_e):
+        return None
+
+    b = b[np.ix_(*[_mirror(n) for n in b.shape])]
+    k_st = 2 / (b.shape[0] - 1)
+    wave = IgorWave(b, name=wname)
+    wave.set_dimscale("x", -1, k_st, "2pi/a")
+    wave.set_dimscale("y", -1, k_st, "2pi/a")
+    if b.ndim == 3:
+        wave.set_dimscale("z", -1, 2 / (b.shape[2] - 1), "2pi/a")
+    wave.save(out)
+    return out
+
+
+def make_3Dband_ibw(npypath, savepath, name, e_s, e_e, workers=1, process=0):
+    """make_3Dband_array の.npyをバンドごとの.ibwに書き出す.
+
+    各バンドは書き出す直前に鏡映展開するので, 全体のコピーは作らない.
+
+    Args:
+        workers (int, optional): 並列に書き出すバンド数. デフォルト値=1.
+        process (int, optional): 1: プロセスプール, 0: スレッドプールを使う.
+    """
+    ch = np.load(npypath, mmap_mode="r")
     print("npy data loaded")
     dims = len(ch.shape) - 1
-    ky_s = -1
-    ky_e = 1
-    kz_s = -1
-    kz_e = 1
+    nb = ch.shape[-2]
+    del ch
 
     sp.call(["mkdir", "-p", savepath])
-    if dims == 2:
-        ch = np.transpose(ch, (1, 2, 0))
-        print(ch.shape)
-        ch = np.concatenate([np.flip(ch, 1), np.delete(ch, 0, 1)], 1)
-        ch = np.concatenate([np.flip(ch, 2), np.delete(ch, 0, 2)], 2)
-    elif dims == 3:
-        ch = np.transpose(ch, (2, 3, 1, 0))
-        ch = np.concatenate([np.flip(ch, 1), np.delete(ch, 0, 1)], 1)
-        ch = np.concatenate([np.flip(ch, 2), np.delete(ch, 0, 2)], 2)
-        ch = np.concatenate([np.flip(ch, 3), np.delete(ch, 0, 3)], 3)
-        kz_n = ch.shape[3]
-        kz_st = (kz_e - kz_s) / (kz_n - 1)
-    print("concatenate end")
-    ky_n = ch.shape[1]
-    ky_st = (ky_e - ky_s) / (ky_n - 1)
-
-    for ba in range(ch.shape[0]):
-        out = savepath + name + "_Band" + str(ba + 1) + ".ibw"
-        if np.amax(ch[ba]) >= e_s and np.amin(ch[ba]) <= e_e:
-            wave = IgorWave(ch[ba], name=name + "_Band" + str(ba + 1))
-            wave.set_dimscale("x", ky_s, ky_st, "2pi/a")
-            wave.set_dimscale("y", ky_s, ky_st, "2pi/a")
-            if dims == 3:
-                wave.set_dimscale("z", kz_s, kz_st, "2pi/a")
-            wave.save(out)
-            print("save : " + out)
+    if dims not in (2, 3):
+        print("2D or 3D band .npy data required")
+        return
 
+    jobs = []
+    for ba in range(nb):
+        out = savepath + name + "_Band" + str(ba + 1) + ".ibw"
+        jobs.append((npypath, ba, out, name + "_Band" + str(ba + 1), e_s, e_e))
 
-def make_dos_waves(path_list):
-    for rt in path_list:
-        print(rt)
-
-        fl = os.listdir(rt)
-        fl = [f for f in fl if ".dos" in f]
-        fl.sort()
+    if workers > 1:
+        if process:
+            pool = futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            pool = futures.ThreadPoolExecutor(max_workers=workers)
+        with pool:
+            fs = [pool.submit(_save_band_ibw, *j) for j in jobs]
+            for f in futures.as_completed(fs):
+                if f.result() is not None:
+                    print("save : " + f.result())
+    else:
+        for j in jobs:
+            out = _save_band_ibw(*j)
+            if out is not None:
+                print("save : " + out)
+
+
+def _dos_group_waves(rt, fl):
+    ws = {}
+    head = fl[0].split(".")[0]
+    for f in fl:
+        sp = f.split("eV")[1]
+        if sp == "up":
+            r = 1
+        elif sp == "dn":
+            r = -1
+        dos = load_dos(rt + f)
+        for ky in dos.dtype.names:
+            ws[ky + sp] = dos[ky] * r
+
+    print(ws.keys())
+    el = ws["ENERGYup"]
+
+    e_s = el[0]
+    e_n = el.shape[0]
+    e_e = el[e_n - 1]
+    e_st = (e_e - e_s) / (e_n - 1)
+
+    wp = rt + head + "_dos.itx"
+    tmp = wp + ".tmp"
+    with open(tmp, "w") as fp:
+        for ky in ws.keys():
+            if "ENERGY" in ky:
+                pass
+            else:
+                wn = head + "_" + ky.replace(":", "_")
+                wn = wn.replace("-", "_")
+                wave = IgorWave(ws[ky], name=wn)
+                wave.set_dimscale("x", e_s, e_st, "eV")
+                wave.save_itx(fp)
+    os.replace(tmp, wp)
+
+
+def _dos_waves_dir(rt, force):
+    print(rt)
+
+    fl = os.listdir(rt)
+    fl = [f for f in fl if ".dos" in f]
+    fl.sort()
+
+    fm = []
+    head = ""
+    for f in fl:
+        if not f.split(".")[0] == head:
+            head = f.split(".")[0]
+            fm.append([])
+        fm[len(fm) - 1].append(f)
+
+    print(fm)
+
+    # file sizes and mtimes of each group at the last export
+    mpath = rt + "_dos_waves.json"
+    done = {}
+    if os.path.exists(mpath) and not force:
+        with open(mpath, "r") as f:
+            done = json.load(f)
 
-        fm = []
-        head = ""
+    n = 0
+    for fl in fm:
+        head = fl[0].split(".")[0]
+        sig = {}
         for f in fl:
-            if not f.split(".")[0] == head:
-                head = f.split(".")[0]
-                fm.append([])
-            fm[len(fm) - 1].append(f)
-
-        print(fm)
-
-        for fl in fm:
-            ws = {}
-            head = fl[0].split(".")[0]
-            for f in fl:
-                sp = f.split("eV")[1]
-                if sp == "up":
-                    r = 1
-                elif sp == "dn":
-                    r = -1
-                en = 0
-                wp = rt + head + "_dos.itx"
-                path = rt + f
-                dos = load_dos(path)
-                for ky in dos.keys():
-                    ws[ky + sp] = dos[ky] * r
-
-            print(ws.keys())
-            el = ws["ENERGYup"]
-
-            e_s = el[0]
-            e_n = el.shape[0]
-            e_e = el[e_n - 1]
-            e_st = (e_e - e_s) / (e_n - 1)
-
-            with open(wp, "w") as fp:
-                for ky in ws.keys():
-                    if "ENERGY" in ky:
-                        pass
-                    else:
-                        wn = head + "_" + ky.replace(":", "_")
-                        wn = wn.replace("-", "_")
-                        wave = IgorWave(ws[ky], name=wn)
-                        wave.set_dimscale("x", e_s, e_st, "eV")
-                        wave.save_itx(fp)
-        print(len(fm))
+            st = os.stat(rt + f)
+            sig[f] = [st.st_size, st.st_mtime_ns]
+        if done.get(head) == sig and os.path.exists(rt + head + "_dos.itx"):
+            continue
+        _dos_group_waves(rt, fl)
+        done[head] = sig
+        n += 1
+        with open(mpath, "w") as f:
+            json.dump(done, f)
+    print(str(n) + " / " + str(len(fm)) + " written")
+
+
+def make_dos_waves(path_list, workers=1, force=0):
+    """ディレクトリ内の.dosファイルをグループごとに.itxファイルへ変換する.
+
+    前回の書き出しから追加・変更されたグループのみ書き出す.
+
+    Args:
+        path_list (List[str]): .dosファイルがあるディレクトリのリスト
+        workers (int, optional): 並列に処理するディレクトリ数. デフォルト値=1.
+        force (int, optional): 1の場合, 全てのグループを書き出し直す.
+    """
+    if workers > 1:
+        with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for f in [pool.submit(_dos_waves_dir, rt, force) for rt in path_list]:
+                f.result()
+    else:
+        for rt in path_list:
+            _dos_waves_dir(rt, force)
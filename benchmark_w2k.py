@@ -0,0 +1,451 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import numpy as np
+
+import analyze_w2k as anal
+import energy_w2k
+import make_klist_band as kb
+import qtl_w2k
+import scf_w2k
+import store_w2k as st
+import symmetry_w2k as sym
+
+# directory path string must finish with "/"
+
+BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline_small.json"
+)
+
+SIZES = {  # [band, k points per line, ky lines, kz planes]
+    "small": [30, 101, 21, 2],
+    "medium": [60, 201, 101, 2],
+    "large": [80, 401, 201, 4],
+}
+
+
+def synth_bands(nband: int, k: np.ndarray, seed: int = 0) -> np.ndarray:
+    """合成のバンドエネルギー (eV, Ef=0).
+
+    バンドごとに余弦の分散を持ち, 隣のバンドと交差するので縮退点ができる.
+
+    Args:
+        nband (int): バンド数
+        k (np.ndarray): (nk, 3) のk点座標
+        seed (int, optional): 乱数のシード
+
+    Returns:
+        np.ndarray: energy(band, k) (エネルギーの小さい順)
+    """
+    r = np.random.default_rng(seed)
+    center = np.linspace(-10, 5, nband)[:, None]
+    amp = r.uniform(0.2, 1.0, (nband, 3))
+    phase = r.uniform(0, 2 * np.pi, (nband, 3))
+    e = center + np.sum(
+        amp[:, None, :] * np.cos(np.pi * k[None, :, :] + phase[:, None, :]), axis=2
+    )
+    return np.sort(e, axis=0)
+
+
+def write_agr(path: str, e: np.ndarray, w: np.ndarray = None) -> None:
+    """spaghettiと同じ形式の.agrファイル (ヘッダ, "# bandindex:" ブロック, "&") を書く."""
+    nband, nk = e.shape
+    if w is None:
+        w = np.full(e.shape, 0.5)
+    x = np.linspace(0, 1, nk)
+    out = ["# Grace project file", "@version 50122", "@    s0 line type 1"]
+    for b in range(nband):
+        out.append("# bandindex:  " + str(b + 1))
+        rows = np.column_stack([x, e[b], w[b]])
+        out += ["  %10.5f  %10.5f  %10.5f" % tuple(r) for r in rows.tolist()]
+        out.append("&")
+    with open(path, "w") as f:
+        f.write("\n".join(out) + "\n")
+
+
+def write_dos(path: str, ne: int = 3000, ncol: int = 8, seed: int = 0) -> None:
+    """tetraの.dosNeVと同じ形式 (3行のヘッダ, ENERGY と各DOSの列) のファイルを書く."""
+    r = np.random.default_rng(seed)
+    e = np.linspace(-0.8, 0.4, ne)
+    vals = np.abs(r.normal(0, 1, (ne, ncol - 1))).cumsum(axis=0) / ne
+    head = [
+        "# case: synthetic DOS",
+        "# EF=  0.50000   NDOS= " + str(ncol - 1) + "  NENRG= " + str(ne),
+        "#   ENERGY  total" + "".join("  tot-" + str(i) for i in range(1, ncol - 1)),
+    ]
+    rows = np.column_stack([e, vals])
+    with open(path, "w") as f:
+        f.write("\n".join(head) + "\n")
+        np.savetxt(f, rows, fmt="%10.5f")
+
+
+def write_scf(path: str, nite: int = 200, seed: int = 0) -> None:
+    """SCFの反復ごとに :ITE, :ENE, :FER, :DIS, :MMT などを含む.scfファイルを書く."""
+    r = np.random.default_rng(seed)
+    out = []
+    for i in range(1, nite + 1):
+        out.append(":ITE%03d:  %d. ITERATION" % (i, i))
+        out += ["    filler line of lapw0 / lapw1 output %d" % j for j in range(60)]
+        out.append(
+            ":ENE  : ********** TOTAL ENERGY IN Ry =    %16.8f" % (-6000 - r.random())
+        )
+        out.append(
+            ":FER  : F E R M I - ENERGY(TETRAH.M.)=   %10.5f" % (0.5 + r.random() / 100)
+        )
+        out.append(
+            ":DIS  :  CHARGE DISTANCE       ( 0.000%d for atom    1 spin 1)      %10.7f"
+            % (i, 1 / i)
+        )
+        out.append(
+            ":MMT001:  MAGNETIC MOMENT IN SPHERE   1    =   %10.5f" % (3 + r.random())
+        )
+        out.append(":ENERGY convergence:  0 0.0001 .0000500000000000")
+    with open(path, "w") as f:
+        f.write("\n".join(out) + "\n")
+
+
+def write_qtl(path: str, e: np.ndarray, natom: int = 4, ncol: int = 6) -> None:
+    """lapw2 -qtl と同じ形式 (BANDブロック, k点ごとに全atom) の.qtlファイルを書く.
+
+    Args:
+        path (str): 出力ファイル
+        e (np.ndarray): energy(band, k) (eV). Ryに換算して書く.
+        natom (int, optional): 格子間を含むatom数
+        ncol (int, optional): tot を含む軌道の列数
+    """
+    nband, nk = e.shape
+    ene = e / energy_w2k.RY2EV + 0.5
+    w = np.full(ncol, 1 / ncol)
+    fmt = "%10.7f%3d" + "%8.5f" * ncol
+    out = ["synthetic qtl", " FERMI ENERGY=  0.50000"]
+    for b in range(nband):
+        out.append(" BAND:" + "%4d" % (b + 1))
+        for k in range(nk):
+            out += [fmt % (ene[b, k], a + 1, *w) for a in range(natom)]
+    with open(path, "w") as f:
+        f.write("\n".join(out) + "\n")
+
+
+def write_energy(path: str, k: np.ndarray, e: np.ndarray) -> None:
+    """lapw1と同じ形式 (3E19.12,A10,2I6,F5.1) の case.energy を書く. e は eV (Ef=0)."""
+    ene = e / energy_w2k.RY2EV + 0.5
+    out = ["  0.30000000E+00  0.30000000E+00"]
+    for i in range(k.shape[0]):
+        out.append(
+            "%19.12E%19.12E%19.12E%10s%6d%6d%5.1f"
+            % (k[i, 0], k[i, 1], k[i, 2], "", 0, e.shape[0], 1.0)
+        )
+        out += ["%12d%25.15E" % (b + 1, ene[b, i]) for b in range(e.shape[0])]
+    with open(path, "w") as f:
+        f.write("\n".join(out) + "\n")
+
+
+def make_dataset(root: str, nband: int, nk: int, nly: int, nlz: int) -> dict:
+    """ベンチマーク用の合成データを作る.
+
+    mapall と同じ名前の map_kz<kz>_ky<ky>up/dn.bands.agr, .dosNeV, .scf, .qtl, .energy を書く.
+
+    Args:
+        root (str): 出力ディレクトリ
+        nband (int): バンド数
+        nk (int): 1ラインのk点数
+        nly (int): ky ライン数
+        nlz (int): kz 面の数
+
+    Returns:
+        dict: ファイルのパスとサイズ
+    """
+    os.makedirs(root + "data/", exist_ok=True)
+    os.makedirs(root + "klist/", exist_ok=True)
+    kx = np.linspace(0, 1, nk)
+    lines = []
+    for kz in range(nlz):
+        for ky in range(nly):
+            name = "map_kz" + str(kz) + "_ky" + str(ky)
+            k = np.column_stack(
+                [
+                    kx,
+                    np.full(nk, ky / max(nly - 1, 1)),
+                    np.full(nk, kz / max(nlz - 1, 1)),
+                ]
+            )
+            for s, spin in enumerate(["up", "dn"]):
+                e = synth_bands(nband, k, seed=s)
+                write_agr(root + "data/" + name + spin + ".bands.agr", e)
+            with open(root + "klist/" + name + ".klist_band", "w") as f:
+                for r in np.rint(k * 1000).astype(int).tolist():
+                    f.write("%-10s%5d%5d%5d%5d  2.0\n" % ("", *r, 1000))
+                f.write("END\n")
+            lines.append([name, root + "klist/" + name + ".klist_band"])
+
+    k0 = np.column_stack([kx, np.zeros(nk), np.zeros(nk)])
+    e0 = synth_bands(nband, k0)
+    write_dos(root + "case.dos1eVup")
+    write_scf(root + "case.scf")
+    write_qtl(root + "case.qtlup", e0)
+    write_energy(root + "case.energyup", k0, e0)
+    return {
+        "root": root,
+        "lines": lines,
+        "agr": root + "data/map_kz0_ky0up.bands.agr",
+        "dos": root + "case.dos1eVup",
+        "scf": root + "case.scf",
+        "qtl": root + "case.qtlup",
+        "energy": root + "case.energyup",
+        "size": [nband, nk, nly, nlz],
+    }
+
+
+def ingest(ds: dict) -> st.BandStore:
+    """データセットの.agrを全て BandStore に取り込む (NLcalc.map_store と同じ手順)."""
+    root = ds["root"]
+    store = st.BandStore(root + "store/")
+    for name, klist in ds["lines"]:
+        e, w = anal.load_agr(root + "data/" + name + "up.bands.agr", cache=0)
+        store.append_band(name + "up", kb.klist_points(klist), e, w)
+    store.close()
+    return store
+
+
+def measure(fn: Callable[[], object], repeat: int = 3) -> dict:
+    """関数の経過時間 (最小値と中央値) とメモリのピークを測る.
+
+    時間は tracemalloc なしで repeat 回測り, ピークは別に1回だけ tracemalloc で測る.
+    numpyの配列も tracemalloc で数えられる. 関数のprintは捨てる.
+
+    Args:
+        fn (Callable[[], object]): 引数なしの関数
+        repeat (int, optional): 時間を測る回数
+
+    Returns:
+        dict: wall_min, wall_median (s), peak_kb
+    """
+    walls = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            gc.collect()
+            t0 = time.perf_counter()
+            fn()
+            walls.append(time.perf_counter() - t0)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {
+        "wall_min": min(walls),
+        "wall_median": float(np.median(walls)),
+        "peak_kb": peak / 1024,
+    }
+
+
+def benchmarks(ds: dict) -> Dict[str, Callable[[], object]]:
+    """データセットに対するベンチマークの一覧. data.npy と store/ は prepare で作っておく."""
+    root = ds["root"]
+    nband, nk, nly, nlz = ds["size"]
+    ops = sym.cubic_ops()
+
+    def no_cache(fn):
+        def run():
+            anal.set_cache(on=0)
+            try:
+                return fn()
+            finally:
+                anal.set_cache(on=1)
+
+        return run
+
+    def store_ingest():
+        shutil.rmtree(root + "store/", ignore_errors=True)
+        return ingest(ds)
+
+    def nl_unfold():
+        nl = anal.get_NL_list(root + "data.npy", nband // 2, 0.05)
+        k = nl / [max(nk - 1, 1), max(nly - 1, 1), max(nlz - 1, 1)]  # kx, ky, kz
+        return sym.unfold(k, ops, [np.zeros(k.shape[0]), np.zeros(k.shape[0])])
+
+    return {
+        "load_agr": no_cache(lambda: anal.load_agr(ds["agr"])),
+        "load_agr_cached": lambda: anal.load_agr(ds["agr"]),
+        "load_dos": no_cache(lambda: anal.load_dos(ds["dos"])),
+        "load_scf": lambda: (scf_w2k._cache.clear(), scf_w2k.load_scf(ds["scf"])),
+        "scf_last_value": lambda: scf_w2k.last_value(ds["scf"], ":FER"),
+        "load_qtl": lambda: qtl_w2k.load_qtl(ds["qtl"]),
+        "load_energy": lambda: energy_w2k.load_energy(ds["energy"]),
+        "make_vox_vol": no_cache(
+            lambda: anal.make_vox_vol(
+                -3, 1, 0.01, nk, nly, root + "data/", "map_kz0_ky", spin=1
+            )
+        ),
+        "make_3Dband_array": no_cache(
+            lambda: anal.make_3Dband_array(
+                [nly, nlz], "up", root + "data/", root + "data.npy"
+            )
+        ),
+        "get_NL_list": lambda: anal.get_NL_list(
+            root + "data.npy", list(range(1, nband)), 0.05
+        ),
+        "make_3Dband_ibw": lambda: anal.make_3Dband_ibw(
+            root + "data.npy", root + "ibw/", "bench", -1, 1
+        ),
+        "get_NL_store": lambda: anal.get_NL_store(
+            st.BandStore(root + "store/"), list(range(1, nband)), 0.05
+        ),
+        "nl_unfold": nl_unfold,
+        "store_ingest": store_ingest,
+        "store_query": lambda: st.BandStore(root + "store/").query(
+            k_max=[1, 0.3, 1], band_range=[nband // 2 - 2, nband // 2 + 2]
+        ),
+    }
+
+
+def prepare(ds: dict) -> None:
+    """make_3Dband_array の data.npy と BandStore を作る. 後の解析のベンチマークの入力."""
+    root = ds["root"]
+    nband, nk, nly, nlz = ds["size"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        anal.make_3Dband_array([nly, nlz], "up", root + "data/", root + "data.npy")
+        ingest(ds)
+
+
+def run(
+    size: List[int], repeat: int = 3, only: List[str] = [], workdir: str = ""
+) -> dict:
+    """合成データを作り, ベンチマークを実行する.
+
+    Args:
+        size (List[int]): [band, k点数, ky ライン数, kz 面の数]
+        repeat (int, optional): 時間を測る回数. デフォルト値=3.
+        only (List[str], optional): 実行するベンチマーク名. 指定しない場合は全て.
+        workdir (str, optional): 作業ディレクトリ. 指定しない場合は一時ディレクトリを作って最後に消す.
+
+    Returns:
+        dict: "results" (名前ごとの measure の出力) と "meta"
+    """
+    tmp = workdir == ""
+    root = tempfile.mkdtemp(prefix="bench_w2k_") + "/" if tmp else workdir
+    cache = anal.CACHE_DIR
+    anal.set_cache(path=root + "cache/")
+    try:
+        t0 = time.perf_counter()
+        ds = make_dataset(root, *size)
+        prepare(ds)
+        print("dataset %s : %.1f s" % (size, time.perf_counter() - t0))
+        results = {}
+        for name, fn in benchmarks(ds).items():
+            if len(only) > 0 and name not in only:
+                continue
+            results[name] = measure(fn, repeat)
+            r = results[name]
+            print(
+                "%-18s %10.4f s %10.4f s %12.0f kB"
+                % (name, r["wall_min"], r["wall_median"], r["peak_kb"])
+            )
+    finally:
+        anal.set_cache(path=cache)
+        if tmp:
+            shutil.rmtree(root, ignore_errors=True)
+    meta = {
+        "size": size,
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.node(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    return {"meta": meta, "results": results}
+
+
+def compare(current: dict, baseline: dict, threshold: float = 0.2) -> List[str]:
+    """ベースラインと比べて遅くなった, またはメモリが増えたベンチマークを返す.
+
+    時間は wall_min, メモリは peak_kb を比べる. 10 ms 未満の時間は揺らぎが大きいので 10 ms として比べる.
+
+    Args:
+        current (dict): run の出力
+        baseline (dict): 保存した run の出力
+        threshold (float, optional): 許容する増加の割合. デフォルト値=0.2.
+
+    Returns:
+        List[str]: 回帰の説明のリスト. 回帰が無い場合は空.
+    """
+    if current["meta"]["size"] != baseline["meta"]["size"]:
+        print("WARNING : baseline size " + str(baseline["meta"]["size"]) + " differs")
+    out = []
+    for name, r in current["results"].items():
+        b = baseline["results"].get(name)
+        if b is None:
+            continue
+        for key, floor in [["wall_min", 1e-2], ["peak_kb", 64]]:
+            if b[key] < floor and r[key] < floor:
+                continue
+            ratio = r[key] / max(b[key], floor)
+            if ratio > 1 + threshold:
+                out.append(
+                    "%s %s : %.4g -> %.4g (x%.2f)" % (name, key, b[key], r[key], ratio)
+                )
+    return out
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="analysis layer benchmark with synthetic WIEN2k outputs"
+    )
+    parser.add_argument("--size", default="small", choices=list(SIZES))
+    parser.add_argument("--band", type=int, default=0)
+    parser.add_argument("--nk", type=int, default=0)
+    parser.add_argument("--lines", type=int, default=0)
+    parser.add_argument("--planes", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="*", default=[])
+    parser.add_argument("--workdir", default="")
+    parser.add_argument("--save", default="", help="write the results as a baseline")
+    parser.add_argument(
+        "--compare",
+        nargs="?",
+        const=BASELINE,
+        default="",
+        help="baseline .json to compare with, the committed small baseline if omitted",
+    )
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    size = list(SIZES[args.size])
+    for i, v in enumerate([args.band, args.nk, args.lines, args.planes]):
+        if v > 0:
+            size[i] = v
+
+    res = run(size, args.repeat, args.only, args.workdir)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(res, f, indent=1)
+        print("baseline saved : " + args.save)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            base = json.load(f)
+        reg = compare(res, base, args.threshold)
+        for r in reg:
+            print("REGRESSION : " + r)
+        if len(reg) > 0:
+            return 1
+        print("no regression (threshold " + str(args.threshold) + ")")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,6 +12,7 @@ w2k.set_parallel(4)
 
 etot_ls = []
 scf_time_ls = []
+scf_ite_ls = []
 convdir = w2k.case_path + "conv/rkmax/"
 dosout = convdir + "dos/"
 scfout = convdir + "scf/"
@@ -27,8 +28,8 @@ for v in np.arange(v_start, v_end + v_step / 2, v_step):
         w2k.kmesh = 10000
         w2k.gmax = 12
 
-        sp.run("rm *.scf*", shell=True)
-        sp.run("rm *.broyd*", shell=True)
+        sp.run("rm *.scf*", shell=True, cwd=w2k.case_path)
+        sp.run("rm *.broyd*", shell=True, cwd=w2k.case_path)
         w2k.init_lapw()
         dt_s = dt.datetime.now()
         w2k.run_scf()
@@ -36,6 +37,7 @@ for v in np.arange(v_start, v_end + v_step / 2, v_step):
         etot = w2k.get_etot()
         etot_ls.append(etot)
         scf_time_ls.append(scf_time.seconds)
+        scf_ite_ls.append(len(w2k.scf_history()["ITE"]))
 
         vstr = str(v).replace(".", "p")
         dosname = "dos" + vstr
@@ -46,11 +48,14 @@ for v in np.arange(v_start, v_end + v_step / 2, v_step):
 
         etotw = iw.IgorWave(np.array(etot_ls), name="etot")
         scftw = iw.IgorWave(np.array(scf_time_ls), name="scftime")
+        itew = iw.IgorWave(np.array(scf_ite_ls), name="scfite")
         etotw.set_dimscale("x", v_start, v_step, "")
         scftw.set_dimscale("x", v_start, v_step, "")
+        itew.set_dimscale("x", v_start, v_step, "")
         etotw.set_datascale("eV")
         scftw.set_datascale("sec")
         with open(convdir + "scflog.itx", "w") as f:
             etotw.save_itx(f)
             scftw.save_itx(f)
+            itew.save_itx(f)
         an.make_dos_waves([dosout])
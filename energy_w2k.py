@@ -0,0 +1,159 @@
+import numpy as np
+import itertools
+import os
+from typing import Iterator, List, Tuple
+
+# directory path string must finish with "/"
+
+RY2EV = 13.605693  # eV / Ry
+
+
+def _is_kline(line: str) -> bool:  # format (3E19.12,A10,2I6,F5.1)
+    return (
+        len(line) >= 79 and "E" in line[0:19].upper() and line[73:79].strip().isdigit()
+    )
+
+
+def energy_files(path: str, since: float = None) -> List[str]:
+    """case.energy と並列計算の断片 case.energy_1, _2, ... のうち, 読むべきファイルのリスト.
+
+    断片を番号順に見て, 更新時刻が since より古い断片があればそこで止める. 前の計算の
+    ジョブ数が多かった場合に残っている番号の大きい断片は読まない. 新しい断片が無い場合は
+    case.energy を返す.
+
+    Args:
+        path (str): case.energy[so][up|dn] のパス
+        since (float, optional): lapw1 を始めた時刻 (time.time()).
+            デフォルトは case.energy の更新時刻 (無ければ全ての断片).
+
+    Returns:
+        List[str]: ファイルのリスト
+    """
+    if since is None:
+        since = os.path.getmtime(path) if os.path.exists(path) else -np.inf
+    frags = []
+    while True:
+        frag = path + "_" + str(len(frags) + 1)
+        if not os.path.exists(frag) or os.path.getmtime(frag) < since:
+            break
+        frags.append(frag)
+    if len(frags) > 0:
+        return frags
+    return [path]
+
+
+def iter_energy(path: str) -> Iterator[Tuple[np.ndarray, str, float, np.ndarray]]:
+    """case.energy をk点ごとに読むジェネレータ. ファイル全体をメモリに読み込まない.
+
+    Args:
+        path (str): case.energy のパス (断片は energy_files で選ぶ)
+
+    Yields:
+        Tuple[np.ndarray, str, float, np.ndarray]: k点 (3,), k点の名前, 重み (多重度), エネルギー (ne,) (Ry)
+    """
+    with open(path, "r") as f:
+        for line in f:
+            if not _is_kline(line):
+                continue  # linearization energies of the atoms at the top
+            k = np.array([float(line[0:19]), float(line[19:38]), float(line[38:57])])
+            ne = int(line[73:79])
+            wgt = float(line[79:84]) if line[79:84].strip() else 1.0
+            block = "".join(itertools.islice(f, ne))
+            ene = np.fromstring(block, sep=" ").reshape(ne, 2)[:, 1]
+            yield k, line[57:67].strip(), wgt, ene
+
+
+def load_energy(
+    path: str, trim: int = 1, ef: float = None, since: float = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """case.energy (または断片 _1, _2, ...) から全k点を読み込む.
+
+    Args:
+        path (str): case.energy[so][up|dn] のパス
+        trim (int, optional): 1: 全k点に共通のバンド数に揃える, 0: 足りない分をNaNで埋める. デフォルト値=1.
+        ef (float, optional): Fermi Energy (Ry). 指定した場合は E - ef を eV で返す (.agrと同じ).
+        since (float, optional): energy_files に渡す lapw1 の開始時刻.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: k点 (nk, 3), エネルギー (band, nk), 重み (nk,)
+    """
+    ks = []
+    es = []
+    ws = []
+    for p in energy_files(path, since):
+        for k, _, w, e in iter_energy(p):
+            ks.append(k)
+            es.append(e)
+            ws.append(w)
+    if len(es) == 0:
+        return np.zeros((0, 3)), np.zeros((0, 0)), np.zeros(0)
+
+    nb = [e.shape[0] for e in es]
+    ene = np.full((min(nb) if trim else max(nb), len(es)), np.nan)
+    for i, e in enumerate(es):
+        ene[: e.shape[0], i] = e[: ene.shape[0]]
+    if ef is not None:
+        ene = (ene - ef) * RY2EV
+    return np.array(ks), ene, np.array(ws)
+
+
+def _read_blocks(path: str) -> Tuple[List[str], List[List[str]]]:
+    with open(path, "r") as f:
+        lines = f.read().splitlines()
+    head = []
+    blocks = []
+    i = 0
+    while i < len(lines):
+        if _is_kline(lines[i]):
+            ne = int(lines[i][73:79])
+            blocks.append(lines[i : i + 1 + ne])
+            i += 1 + ne
+        else:
+            if len(blocks) == 0:
+                head.append(lines[i])
+            i += 1
+    return head, blocks
+
+
+def merge_energy(src_ls: List[str], dst: str) -> None:
+    """並列計算の断片をk点の順に1つのファイルにまとめる. 先頭のatomの行は最初の断片のもの.
+
+    Args:
+        src_ls (List[str]): 断片のリスト
+        dst (str): 出力ファイル
+    """
+    out = []
+    for i, src in enumerate(src_ls):
+        head, blocks = _read_blocks(src)
+        if i == 0:
+            out += head
+        for b in blocks:
+            out += b
+    with open(dst, "w") as f:
+        f.write("\n".join(out) + "\n")
+
+
+def split_energy(src: str, dst_ls: List[str], counts: List[int]) -> bool:
+    """連結したk点で計算した case.energy を, k点数ごとに複数のファイルに分割する.
+
+    Args:
+        src (str): 分割するファイル
+        dst_ls (List[str]): 出力ファイルのリスト
+        counts (List[int]): 各出力のk点数
+
+    Returns:
+        bool: 分割できた場合True. k点数が合わない場合は何も書かずFalse.
+    """
+    head, blocks = _read_blocks(src)
+    if len(blocks) != sum(counts):
+        print("ERROR: " + src + " has " + str(len(blocks)) + " k points")
+        return False
+    s = 0
+    for dst, c in zip(dst_ls, counts):
+        out = list(head)
+        for b in blocks[s : s + c]:
+            out += b
+        s += c
+        with open(dst, "w") as f:
+            f.write("\n".join(out) + "\n")
+    return True
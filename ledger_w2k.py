@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import signal
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import List
+
+# directory path string must finish with "/"
+
+_stop = False  # set by the signal handler, checked by the drivers
+
+
+def _handler(signum, frame) -> None:
+    global _stop
+    if _stop:  # second signal: stop immediately
+        signal.signal(signum, signal.SIG_DFL)
+        raise KeyboardInterrupt
+    _stop = True
+    print("")
+    print("STOP REQUESTED (" + signal.Signals(signum).name + ").")
+    print("THE CURRENT JOB WILL BE FINISHED. SEND AGAIN TO STOP IMMEDIATELY.")
+    print("")
+
+
+def install_stop_handler() -> None:
+    """SIGINT / SIGTERM を受け取ったら, 実行中のジョブを終えてから止まるようにする.
+
+    1回目のシグナルで停止フラグを立て, 2回目で KeyboardInterrupt を送出する.
+    端末の Ctrl-C は WIEN2k のプロセスにも届くので, 実行中のジョブを残したい場合は
+    pythonのプロセスに kill -TERM を送る.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    signal.signal(signal.SIGINT, _handler)
+    signal.signal(signal.SIGTERM, _handler)
+
+
+def stop_requested(stop_file: str = "") -> bool:
+    """停止が要求されたかどうか.
+
+    Args:
+        stop_file (str, optional): このファイルがあれば削除して停止とみなす. stop.txt など.
+
+    Returns:
+        bool: 停止が要求された場合は True
+    """
+    global _stop
+    if stop_file and os.path.exists(stop_file):
+        print(os.path.basename(stop_file) + " FILE DETECTED.")
+        os.remove(stop_file)
+        _stop = True
+    return _stop
+
+
+def digest(files: List[str] = [], params: dict = {}, stamps: List[str] = []) -> str:
+    """ジョブの入力のハッシュ.
+
+    Args:
+        files (List[str], optional): 内容をハッシュするファイル. 存在しないものは無視する.
+        params (dict, optional): 計算パラメータ. JSONにできる値.
+        stamps (List[str], optional): サイズと更新時刻だけをハッシュする大きなファイル.
+
+    Returns:
+        str: sha1
+    """
+    h = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    for p in files:
+        if os.path.exists(p):  # only the content, a copied file gives the same hash
+            with open(p, "rb") as f:
+                h.update(f.read())
+    for p in stamps:
+        if os.path.exists(p):
+            st = os.stat(p)
+            h.update(
+                (os.path.basename(p) + str(st.st_size) + str(st.st_mtime_ns)).encode()
+            )
+    return h.hexdigest()
+
+
+class Ledger:
+    def __init__(self, path: str) -> None:
+        """SQLiteのジョブ台帳を開く. 存在しない場合は作成する.
+
+        ジョブごとに入力のハッシュ, 状態 (running / done / failed), 開始・終了時刻,
+        出力ファイルを記録する. 接続は操作ごとに開くので, 複数のプロセスから使える.
+
+        Args:
+            path (str): .sqliteファイルのパス
+        """
+        self.path = path
+        with closing(self._connect()) as con, con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "key TEXT PRIMARY KEY, kind TEXT, inputs TEXT, status TEXT, "
+                "start REAL, end REAL, outputs TEXT, error TEXT)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path, timeout=60)
+        con.execute("PRAGMA journal_mode=WAL")
+        return con
+
+    def done(self, key: str, inputs: str) -> bool:
+        """同じ入力のジョブが完了していて, 出力が残っているかどうか.
+
+        Args:
+            key (str): ジョブ名
+            inputs (str): digest の出力
+
+        Returns:
+            bool: 完了している場合は True
+        """
+        with closing(self._connect()) as con:
+            row = con.execute(
+                "SELECT inputs, status, outputs FROM jobs WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[0] != inputs or row[1] != "done":
+            return False
+        return all(os.path.exists(p) for p in json.loads(row[2]))
+
+    def status(self, key: str) -> str:
+        """ジョブの状態. running / done / failed, 記録が無い場合は空文字列."""
+        with closing(self._connect()) as con:
+            row = con.execute(
+                "SELECT status FROM jobs WHERE key = ?", (key,)
+            ).fetchone()
+        return "" if row is None else row[0]
+
+    def start(self, key: str, kind: str, inputs: str) -> None:
+        """ジョブの開始を記録する."""
+        with closing(self._connect()) as con, con:
+            con.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, 'running', ?, NULL, '[]', '')",
+                (key, kind, inputs, time.time()),
+            )
+
+    def finish(
+        self, key: str, outputs: List[str], status: str = "done", error: str = ""
+    ) -> None:
+        """ジョブの終了を記録する.
+
+        Args:
+            key (str): ジョブ名
+            outputs (List[str]): 出力ファイルのパス
+            status (str, optional): "done" または "failed". デフォルト値="done".
+            error (str, optional): 失敗の理由
+        """
+        with closing(self._connect()) as con, con:
+            con.execute(
+                "UPDATE jobs SET status = ?, end = ?, outputs = ?, error = ? WHERE key = ?",
+                (status, time.time(), json.dumps(outputs), error, key),
+            )
+
+    def jobs(self, status: str = "", kind: str = "") -> List[dict]:
+        """記録されたジョブの一覧.
+
+        Args:
+            status (str, optional): 指定した状態のジョブだけを返す.
+            kind (str, optional): 指定した種類のジョブだけを返す.
+
+        Returns:
+            List[dict]: ジョブごとの辞書
+        """
+        sql = "SELECT * FROM jobs WHERE (? = '' OR status = ?) AND (? = '' OR kind = ?)"
+        with closing(self._connect()) as con:
+            cur = con.execute(sql + " ORDER BY start", (status, status, kind, kind))
+            names = [c[0] for c in cur.description]
+            rows = cur.fetchall()
+        out = [dict(zip(names, r)) for r in rows]
+        for j in out:
+            j["outputs"] = json.loads(j["outputs"])
+        return out
@@ -1,5 +1,52 @@
 import numpy as np
-from typing import List
+from typing import List, Tuple
+
+
+def kpath_points(
+    kmeshx: int, kpath: list, index_ls: List[str] = [], d: int = 0
+) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """kpath を補完したk点の整数座標, 分母, ラベルをまとめて計算する (main と同じ点).
+
+    Args:
+        kmeshx (int): k点数
+        kpath (list): kpath
+        index_ls (List[str], optional): kpathに対応するインデックス. デフォルト値=[].
+        d (int, optional): 分母 (0で区間ごとに自動設定). デフォルト値=0.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, List[str]]: (N, 3) の整数座標, (N,) の分母, ラベル
+    """
+    kpath = np.asarray(kpath, dtype=float)
+    seg = np.linalg.norm(kpath[:-1] - kpath[1:], axis=1)
+    kplen = np.cumsum(seg)
+    ind = np.concatenate([[0], np.rint(kplen / kplen[-1] * (kmeshx - 1)).astype(int)])
+
+    kint = []
+    dnum = []
+    labels = []
+    minwid = 0
+    for kpi in range(len(seg)):
+        kps = kpath[kpi]
+        kpe = kpath[kpi + 1]
+        kpd = np.abs(kps - kpe)
+        if np.any(kpd > 0):  # otherwise the width of the previous segment
+            minwid = kpd[kpd > 0].min()
+        i_s = ind[kpi]
+        i_ee = ind[kpi + 1]
+        i_e = i_ee + 1 if kpi == len(seg) - 1 else i_ee
+
+        dn = int(round(d)) if d > 0 else int(round((i_ee - i_s) / minwid))
+        sc = (np.arange(i_s, i_e) - i_s)[:, None] / (i_ee - i_s)
+        kint.append(np.rint((kps * (1 - sc) + kpe * sc) * dn).astype(np.int64))
+        dnum.append(np.full(i_e - i_s, dn, dtype=np.int64))
+
+        lab = [""] * (i_e - i_s)
+        if len(lab) > 0 and kpi < len(index_ls):
+            lab[0] = index_ls[kpi]
+        if i_e > i_ee and kpi < len(index_ls) - 1:  # end point of the last segment
+            lab[-1] = index_ls[kpi + 1]
+        labels += lab
+    return np.concatenate(kint).reshape(-1, 3), np.concatenate(dnum), labels
 
 
 def main(
@@ -9,116 +56,136 @@ def main(
     index_ls: List[str] = [],
     d: int = 0,
     echo: int = 1,
-) -> None:
-    kplen = []
-
-    for kpi in range(len(kpath) - 1):
-        kps = np.array(kpath[kpi])
-        kpe = np.array(kpath[kpi + 1])
-        if kpi > 0:
-            bef = kplen[kpi - 1]
-        else:
-            bef = 0
-        kplen.append(np.linalg.norm(kps - kpe) + bef)
-
-    ind = kplen / kplen[len(kplen) - 1] * (kmeshx - 1)
-
-    ind = [int(round(i)) for i in ind]
-
-    ind.insert(0, 0)
-
-    out_ls = []
-    tail = "-8.00 8.00"
+) -> np.ndarray:
+    """kpath を補完した.klist_bandファイルを作る.
+
+    Args:
+        output_name (str): 出力ファイルのフルパス
+        kmeshx (int): k点数
+        kpath (list): kpath
+        index_ls (List[str], optional): kpathに対応するインデックス. デフォルト値=[].
+        d (int, optional): 分母 (0で自動設定). デフォルト値=0.
+        echo (int, optional): ログの出力フラグ. デフォルト値=1.
+
+    Returns:
+        np.ndarray: (N, 3) のk点座標 (整数座標 / 分母)
+    """
+    kint, dnum, labels = kpath_points(kmeshx, kpath, index_ls, d)
 
     if echo == 1:
+        kplen = np.cumsum(np.linalg.norm(np.diff(np.asarray(kpath), axis=0), axis=1))
+        ind = [0] + [int(round(i)) for i in kplen / kplen[-1] * (kmeshx - 1)]
         print("OUTPUT ----> " + output_name)
         print("Index  Label  k-vector")
-
-    for kpi in range(len(kplen)):
-        kps = np.array(kpath[kpi])
-        kpe = np.array(kpath[kpi + 1])
-        kpd = abs(kps - kpe)
-        kpd = [i for i in kpd.tolist() if i > 0]
-        if len(kpd) > 0:
-            minwid = min(kpd)
-        i_s = ind[kpi]
-        i_ee = ind[kpi + 1]
-        if echo == 1:
-            if kpi < len(index_ls):
-                head = index_ls[kpi]
-            else:
-                head = ""
-            print("{:<7}".format(i_s) + "{:7}".format(head) + str(kps))
-        if kpi == len(kplen) - 1:
-            i_e = i_ee + 1
-            if echo == 1:
-                if kpi < len(index_ls) - 1:
-                    head = index_ls[kpi + 1]
-                else:
-                    head = ""
-                print("{:<7}".format(i_ee) + "{:7}".format(head) + str(kpe))
-        else:
-            i_e = i_ee
-
-        if d > 0:
-            dnum = int(round(d))
-        else:
-            dnum = int(round((i_ee - i_s) / minwid))
-
-        if kpi < len(index_ls):
-            head = index_ls[kpi]
-        for i in range(i_s, i_e):
-            if i == i_ee and kpi < len(index_ls) - 1:
-                head = index_ls[kpi + 1]
-            sc = (i - i_s) / (i_ee - i_s)
-            kx = int(round((kps[0] * (1 - sc) + kpe[0] * sc) * dnum))
-            ky = int(round((kps[1] * (1 - sc) + kpe[1] * sc) * dnum))
-            kz = int(round((kps[2] * (1 - sc) + kpe[2] * sc) * dnum))
-            line = [
-                "{:10}".format(head),
-                "{:5}".format(kx),
-                "{:5}".format(ky),
-                "{:5}".format(kz),
-                "{:5}".format(dnum),
-                "  2.0",
-                tail,
-            ]
-            head = ""
-            tail = ""
-            out_ls.append(line)
-    with open(output_name, "w") as f:
-        for lines in out_ls:
-            print("".join(lines), file=f)
-        print("END", file=f)
-
-
-def sonomama(output_name: str, kpath: List[List[float]], d: int, echo: int = 0) -> None:
-    out_ls = []
-    tail = "-8.00 8.00"
-
+        for kpi in range(len(kpath)):
+            head = index_ls[kpi] if kpi < len(index_ls) else ""
+            print(
+                "{:<7}".format(ind[kpi])
+                + "{:7}".format(head)
+                + str(np.array(kpath[kpi]))
+            )
+
+    write_klist(output_name, kint, dnum, labels)
+    return kint / dnum[:, None]
+
+
+def main_many(
+    output_names: List[str], kmeshx: int, kpaths: List[list], d: int = 0
+) -> List[np.ndarray]:
+    """複数の kpath について main を実行する. ログは出力しない.
+
+    全てのkpathが2点で同じ区間長の場合 (mapall の平行なラインなど), 整数座標を一度にまとめて計算する.
+
+    Args:
+        output_names (List[str]): 出力ファイルのフルパスのリスト
+        kmeshx (int): k点数
+        kpaths (List[list]): kpath のリスト
+        d (int, optional): 分母 (0で自動設定). デフォルト値=0.
+
+    Returns:
+        List[np.ndarray]: 各ファイルの (N, 3) のk点座標
+    """
+    kp = np.asarray(kpaths, dtype=float)
+    if kp.ndim != 3 or kp.shape[1] != 2 or len(kpaths) == 0:
+        return [main(o, kmeshx, p, [], d, 0) for o, p in zip(output_names, kpaths)]
+    kpd = np.abs(kp[:, 1] - kp[:, 0])
+    if not np.all(kpd == kpd[0]) or not np.any(kpd[0] > 0):
+        return [main(o, kmeshx, p, [], d, 0) for o, p in zip(output_names, kpaths)]
+
+    # same (kmeshx, denominator) for all lines, only the end points differ
+    dn = int(round(d)) if d > 0 else int(round((kmeshx - 1) / kpd[0][kpd[0] > 0].min()))
+    sc = (np.arange(kmeshx) / (kmeshx - 1))[None, :, None]
+    kint = np.rint((kp[:, :1] * (1 - sc) + kp[:, 1:] * sc) * dn).astype(np.int64)
+    for o, k in zip(output_names, kint):
+        write_klist(o, k, dn)
+    return list(kint / dn)
+
+
+def sonomama(
+    output_name: str, kpath: List[List[float]], d: int, echo: int = 0
+) -> np.ndarray:
+    """k点を補完せずにそのまま.klist_bandファイルに書き込む.
+
+    Args:
+        output_name (str): 出力ファイルのフルパス
+        kpath (List[List[float]]): k点座標のリスト
+        d (int): 分母
+        echo (int, optional): ログの出力フラグ. デフォルト値=0.
+
+    Returns:
+        np.ndarray: (N, 3) のk点座標 (整数座標 / 分母)
+    """
     if echo == 1:
         print("OUTPUT ----> " + output_name)
 
-    for kpi in range(len(kpath)):
-        kx = int(round(kpath[kpi][0] * d))
-        ky = int(round(kpath[kpi][1] * d))
-        kz = int(round(kpath[kpi][2] * d))
-        line = [
-            "{:10}".format(""),
-            "{:5}".format(kx),
-            "{:5}".format(ky),
-            "{:5}".format(kz),
-            "{:5}".format(d),
-            "  2.0",
-            tail,
-        ]
-        head = ""
-        tail = ""
-        out_ls.append(line)
+    kint = np.rint(np.asarray(kpath, dtype=float).reshape(-1, 3) * d).astype(np.int64)
+    write_klist(output_name, kint, d)
+    return kint / d
+
+
+def write_klist(
+    output_name: str, kint: np.ndarray, d, labels: List[str] = None
+) -> None:
+    """整数のk点座標をまとめて.klist_bandファイルに書き込む.
+
+    Args:
+        output_name (str): 出力ファイルのフルパス
+        kint (np.ndarray): (N, 3) の整数k点座標
+        d: 分母. 整数または (N,) の配列.
+        labels (List[str], optional): 各k点のラベル. 指定しない場合は空白.
+    """
+    kint = np.asarray(kint, dtype=np.int64).reshape(-1, 3)
+    d = np.broadcast_to(np.asarray(d, dtype=np.int64), (kint.shape[0],))
+    if labels is None:
+        labels = [""] * kint.shape[0]
+    rows = np.column_stack([kint, d]).tolist()
+    lines = ["%-10s%5d%5d%5d%5d  2.0" % (l, *r) for l, r in zip(labels, rows)]
+    if len(lines) > 0:
+        lines[0] += "-8.00 8.00"
+    lines.append("END")
     with open(output_name, "w") as f:
-        for lines in out_ls:
-            print("".join(lines), file=f)
-        print("END", file=f)
+        f.write("\n".join(lines) + "\n")
+
+
+def klist_points(path: str) -> np.ndarray:
+    """.klist_bandファイルのk点座標を読み込む.
+
+    Args:
+        path (str): .klist_bandファイルのパス
+
+    Returns:
+        np.ndarray: (N, 3) のk点座標 (整数座標 / 分母)
+    """
+    rows = []
+    with open(path, "r") as f:
+        for line in f:  # format (A10,4I5,F5.1)
+            if line.startswith("END"):
+                break
+            rows.append(
+                [int(line[10:15]), int(line[15:20]), int(line[20:25]), int(line[25:30])]
+            )
+    ar = np.array(rows, dtype=float).reshape(-1, 4)
+    return ar[:, :3] / ar[:, 3:]
 
 
 def fcc_temp(name: str, n: int) -> None:
@@ -3,7 +3,6 @@ import analyze_w2k as an
 import make_klist_band as kb
 import subprocess as sp
 from igorwriter import IgorWave as iw
-import datetime as dt  # optional
 
 
 def run():
@@ -15,24 +14,21 @@ def run():
     w2k.set_ef_insp()
 
     outputdpath = w2k.case_path + "kxkymap/"
-    sp.run(["mkdir", "-p", outputdpath])
+    sp.run(["mkdir", "-p", outputdpath + "klist/"])
 
     kxn = 101
     kyn = 101
 
-    tst = dt.datetime.now()  # optional
-
+    lines = []
+    kpaths = []
     for ky in range(kyn):
-        kb.main(
-            w2k.filepath(".klist_band"),
-            kxn,
-            [[0, ky / (kyn - 1), 0], [1, ky / (kyn - 1), 0]],
-            [],
-        )
         name = "ky_" + str(ky)
-        w2k.run_band(outputdpath, name)
-        tn = dt.datetime.now()  # optional
-        print("FINISH : " + str(tst + (tn - tst) / (ky + 1) * kyn))  # optional
+        kpaths.append([[0, ky / (kyn - 1), 0], [1, ky / (kyn - 1), 0]])
+        lines.append([name, outputdpath + "klist/" + name + ".klist_band"])
+    kb.main_many([l[1] for l in lines], kxn, kpaths)
+
+    # many ky lines per lapw1 / spaghetti run, split back into ky_<n> files
+    w2k.run_band_batch(outputdpath, lines, max_k=2000)
 
 
 def anal():
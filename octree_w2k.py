@@ -0,0 +1,198 @@
+import numpy as np
+import os
+from typing import Callable, Tuple
+
+# directory path string must finish with "/"
+
+
+class Octree:
+    def __init__(
+        self,
+        path: str,
+        n: int = 100,
+        depth: int = 6,
+        cutoff: float = 0.001,
+        lipschitz: float = 10.0,
+    ) -> None:
+        """縮退点の周りだけを細かくする適応的な八分木探索. 状態は path に保存され, 途中から再開できる.
+
+        k点は最小セルの整数座標で表す. 粗い格子の1間隔 (1/n) が 2^depth 個の最小セルになり,
+        k = 整数座標 / (n * 2^depth) となる.
+        セルの8頂点のギャップの最小値から lipschitz * (セルの対角線の半分) を引いた値を
+        セル内のギャップの下限とし, これが cutoff 未満のセルだけを8分割する.
+
+        Args:
+            path (str): 状態を保存するディレクトリ
+            n (int, optional): 粗い格子の分割数. デフォルト値=100.
+            depth (int, optional): 分割の最大回数. デフォルト値=6.
+            cutoff (float, optional): 縮退判定のエネルギー差. デフォルト値=0.001.
+            lipschitz (float, optional): ギャップの傾きの上限 (エネルギー / 逆格子の単位). デフォルト値=10.0.
+        """
+        self.path = path
+        self.n = n
+        self.depth = depth
+        self.cutoff = cutoff
+        self.lipschitz = lipschitz
+        self.d = n * 2**depth
+        if self.d > 99999:  # denominator of .klist_band is I5
+            raise ValueError("n * 2**depth must be less than 100000")
+
+        self.queue = np.zeros((0, 4), dtype=np.int64)  # [level, x, y, z] of cells
+        self.keys = np.zeros(0, dtype=np.int64)  # sorted keys of evaluated corners
+        self.e = np.zeros(0)
+        self.g = np.zeros(0)
+        self.rounds = 0
+
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(self.path + "octree.npz"):
+            self.load()
+
+    def load(self) -> None:
+        """保存された状態を読み込む."""
+        with np.load(self.path + "octree.npz") as z:
+            if int(z["d"]) != self.d:
+                raise ValueError("octree state in " + self.path + " has other n/depth")
+            self.queue = z["queue"]
+            self.keys = z["keys"]
+            self.e = z["e"]
+            self.g = z["g"]
+            self.rounds = int(z["rounds"])
+
+    def save(self) -> None:
+        """状態を保存する."""
+        tmp = self.path + "octree.tmp.npz"
+        np.savez(
+            tmp,
+            d=self.d,
+            queue=self.queue,
+            keys=self.keys,
+            e=self.e,
+            g=self.g,
+            rounds=self.rounds,
+        )
+        os.replace(tmp, self.path + "octree.npz")
+
+    def seed(self, points: np.ndarray) -> None:
+        """粗い格子の点 (整数座標) を頂点にもつ8個のセルを探索の初期セルにする.
+
+        Args:
+            points (np.ndarray): (N, 3) の粗い格子の整数座標. get_NL_list の出力など.
+        """
+        s = 2**self.depth
+        p = np.asarray(points, dtype=np.int64).reshape(-1, 3) * s
+        off = np.array(np.meshgrid([-s, 0], [-s, 0], [-s, 0])).reshape(3, -1).T
+        org = (p[:, None, :] + off[None, :, :]).reshape(-1, 3)
+        cells = np.column_stack([np.zeros(org.shape[0], dtype=np.int64), org])
+        self.queue = np.unique(np.concatenate([self.queue, cells]), axis=0)
+        self.save()
+
+    def key(self, kint: np.ndarray) -> np.ndarray:
+        """最小セルの整数座標をint64の鍵にする."""
+        m = self.d + 3 * 2**self.depth  # one coarse spacing of margin on each side
+        q = kint + 2**self.depth
+        return (q[..., 0] * m + q[..., 1]) * m + q[..., 2]
+
+    def corners(self, cells: np.ndarray) -> np.ndarray:
+        """セルの8頂点の整数座標 (N, 8, 3)."""
+        size = 2 ** (self.depth - cells[:, 0])
+        off = np.array(np.meshgrid([0, 1], [0, 1], [0, 1])).reshape(3, -1).T
+        return cells[:, None, 1:] + off[None, :, :] * size[:, None, None]
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """鍵に対応するキャッシュのindex. 未計算の場合は -1."""
+        if self.keys.shape[0] == 0:
+            return np.full(keys.shape, -1)
+        ind = np.minimum(np.searchsorted(self.keys, keys), self.keys.shape[0] - 1)
+        return np.where(self.keys[ind] == keys, ind, -1)
+
+    def evaluate(
+        self,
+        evaluator: Callable[[np.ndarray, int], Tuple[np.ndarray, np.ndarray]],
+        kint: np.ndarray,
+        max_k: int = 2000,
+    ) -> None:
+        """未計算の点を max_k 点ずつ evaluator で計算し, キャッシュに加える.
+
+        Args:
+            evaluator: (整数座標 (N, 3), 分母) を受け取り, (平均エネルギー (N,), ギャップ (N,)) を返す関数
+            kint (np.ndarray): (N, 3) の整数座標
+            max_k (int, optional): 1回に計算する点数. デフォルト値=2000.
+        """
+        keys, ind = np.unique(self.key(kint), return_index=True)
+        new = self.lookup(keys) < 0
+        kint = kint[ind[new]]
+        for s in range(0, kint.shape[0], max_k):
+            e, g = evaluator(kint[s : s + max_k], self.d)
+            self.keys = np.concatenate([self.keys, self.key(kint[s : s + max_k])])
+            self.e = np.concatenate([self.e, e])
+            self.g = np.concatenate([self.g, g])
+            order = np.argsort(self.keys, kind="stable")
+            self.keys = self.keys[order]
+            self.e = self.e[order]
+            self.g = self.g[order]
+            self.save()  # evaluated points survive an interrupted round
+            print(
+                "points : "
+                + str(min(s + max_k, kint.shape[0]))
+                + " / "
+                + str(kint.shape[0])
+            )
+
+    def step(self, evaluator, max_k: int = 2000) -> int:
+        """キューのセルを全て処理し, 分割したセルを次のキューにする.
+
+        Returns:
+            int: 次のキューのセル数
+        """
+        cells = self.queue
+        cor = self.corners(cells)
+        self.evaluate(evaluator, cor.reshape(-1, 3), max_k)
+
+        gmin = self.g[self.lookup(self.key(cor))].min(axis=1)
+        size = 2.0 ** (self.depth - cells[:, 0]) / self.d
+        bound = gmin - self.lipschitz * size * np.sqrt(3) / 2
+        split = (bound < self.cutoff) & (cells[:, 0] < self.depth)
+
+        cells = cells[split]
+        half = 2 ** (self.depth - cells[:, 0] - 1)
+        off = np.array(np.meshgrid([0, 1], [0, 1], [0, 1])).reshape(3, -1).T
+        org = cells[:, None, 1:] + off[None, :, :] * half[:, None, None]
+        lev = np.repeat(cells[:, 0] + 1, 8)
+        self.queue = np.column_stack([lev, org.reshape(-1, 3)])
+        self.rounds += 1
+        self.save()
+        return self.queue.shape[0]
+
+    def run(self, evaluator, max_k: int = 2000) -> None:
+        """キューが空になるまで分割を繰り返す. 中断しても同じ path で再開できる.
+
+        Args:
+            evaluator: evaluate と同じ.
+            max_k (int, optional): 1回に計算する点数. デフォルト値=2000.
+        """
+        while self.queue.shape[0] > 0:
+            lev = self.queue[:, 0].max()
+            print(
+                "round "
+                + str(self.rounds)
+                + " : level "
+                + str(lev)
+                + ", cells "
+                + str(self.queue.shape[0])
+            )
+            self.step(evaluator, max_k)
+
+    def hits(self, evaluated: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ギャップが cutoff 未満の計算済みの点.
+
+        Args:
+            evaluated (int, optional): 1の場合, 計算済みの全ての点を返す. デフォルト値=0.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: k点 (N, 3) (逆格子の基底), 平均エネルギー, ギャップ
+        """
+        m = self.d + 3 * 2**self.depth
+        q = np.stack([self.keys // (m * m), self.keys // m % m, self.keys % m], -1)
+        k = (q - 2**self.depth) / self.d
+        sel = np.ones(k.shape[0], bool) if evaluated else self.g < self.cutoff
+        return k[sel], self.e[sel], self.g[sel]
@@ -0,0 +1,122 @@
+import numpy as np
+import re
+from typing import List, Tuple
+
+# directory path string must finish with "/"
+
+
+def load_qtl(path: str) -> Tuple[np.ndarray, np.ndarray, float]:
+    """lapw2 -band -qtl の出力 case.qtl (case.qtlup, case.qtldn) を全て読み込む.
+
+    データ行は (エネルギー, jatom, tot, s, p, ...) で, k点ごとに全てのatom (最後は格子間) が並ぶ.
+    同じjatomの行は列数が同じなので, atomごとにまとめて数値に変換する.
+
+    Args:
+        path (str): .qtlファイルのパス
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, float]: エネルギー (band, k) (Ry),
+        重み (band, k, atom, orb) (orb=0 が tot, 列の無い軌道はNaN), Fermi Energy (Ry)
+    """
+    with open(path, "r") as f:
+        lines = f.read().splitlines()
+
+    ef = np.nan
+    start = len(lines)
+    for i, l in enumerate(lines):
+        if "FERMI ENERGY=" in l:
+            ef = float(l.split("FERMI ENERGY=")[1].split()[0])
+        if "BAND:" in l:
+            start = i
+            break
+
+    nband = 0
+    data = []
+    for l in lines[start:]:
+        if "BAND:" in l:
+            nband += 1
+        elif l.strip():
+            data.append(l)
+    if nband == 0:
+        return np.array([]), np.array([]), ef
+
+    na = 1  # atoms per k point, jatom counts up within one k point
+    while na < len(data) and int(data[na].split()[1]) > int(data[na - 1].split()[1]):
+        na += 1
+    nk = len(data) // (nband * na)
+    if nk * nband * na != len(data):
+        raise ValueError("wrong number of lines in " + path)
+
+    ncol = [len(data[a].split()) - 2 for a in range(na)]
+    qtl = np.full((nband, nk, na, max(ncol)), np.nan)
+    ene = None
+    for a in range(na):
+        v = np.array(" ".join(data[a::na]).split(), dtype=float)
+        v = v.reshape(nband, nk, ncol[a] + 2)
+        qtl[:, :, a, : ncol[a]] = v[:, :, 2:]
+        if ene is None:
+            ene = v[:, :, 0]
+    return ene, qtl, ef
+
+
+_BANDINDEX = re.compile(r"bandindex:\s*(\d+)")
+
+
+def write_weighted_agr(
+    agrpath: str, qtl: np.ndarray, qtl_ls: List[List[int]], out_ls: List[str]
+) -> None:
+    """重み付けなしの.agrファイルの重みの列を case.qtl の値に置き換えた.agrファイルを書く.
+
+    横軸とエネルギーは.agrファイルのものをそのまま使い, "# bandindex:" の番号で
+    case.qtl のバンドと対応させる. 重みは qtl の値そのもので, .insp の size は掛けない.
+
+    Args:
+        agrpath (str): spaghettiの.agrファイル (jatom=0 で出力したもの)
+        qtl (np.ndarray): load_qtl の重み (band, k, atom, orb)
+        qtl_ls (List[List[int]]): .insp と同じ [jatom, jcol] のリスト (1始まり, jcol=1 が tot)
+        out_ls (List[str]): qtl_ls に対応する出力ファイルのパス
+
+    Raises:
+        ValueError: qtl_ls の原子や列, .agrファイルのバンドやk点が qtl に無い場合
+    """
+    nband, nk, na, ncol = qtl.shape
+    for atom, jcol in qtl_ls:
+        if not (1 <= atom <= na and jcol <= ncol):
+            raise ValueError(
+                "[jatom, jcol] = [%d, %d] not in qtl with %d atoms and %d columns"
+                % (atom, jcol, na, ncol)
+            )
+    with open(agrpath, "r") as f:
+        lines = f.read().splitlines()
+
+    w = np.nan_to_num(qtl)
+    outs = [[] for _ in out_ls]
+    ba = 1  # counted by "&" unless "# bandindex:" gives the number
+    k = 0
+    for line in lines:
+        s = line.lstrip()
+        if s.startswith("#") or s.startswith("@") or s.startswith("&") or not s:
+            m = _BANDINDEX.search(s)
+            if m:
+                ba = int(m.group(1))
+            elif s.startswith("&"):
+                ba += 1
+                k = 0
+            for o in outs:
+                o.append(line)
+            continue
+        if not (1 <= ba <= nband and k < nk):
+            raise ValueError(
+                "band %d, k point %d of %s not in qtl with %d bands and %d k points"
+                % (ba, k + 1, agrpath, nband, nk)
+            )
+        ls = s.split()
+        x, e = float(ls[0]), float(ls[1])
+        for o, (atom, jcol) in zip(outs, qtl_ls):
+            col = jcol - 1 if jcol > 0 else 0  # jcol=0 (default of run_band) is tot
+            o.append("  %10.5f  %10.5f  %10.5f" % (x, e, w[ba - 1, k, atom - 1, col]))
+        k += 1
+
+    for path, o in zip(out_ls, outs):
+        with open(path, "w") as f:
+            f.write("\n".join(o) + "\n")
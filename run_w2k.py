@@ -1,11 +1,185 @@
 import subprocess
 import numpy as np
 import os
-from typing import List
+import datetime
+import shutil
+import time
+import copy
+import re
+from typing import Callable, Dict, List
+import ledger_w2k
+import telemetry_w2k
+import scf_w2k
+import qtl_w2k
+import energy_w2k
 
 # directory path string must finish with "/"
 
 
+def read_klist(path: str) -> List[str]:
+    """.klist_bandファイルのk点の行 (ENDより前) を読み込む.
+
+    Args:
+        path (str): .klist_bandファイルのパス
+
+    Returns:
+        List[str]: k点ごとの行
+    """
+    out = []
+    with open(path, "r") as f:
+        for l in f:
+            if l.startswith("END"):
+                break
+            out.append(l.rstrip("\n"))
+    return out
+
+
+def split_agr(src: str, dst_ls: List[str], counts: List[int]) -> bool:
+    """連結したk点で計算した.agrファイルを, k点数ごとに複数の.agrファイルに分割する.
+
+    各出力の横軸 (k点距離) はそれぞれの先頭が0になるようにずらす.
+
+    Args:
+        src (str): 分割する.agrファイル
+        dst_ls (List[str]): 出力ファイルのリスト
+        counts (List[int]): 各出力のk点数
+
+    Returns:
+        bool: 分割できた場合True. k点数が合わない場合は何も書かずFalse.
+    """
+    with open(src, "r") as f:
+        lines = f.read().splitlines()
+
+    owner = np.repeat(np.arange(len(counts)), counts)
+    outs = [[] for _ in dst_ls]
+    x0 = [None for _ in dst_ls]
+    i = 0  # index of data line in the current band
+    for line in lines:
+        s = line.lstrip()
+        if s.startswith("@") or s.startswith("#") or len(s) == 0:
+            for o in outs:
+                o.append(line)
+        elif s.startswith("&"):
+            if i != len(owner):
+                print("ERROR: " + src + " has " + str(i) + " k points")
+                return False
+            for o in outs:
+                o.append(line)
+            i = 0
+        else:
+            if i >= len(owner):
+                print("ERROR: " + src + " has too many k points")
+                return False
+            j = owner[i]
+            ls = s.split()
+            if x0[j] is None:
+                x0[j] = float(ls[0])
+            outs[j].append(
+                "  "
+                + "{:10.5f}".format(float(ls[0]) - x0[j])
+                + "  "
+                + "  ".join(ls[1:])
+            )
+            i += 1
+
+    for dst, o in zip(dst_ls, outs):
+        with open(dst, "w") as f:
+            f.write("\n".join(o) + "\n")
+    return True
+
+
+class InputFile:
+    def __init__(self, path: str) -> None:
+        """WIEN2kの入力ファイル (.in1, .in2, .insp, .klist_band など) を行のリストとして保持する.
+
+        最初に使うときに1度だけ読み込み, 変更はメモリ上で行う. flush で変更があった場合だけ
+        一時ファイルに書いてから置き換える. 変更が無いときにファイルが外部で書き換えられた場合は
+        次に使うときに読み直す. 変更した後に外部で書き換えられた場合 (cp で klist をコピーした
+        場合など) は, 外部の内容を優先してメモリ上の変更を捨てる.
+
+        Args:
+            path (str): ファイルのパス
+        """
+        self.path = path
+        self.dirty = False
+        self.__lines = None
+        self.__stamp = None
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    @property
+    def lines(self) -> List[str]:
+        """改行を除いた行のリスト. 直接変更した場合は dirty を True にする."""
+        if not self.dirty and (self.__lines is None or self._stamp() != self.__stamp):
+            with open(self.path, "r") as f:
+                self.__lines = f.read().splitlines()
+            self.__stamp = self._stamp()
+        return self.__lines
+
+    def set_lines(self, lines: List[str]) -> None:
+        """全ての行を置き換える."""
+        self.__lines = list(lines)
+        self.__stamp = self._stamp()  # the file this replaces
+        self.dirty = True
+
+    def set_token(self, key: str, index: int, value) -> int:
+        """key を含む行の index 番目の単語を value にする. 他の単語の位置は変えない.
+
+        Args:
+            key (str): 行を探す文字列
+            index (int): 空白で区切った単語の番号
+            value: 設定値
+
+        Returns:
+            int: 見つかった行数
+        """
+        n = 0
+        lines = self.lines
+        for i, l in enumerate(lines):
+            if key in l:
+                a, b = [m.span() for m in re.finditer(r"\S+", l)][index]
+                new = l[:a] + str(value) + l[b:]
+                if new != l:
+                    lines[i] = new
+                    self.dirty = True
+                n += 1
+        return n
+
+    def replace(self, old: str, new: str) -> None:
+        """全ての行の文字列 old を new にする."""
+        lines = self.lines
+        for i, l in enumerate(lines):
+            if old in l:
+                lines[i] = l.replace(old, new)
+                self.dirty = True
+
+    def flush(self) -> None:
+        """変更があればファイルに書き込む (一時ファイルを書いてから置き換える).
+
+        変更した後にファイルが外部で書き換えられていた場合は書き込まず, 変更を捨てる.
+        """
+        if not self.dirty:
+            return
+        if self._stamp() != self.__stamp:
+            print(
+                "WARNING : " + self.path + " was changed on disk, edits are discarded"
+            )
+            self.__lines = None
+            self.dirty = False
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(self.__lines) + "\n")
+        os.replace(tmp, self.path)
+        self.__stamp = self._stamp()
+        self.dirty = False
+
+
 class W2k:
     def __init__(self, case_g: str) -> None:
         """sessionに対応するインスタンス生成.
@@ -25,6 +199,12 @@ class W2k:
         self.spol = 1  # spin polarized calculation on: 1, off: 0
         self.spin_ls = ["up", "dn"]
         self.parallel = 1  # parallel on: >1, off: 1
+        self.omp = None  # OMP_NUM_THREADS of each WIEN2k process, inherited if None
+        self.scratch = None  # SCRATCH directory, the session folder if None
+        self.machines = None  # write_machines arguments, rewritten before each band run
+        self.ledger = None  # ledger_w2k.Ledger, completed runs are recorded and skipped
+        self.telemetry = None  # telemetry_w2k.Telemetry, every step is recorded
+        self.inputs = {}  # extension: InputFile, written before each WIEN2k step
 
         self.rkmax = 7
         self.__lmax = 10
@@ -42,18 +222,192 @@ class W2k:
             p (int): 並列数.
         """
         self.parallel = p
-        machinespath = self.case_path + ".machines"
 
         if p > 1:
-            subprocess.call(["cp", self.temp_path + ".machines", machinespath])
-            if p > 2:
-                with open(machinespath, "r") as f:
-                    ms = f.read()
+            omp = self.omp  # omp_global:1 in .machines, OMP_NUM_THREADS is kept
+            self.write_machines(hosts={"localhost": p}, omp=1)
+            self.omp = omp
+
+    def write_machines(
+        self,
+        cores: int = 0,
+        hosts: Dict[str, int] = None,
+        omp: int = 0,
+        weights: Dict[str, int] = None,
+        mpi: int = 1,
+        granularity: int = 1,
+        extrafine: int = 1,
+        nk: int = 0,
+    ) -> None:
+        """資源の指定から.machinesファイルを作り, parallel と omp を設定する.
+
+        omp=0 の場合, k点数がジョブ数より少なければ余ったコアをOpenMPスレッドに回す.
 
-                ms = ms.replace("1:localhost\n" * 2, "1:localhost\n" * p)
+        Args:
+            cores (int, optional): hostsを指定しない場合のlocalhostのコア数. 0でos.cpu_count().
+            hosts (Dict[str, int], optional): {ホスト名: コア数}.
+            omp (int, optional): 1ジョブあたりのスレッド数. 0で自動. デフォルト値=0.
+            weights (Dict[str, int], optional): {ホスト名: 重み}. デフォルトは全て1.
+            mpi (int, optional): 1ジョブあたりのMPIプロセス数. デフォルト値=1.
+            granularity (int, optional): granularity. デフォルト値=1.
+            extrafine (int, optional): 1でextrafineを有効にする. デフォルト値=1.
+            nk (int, optional): k点数. 0の場合は現在の.klist_bandから数える.
+        """
+        if hosts is None:
+            hosts = {"localhost": cores if cores > 0 else os.cpu_count()}
+        if weights is None:
+            weights = {}
+
+        if omp <= 0:
+            if nk <= 0:
+                nk = self.count_k(".klist_band")
+            slots = sum(c // mpi for c in hosts.values())
+            if nk <= 0 or nk >= slots:
+                omp = 1
+            else:  # fewer k points than cores: k parallel over nk jobs, rest OpenMP
+                omp = max(1, slots // nk)
+
+        ms = []
+        for host, c in hosts.items():
+            for _ in range(max(1, c // (mpi * omp))):
+                line = str(weights.get(host, 1)) + ":" + host
+                if mpi > 1:
+                    line += ":" + str(mpi)
+                ms.append(line)
+        njob = len(ms)
+        if mpi > 1:
+            host = list(hosts)[0]
+            ms.insert(0, "lapw0:" + host + ":" + str(hosts[host]))
+        ms.append("granularity:" + str(granularity))
+        if extrafine:
+            ms.append("extrafine:1")
+        ms.append("omp_global:" + str(omp))
+        ms.append("omp_lapw1:" + str(omp))
+
+        with open(self.case_path + ".machines", "w") as f:
+            f.write("\n".join(ms) + "\n")
+
+        self.parallel = njob
+        self.omp = omp
+
+    def env(self) -> dict:
+        """WIEN2kのプロセスに渡す環境変数.
+
+        SCRATCH は常に設定する (scratch が None の場合は sessionフォルダ). シェルの $SCRATCH は
+        引き継がないので, 同時に動く別のインスタンスと case.vector を共有しない.
+        OMP_NUM_THREADS は omp が設定されている場合だけ上書きし, それ以外はシェルの設定を引き継ぐ.
 
-                with open(machinespath, "w") as f:
-                    f.write(ms)
+        Returns:
+            dict: os.environ に SCRATCH と OMP_NUM_THREADS を設定したもの
+        """
+        env = dict(os.environ)
+        env["SCRATCH"] = self.scratch if self.scratch else self.case_path
+        if self.omp is not None:
+            env["OMP_NUM_THREADS"] = str(self.omp)
+        return env
+
+    def _run(
+        self, cmd: List[str], note: str = "", check: int = 0, band: int = 0
+    ) -> subprocess.CompletedProcess:
+        """case_path を作業ディレクトリとしてコマンドを実行する. os.chdir はしない.
+
+        telemetry が設定されていれば, 経過時間, CPU時間, 終了コード, 最大メモリ, k点数を記録する.
+        終了コードが0でない場合は警告をprintする. check=1 の場合は RuntimeError を投げる.
+        band=1 はバンド計算の一部で, k点数を .klist_band から数える.
+        """
+        self.flush_inputs()
+        print("run " + " ".join(cmd) + note)
+        env = self.env()
+        if self.telemetry is None:
+            res = subprocess.run(cmd, cwd=self.case_path, env=env)
+        else:
+            res, rec = telemetry_w2k.timed_run(cmd, cwd=self.case_path, env=env)
+            step = cmd[1] if cmd[0] == "x_lapw" and len(cmd) > 1 else cmd[0]
+            rec.update(step=step, cmd=" ".join(cmd) + note, case=self.case_path)
+            rec["nk"] = self._nk(cmd, band)
+            rec["parallel"] = self.parallel
+            rec["omp"] = env.get("OMP_NUM_THREADS", "")
+            self.telemetry.record(rec)
+        if res.returncode != 0:
+            msg = " ".join(cmd) + " returned " + str(res.returncode)
+            if check:
+                raise RuntimeError(msg)
+            print("WARNING : " + msg)
+        return res
+
+    def _nk(self, cmd: List[str], band: int) -> int:
+        if cmd[0] != "x_lapw":
+            return 0
+        return self.count_k(".klist_band" if band else ".klist")
+
+    def input(self, ext: str) -> InputFile:
+        """sessionの入力ファイルのモデル. 同じ拡張子には同じインスタンスを返す.
+
+        Args:
+            ext (str): 拡張子
+
+        Returns:
+            InputFile: 入力ファイル
+        """
+        if not ext.startswith("."):
+            ext = f".{ext}"
+        if ext not in self.inputs:
+            self.inputs[ext] = InputFile(self.filepath(ext))
+        return self.inputs[ext]
+
+    def flush_inputs(self) -> None:
+        """変更された入力ファイルを全て書き込む."""
+        for f in self.inputs.values():
+            f.flush()
+
+    def count_k(self, ext: str = ".klist_band") -> int:
+        """k点リストのk点数 (ENDより前の行数). ファイルが無い場合は0."""
+        f = self.input(ext)
+        if not f.dirty and not os.path.exists(f.path):
+            return 0
+        for i, l in enumerate(f.lines):
+            if l.startswith("END"):
+                return i
+        return len(f.lines)
+
+    def _digest(self, files: List[str], params: dict, scf: int = 1) -> str:
+        self.flush_inputs()
+        params = dict(params, so=self.so, orb=self.orb, spol=self.spol)
+        params["spin_ls"] = list(self.spin_ls)
+        stamps = [self.filepath(".scf")] if scf else []  # results depend on the SCF
+        return ledger_w2k.digest(files, params, stamps)
+
+    def _ledgered(
+        self,
+        kind: str,
+        key: str,
+        inputs: Callable[[], str],
+        run: Callable[[], List[str]],
+    ) -> None:
+        """ledger が設定されていれば, 完了済みのジョブを飛ばし, 実行結果を記録する.
+
+        Args:
+            kind (str): ジョブの種類
+            key (str): ジョブ名
+            inputs (Callable[[], str]): 入力のハッシュを返す関数
+            run (Callable[[], List[str]]): ジョブを実行し, 出力ファイルのリストを返す関数
+        """
+        if self.ledger is None:
+            run()
+            return
+
+        inputs = inputs()
+        if self.ledger.done(key, inputs):
+            print("skip " + kind + " " + key + " (done)")
+            return
+        self.ledger.start(key, kind, inputs)
+        try:
+            outputs = run()
+        except BaseException as e:
+            self.ledger.finish(key, [], "failed", repr(e))
+            raise
+        ok = len(outputs) > 0 and all(os.path.exists(p) for p in outputs)
+        self.ledger.finish(key, outputs, "done" if ok else "failed")
 
     def print_parameters(self) -> None:
         """インスタンスに設定されているパラメータをprint."""
@@ -68,37 +422,34 @@ class W2k:
         """
         if not ext.startswith("."):
             ext = f".{ext}"
+        self.inputs.pop(ext, None)  # unsaved edits are overwritten by the template
         subprocess.call(
             ["cp", self.temp_path + "case" + ext, self.case_path + self.case + ext]
         )
 
     def get_ef(self) -> float:
-        """.scfファイルからFermi Energyを抜き出す.
+        """.scfファイルからFermi Energyを抜き出す. ファイルの末尾から読む.
 
         Returns:
             float: Fermi Energy (eV)
         """
-        with open(self.filepath(".scf"), "r") as f:
-            l = f.readlines()
-        l0 = [i for i in l if i.startswith(":FER")]
-        l = l0[len(l0) - 1]
-        l0 = l.split()
-        ef = float(l0[len(l0) - 1])
-        return ef
+        return scf_w2k.last_value(self.filepath(".scf"), ":FER")
 
     def get_etot(self) -> float:
-        """.scfファイルからTotal Energyを抜き出す.
+        """.scfファイルからTotal Energyを抜き出す. ファイルの末尾から読む.
 
         Returns:
             float: Total Energy (eV)
         """
-        with open(self.filepath(".scf"), "r") as f:
-            l = f.readlines()
-        l0 = [i for i in l if i.startswith(":ENE")]
-        l = l0[len(l0) - 1]
-        l0 = l.split()
-        etot = float(l0[len(l0) - 1])
-        return etot
+        return scf_w2k.last_value(self.filepath(".scf"), ":ENE")
+
+    def scf_history(self) -> Dict[str, np.ndarray]:
+        """.scfファイルの全ての反復の値 (scf_w2k.load_scf).
+
+        Returns:
+            Dict[str, np.ndarray]: "ENE", "FER", "DIS", "MMTOT" などのラベルと反復ごとの配列
+        """
+        return scf_w2k.load_scf(self.filepath(".scf"))
 
     @property
     def lmax(self) -> float:
@@ -114,22 +465,8 @@ class W2k:
         ToDo:
             * 小数点以下桁数に上限を設けないと, wien2k実行時にエラーが起きるかも？
         """
-        path = self.filepath(".in1")
-        with open(path, "r") as f:
-            s = f.readlines()
-
-        for l in range(len(s)):
-            if "R-MT*K-MAX" in s[l]:
-                out = s[l].split()
-                out[1] = str(val)
-                s[l] = " ".join(out)
-            if not s[l].endswith("\n"):
-                s[l] += "\n"
-
-        s = "".join(s)
-
-        with open(path, "w") as f:
-            f.write(s)
+        self.input(".in1").set_token("R-MT*K-MAX", 1, val)
+        self.input(".in1").flush()
 
         self.__lmax = val
 
@@ -147,28 +484,13 @@ class W2k:
         ToDo:
             * 小数点以下桁数に上限を設けないと, wien2k実行時にエラーが起きるかも？
         """
-        path = self.filepath(".in2")
-        with open(path, "r") as f:
-            s = f.readlines()
-
-        for l in range(len(s)):
-            if "GMAX" in s[l]:
-                out = s[l].split()
-                out[0] = str(val)
-                s[l] = " ".join(out)
-            if not s[l].endswith("\n"):
-                s[l] += "\n"
-
-        s = "".join(s)
-
-        with open(path, "w") as f:
-            f.write(s)
+        self.input(".in2").set_token("GMAX", 0, val)
+        self.input(".in2").flush()
 
         self.__gmax = val
 
     def init_lapw(self) -> None:
         """initializeを実行する."""
-        os.chdir(self.case_path)
         init_run = [
             "init_lapw",
             "-b",
@@ -185,18 +507,57 @@ class W2k:
         if self.spol:
             init_run.insert(2, "-sp")
 
-        print("run " + " ".join(init_run))
-        subprocess.run(init_run)
+        self._run(init_run)
 
     def set_ef_insp(self):  # set ef parameter for x_lapw spaghetti
         self.cp_from_temp(".insp")
-        with open(self.filepath(".insp"), "r") as f:
-            s = f.read()
+        self.input(".insp").replace("0.xxxx", str(self.get_ef()))
+        self.input(".insp").flush()
+
+    def clone(self, dest: str) -> "W2k":
+        """sessionフォルダのファイルを dest/<session名>/ にコピーし, そこを使うインスタンスを返す.
 
-        s = s.replace("0.xxxx", str(self.get_ef()))
+        サブディレクトリはコピーしない. 計算パラメータは元のインスタンスと同じだが, SCRATCH は
+        コピー先のフォルダにする (case.vector などを他のインスタンスと共有しないため).
+
+        Args:
+            dest (str): コピー先のディレクトリ
+
+        Returns:
+            W2k: コピー先を case_path とするインスタンス
+        """
+        self.flush_inputs()
+        path = dest + self.case + "/"
+        os.makedirs(path, exist_ok=True)
+        for f in os.listdir(self.case_path):
+            if os.path.isfile(self.case_path + f):
+                shutil.copy2(self.case_path + f, path + f)
+        w2k = copy.copy(self)
+        w2k.spin_ls = list(self.spin_ls)
+        w2k.case_path = path
+        w2k.scratch = (
+            path  # private case.vector*, concurrent copies must not share them
+        )
+        w2k.inputs = {}  # private input files of the copy
+        return w2k
+
+    def band_outputs(self, outfol: str, name: str, spag: int = 1) -> List[str]:
+        """run_band(outfol, name) が出力する.agrファイルのリスト (重み付けなし).
+
+        Args:
+            outfol (str): 出力フォルダパス
+            name (str): 計算結果ファイル名
+            spag (int, optional): 0の場合は.agrの代わりに.energyファイル. デフォルト値=1.
 
-        with open(self.filepath(".insp"), "w") as f:
-            f.write(s)
+        Returns:
+            List[str]: .agrファイルのフルパスのリスト
+        """
+        if not os.path.isabs(outfol):
+            outfol = self.case_path + outfol
+        ext = ".bands.agr" if spag else ".energy"
+        if self.spol and not self.so:
+            return [outfol + name + spin + ext for spin in self.spin_ls]
+        return [outfol + name + ext]
 
     def filepath(self, ext: str) -> str:
         """指定した拡張子を持つファイルのFull Pathを取得する.
@@ -233,25 +594,31 @@ class W2k:
             atom (int): 元素を指定する整数
             orb (int): 軌道を指定する変数
         """
-        path = self.filepath(".insp")
-
-        with open(path, "r") as f:
-            s = f.readlines()
-
-        for l in range(len(s)):
-            if "jatom, jcol, size" in s[l]:
-                out = s[l].split()
-                out[0] = str(atom)
-                out[1] = str(orb)
-                s[l] = " ".join(out)
-
-        s = "".join(s)
-
-        with open(path, "w") as f:
-            f.write(s)
+        insp = self.input(".insp")  # written before the next spaghetti
+        insp.set_token("jatom, jcol, size", 0, atom)
+        insp.set_token("jatom, jcol, size", 1, orb)
 
     def run_scf(self) -> None:
         """SCF計算を実行する."""
+        params = {"ec": self.scf_ec, "cc": self.scf_cc, "ni": self.ni}
+        self._ledgered(
+            "scf",
+            self.case_path,
+            lambda: self._digest(self._scf_inputs(), params, scf=0),
+            self._run_scf,
+        )
+
+    def _scf_inputs(self) -> List[str]:
+        # every input file x_lapw reads in the cycle, missing ones are skipped by digest
+        ext = [".struct", ".klist", ".in0", ".in1", ".in1c", ".in2", ".in2c", ".inm"]
+        ext += [".inc"] + ([".incup", ".incdn"] if self.spol else [])
+        if self.orb:
+            ext += [".inorb", ".indm", ".indmc"]
+        if self.so:
+            ext += [".inso"]
+        return [self.filepath(e) for e in ext]
+
+    def _run_scf(self) -> List[str]:
         so = self.so
         orb = self.orb
         p = self.parallel
@@ -281,9 +648,8 @@ class W2k:
         if ni:
             run_l.append("-NI")
 
-        os.chdir(self.case_path)
-
-        subprocess.run(run_l)
+        self._run(run_l)
+        return [self.filepath(".scf")]
 
     def restore_lapw(self, name: str) -> None:
         """SCF計算結果を呼び出す.
@@ -291,8 +657,7 @@ class W2k:
         Args:
             name (str): 保存名.
         """
-        os.chdir(self.case_path)
-        subprocess.run(["restore_lapw", name])
+        self._run(["restore_lapw", name])
 
     def run_dos(self, outfol: str, name: str, int_list: List[str] = ["total"]) -> None:
         """DOS計算実行.
@@ -302,16 +667,22 @@ class W2k:
             name (str): 計算結果ファイル名
             int_list (List[str], optional): 計算したい軌道成分のリスト. デフォルト値=["total"].
         """
+        if not os.path.isabs(outfol):
+            outfol = self.case_path + outfol
+
+        self._ledgered(
+            "dos",
+            outfol + name,
+            lambda: self._digest([self.filepath(".klist")], {"int_list": int_list}),
+            lambda: self._run_dos(outfol, name, int_list),
+        )
+
+    def _run_dos(self, outfol: str, name: str, int_list: List[str]) -> List[str]:
         so = self.so
         orb = self.orb
         p = self.parallel
         spol = self.spol
 
-        os.chdir(self.case_path)
-
-        if not outfol.startswith(self.case_path):
-            outfol = self.case_path + outfol
-
         run_lapw1 = ["x_lapw", "lapw1"]
         run_lapw2 = ["x_lapw", "lapw2", "-qtl"]
         run_tetra = ["x_lapw", "tetra"]
@@ -330,32 +701,26 @@ class W2k:
         if spol:
             for spin in self.spin_ls:
                 run_lapw1s = run_lapw1 + ["-" + spin]
-                print("run " + " ".join(run_lapw1s))
-                subprocess.run(run_lapw1s)
+                self._run(run_lapw1s)
             for spin in self.spin_ls:
                 run_lapw2s = run_lapw2 + ["-" + spin]
-                print("run " + " ".join(run_lapw2s))
-                subprocess.run(run_lapw2s)
+                self._run(run_lapw2s)
         else:
-            print("run " + " ".join(run_lapw1))
-            subprocess.run(run_lapw1)
-            print("run " + " ".join(run_lapw2))
-            subprocess.run(run_lapw2)
+            self._run(run_lapw1)
+            self._run(run_lapw2)
 
-        print("run " + " ".join(["configure_int_lapw", "-b"] + int_list + ["END"]))
-        subprocess.run(["configure_int_lapw", "-b"] + int_list + ["END"])
+        self._run(["configure_int_lapw", "-b"] + int_list + ["END"])
 
         if spol:
             for spin in self.spin_ls:
                 run_tetras = run_tetra + ["-" + spin]
-                print("run " + " ".join(run_tetras))
-                subprocess.run(run_tetras)
+                self._run(run_tetras)
         else:
-            print("run " + " ".join(run_tetra))
-            subprocess.run(run_tetra)
+            self._run(run_tetra)
 
         subprocess.call(["mkdir", "-p", outfol])
 
+        outputs = []
         if spol:
             sp = len(self.spin_ls)
         else:
@@ -371,9 +736,11 @@ class W2k:
                 savepath = outfol + name + ".dos" + str(n) + "eV" + spin
                 if os.path.exists(path):
                     subprocess.call(["cp", path, savepath])
+                    outputs.append(savepath)
                 else:
                     break
                 n += 1
+        return outputs
 
     def run_band(
         self,
@@ -383,6 +750,7 @@ class W2k:
         qtl_ls: List[List[int]] = [[1, 0]],
         atom_ls: List[str] = [""],
         orbital_ls: List[str] = [""],
+        spag: int = 1,
     ) -> None:
         """バンド計算を実行.
 
@@ -393,12 +761,40 @@ class W2k:
             qtl_ls (List[List[int]], optional): 重み付けしたい[元素, 軌道]のリスト(たぶん). デフォルト値=[[1, 0]].
             atom_ls (List[str], optional): 出力を見やすくするための元素名. 指定しない場合自動で命名される.
             orbital_ls (List[str], optional): 出力を見やすくするための軌道名. 指定しない場合自動で命名される.
-        """
-        os.chdir(self.case_path)
+            spag (int, optional): 0の場合, qtl=0 ならspaghettiを実行せず, case.energy を
+                name + spin + ".energy" にコピーする (energy_w2k.load_energy で読む). デフォルト値=1.
 
-        if not outfol.startswith(self.case_path):
+        Raises:
+            RuntimeError: WIEN2kのプログラムが0でない終了コードを返した, または出力が無い場合
+        """
+        if not os.path.isabs(outfol):
             outfol = self.case_path + outfol
 
+        params = {"qtl": qtl, "qtl_ls": qtl_ls} if qtl else {}
+        if not spag:
+            params["spag"] = 0
+        self._ledgered(
+            "band",
+            outfol + name,
+            lambda: self._digest([self.filepath(".klist_band")], params),
+            lambda: self._run_band(
+                outfol, name, qtl, qtl_ls, atom_ls, orbital_ls, spag
+            ),
+        )
+
+    def _run_band(
+        self,
+        outfol: str,
+        name: str,
+        qtl: int,
+        qtl_ls: List[List[int]],
+        atom_ls: List[str],
+        orbital_ls: List[str],
+        spag: int = 1,
+    ) -> List[str]:
+        if self.machines is not None:  # split cores for the current .klist_band
+            self.write_machines(**self.machines)
+
         so = self.so
         orb = self.orb
         spol = self.spol
@@ -438,83 +834,196 @@ class W2k:
                 run_lapwso.append("-up")
                 run_spag.append("-up")
 
+        if spol and so:  # [.agr in session, case.qtl, suffix of the output]
+            files = [[".bandsup.agr", ".qtlup", ""]]
+        elif spol:
+            files = [
+                [".bands" + spin + ".agr", ".qtl" + spin, spin] for spin in self.spin_ls
+            ]
+        else:
+            files = [[".bands.agr", ".qtl", ""]]
+        for agr, qf, _ in files:  # outputs of an earlier run must not be copied
+            for f in [agr, qf]:
+                if os.path.exists(self.filepath(f)):
+                    os.remove(self.filepath(f))
+
+        start = time.time() - 1  # fragments older than this are from an earlier run
         if spol:
             for spin in self.spin_ls:
                 run_lapw1s = run_lapw1 + ["-" + spin]
-                print("run " + " ".join(run_lapw1s))
-                subprocess.run(run_lapw1s)
+                self._run(run_lapw1s, check=1, band=1)
         else:
-            print("run " + " ".join(run_lapw1))
-            subprocess.run(run_lapw1)
+            self._run(run_lapw1, check=1, band=1)
 
         if so:
-            print("run " + " ".join(run_lapwso))
-            subprocess.run(run_lapwso)
+            self._run(run_lapwso, check=1, band=1)
 
         if qtl:
-            print("run " + " ".join(run_lapw2))
-            subprocess.run(run_lapw2)
+            self._run(run_lapw2, check=1, band=1)
 
         subprocess.call(["mkdir", "-p", outfol])
 
-        if qtl == 0:
-            qtl_ls = [[0, 1]]
-
-        for q in qtl_ls:
-            self.mod_insp_weight(q[0], q[1])
-            if spol:
-                run_spags = run_spag
-                for spin in self.spin_ls:
-                    run_spags = run_spag + ["-" + spin]
-                    print(
-                        "run "
-                        + " ".join(run_spags)
-                        + " / .insp : "
-                        + " ".join(str(v) for v in q)
-                    )
-                    subprocess.run(run_spags)
+        if not spag and not qtl:  # band energies straight from lapw1 / lapwso
+            if spol and so:  # [case.energy, suffix of the output]
+                files = [[".energysoup", ""]]
+            elif spol:
+                files = [[".energy" + spin, spin] for spin in self.spin_ls]
             else:
-                print(
-                    "run "
-                    + " ".join(run_spag)
-                    + " / .insp : "
-                    + " ".join(str(v) for v in q)
-                )
-                subprocess.run(run_spag)
+                files = [[".energyso" if so else ".energy", ""]]
+            outputs = []
+            for ene, suffix in files:
+                src = energy_w2k.energy_files(self.filepath(ene), start)
+                energy_w2k.merge_energy(src, outfol + name + suffix + ".energy")
+                outputs.append(outfol + name + suffix + ".energy")
+            return outputs
+
+        # one spaghetti run without band character, the weights of all
+        # (atom, orbital) pairs are then taken from case.qtl at once
+        self.mod_insp_weight(0, 1)
+        if spol:
+            for spin in self.spin_ls:
+                self._run(run_spag + ["-" + spin], check=1, band=1)
+        else:
+            self._run(run_spag, check=1, band=1)
+
+        outputs = []
+        for agr, _, suffix in files:
+            if not os.path.exists(self.filepath(agr)):
+                raise RuntimeError("spaghetti wrote no " + self.filepath(agr))
+            subprocess.call(
+                ["cp", self.filepath(agr), outfol + name + suffix + ".bands.agr"]
+            )
+            outputs.append(outfol + name + suffix + ".bands.agr")
 
-            if qtl:
-                if len(atom_ls) >= q[0]:
+        if qtl:
+            qnames = []
+            for q in qtl_ls:
+                if len(atom_ls) > q[0]:
                     atom_name = atom_ls[q[0]]
                 else:
                     atom_name = "Atom" + str(q[0])
 
-                if len(orbital_ls) >= q[1]:
+                if len(orbital_ls) > q[1]:
                     orb_name = orbital_ls[q[1]]
                 else:
                     orb_name = "Orb" + str(q[1])
-                name = atom_name + orb_name + "_" + name
-            else:
-                name = name
+                qnames.append(atom_name + orb_name + "_" + name)
 
-            if spol:
-                if so:
-                    subprocess.call(
-                        [
-                            "cp",
-                            self.filepath(".bandsup.agr"),
-                            outfol + name + ".bands.agr",
-                        ]
-                    )
-                else:
-                    for spin in self.spin_ls:
-                        subprocess.call(
-                            [
-                                "cp",
-                                self.filepath(".bands" + spin + ".agr"),
-                                outfol + name + spin + ".bands.agr",
-                            ]
-                        )
-            else:
-                subprocess.call(
-                    ["cp", self.filepath(".bands.agr"), outfol + name + ".bands.agr"]
+            for agr, qf, suffix in files:
+                _, w, _ = qtl_w2k.load_qtl(self.filepath(qf))
+                out_ls = [outfol + n + suffix + ".bands.agr" for n in qnames]
+                qtl_w2k.write_weighted_agr(self.filepath(agr), w, qtl_ls, out_ls)
+                outputs += out_ls
+        return outputs
+
+    def run_band_batch(
+        self,
+        outfol: str,
+        lines: List[List[str]],
+        max_k: int = 2000,
+        qtl: int = 0,
+        qtl_ls: List[List[int]] = [[1, 0]],
+        atom_ls: List[str] = [""],
+        orbital_ls: List[str] = [""],
+        spag: int = 1,
+    ) -> List[str]:
+        """複数のk点ラインをまとめて1回のバンド計算で実行し, ラインごとの.agrに分割する.
+
+        出力ファイル名は各ラインを run_band で計算した場合と同じになる.
+        spaghettiは全k点で共通のバンド数しか出力しないので,
+        ラインごとに計算した場合よりバンド数が少なくなる場合がある.
+        失敗したまとまりのラインは記録して飛ばし, 次のまとまりを計算する.
+
+        Args:
+            outfol (str): 出力フォルダパス
+            lines (List[List[str]]): [計算結果ファイル名, .klist_bandファイルのパス] のリスト
+            max_k (int, optional): 1回の計算に入れるk点数の上限. デフォルト値=2000.
+            qtl, qtl_ls, atom_ls, orbital_ls, spag: run_band と同じ.
+
+        Returns:
+            List[str]: 計算できなかったライン名 (失敗, または停止したため未実行).
+        """
+        if not os.path.isabs(outfol):
+            outfol = self.case_path + outfol
+
+        tag = "__batch__"  # name of the combined run, replaced by line names
+        tmpfol = self.case_path + "batch_tmp/"
+
+        params = {"qtl": qtl, "qtl_ls": qtl_ls} if qtl else {}
+        if not spag:
+            params["spag"] = 0
+        ledger = self.ledger  # recorded per line, not per batch
+        inputs = {}
+
+        batches = [[]]
+        nk = 0
+        for name, path in lines:
+            kl = read_klist(path)
+            if len(kl) == 0:
+                continue
+            if ledger is not None:
+                inputs[name] = self._digest([path], params)
+                if ledger.done(outfol + name, inputs[name]):
+                    continue
+            if len(batches[-1]) > 0 and nk + len(kl) > max_k:
+                batches.append([])
+                nk = 0
+            batches[-1].append((name, kl))
+            nk += len(kl)
+
+        finished = set()
+        t_st = datetime.datetime.now()
+        for c, batch in enumerate(batches):
+            if len(batch) == 0:
+                continue
+            if ledger_w2k.stop_requested():
+                break
+            kl = []
+            for name, k in batch:  # format (A10,4I5,F5.1), drop the energy window
+                kl += [l[:35] for l in k]
+            kl[0] = batch[0][1][0]  # except on the very first line
+            self.input(".klist_band").set_lines(kl + ["END"])
+
+            if ledger is not None:
+                for name, _ in batch:
+                    ledger.start(outfol + name, "band", inputs[name])
+
+            subprocess.call(["rm", "-rf", tmpfol])
+            try:
+                produced = self._run_band(
+                    tmpfol, tag, qtl, qtl_ls, atom_ls, orbital_ls, spag
                 )
+            except BaseException as e:
+                if ledger is not None:
+                    for name, _ in batch:
+                        ledger.finish(outfol + name, [], "failed", repr(e))
+                if not isinstance(e, Exception):
+                    raise
+                print("ERROR : batch " + str(c + 1) + " failed : " + str(e))
+                continue
+            subprocess.call(["mkdir", "-p", outfol])
+
+            counts = [len(k) for _, k in batch]
+            outputs = {name: [] for name, _ in batch}
+            for src in produced:
+                f = os.path.basename(src)
+                dst_ls = [outfol + f.replace(tag, name) for name, _ in batch]
+                split = split_agr if f.endswith(".agr") else energy_w2k.split_energy
+                if split(src, dst_ls, counts):
+                    for (name, _), dst in zip(batch, dst_ls):
+                        outputs[name].append(dst)
+            subprocess.call(["rm", "-rf", tmpfol])
+
+            for name, _ in batch:  # every output of the run, e.g. both spins
+                ok = len(produced) > 0 and len(outputs[name]) == len(produced)
+                if ok:
+                    finished.add(name)
+                if ledger is not None:
+                    ledger.finish(
+                        outfol + name, outputs[name], "done" if ok else "failed"
+                    )
+
+            t_n = datetime.datetime.now()
+            print("batch " + str(c + 1) + " / " + str(len(batches)), end=" ")
+            print("finish : " + str((t_n - t_st) / (c + 1) * len(batches) + t_st))
+        return [name for batch in batches for name, _ in batch if name not in finished]
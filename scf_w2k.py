@@ -0,0 +1,116 @@
+import numpy as np
+import os
+import re
+from typing import Dict
+
+# directory path string must finish with "/"
+
+_cache = {}  # path: (size, mtime_ns, parsed arrays)
+
+
+def _last_float(line: str) -> float:
+    return float(line.split()[-1])
+
+
+def last_line(path: str, label: str, block: int = 65536) -> str:
+    """.scfファイルを末尾から読み, label で始まる最後の行を返す.
+
+    Args:
+        path (str): .scfファイルのパス
+        label (str): ":FER" などの行頭の文字列
+        block (int, optional): 一度に読むバイト数.
+
+    Returns:
+        str: 見つかった行. 無い場合は空文字列.
+    """
+    # a label at a line start, not followed by more of a word (:ENE but not :ENERGY)
+    pat = re.compile(b"\n" + re.escape(label.encode()) + b"(?![A-Za-z0-9])")
+    with open(path, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        tail = b""  # start of the part already searched, up to its first line end
+        while pos > 0:
+            n = min(block, pos)
+            pos -= n
+            f.seek(pos)
+            buf = f.read(n) + tail
+            if pos == 0:
+                buf = b"\n" + buf
+                n += 1
+            m = None  # last match starting in the new block, the tail may be cut short
+            for mm in pat.finditer(buf, 0, n + len(label) + 2):
+                if mm.start() < n:
+                    m = mm
+            if m is not None:
+                j = buf.find(b"\n", m.start() + 1)
+                return buf[m.start() + 1 : j if j >= 0 else len(buf)].decode()
+            j = buf.find(b"\n")
+            tail = buf[: max(j + 1, len(label) + 2)] if j >= 0 else buf
+    return ""
+
+
+def last_value(path: str, label: str) -> float:
+    """label で始まる最後の行の最後の数値.
+
+    Args:
+        path (str): .scfファイルのパス
+        label (str): ":FER", ":ENE" など
+
+    Returns:
+        float: 値
+    """
+    line = last_line(path, label)
+    if not line:
+        raise ValueError(label + " not found in " + path)
+    return _last_float(line)
+
+
+def load_scf(path: str) -> Dict[str, np.ndarray]:
+    """.scfファイルを一度だけ読み, ラベルごとの値をSCFの反復ごとの配列にする.
+
+    ":ITEnnn" の行で反復を区切り, ":ENE", ":FER", ":DIS", ":MMT001" などの
+    各ラベルについて, 行の最後の数値を反復ごとに並べる. 1つの反復に同じラベルが
+    複数ある場合は最後の値, 無い場合はNaNになる. ラベルは行頭の ":" から次の ":" までの
+    最初の単語 (":CHARGE convergence:" は "CHARGE").
+    ファイルのサイズと更新時刻が変わらなければ, 前回の結果を返す.
+
+    Args:
+        path (str): .scfファイルのパス
+
+    Returns:
+        Dict[str, np.ndarray]: ラベルと (反復数,) の配列. "ITE" は反復の番号.
+    """
+    st = os.stat(path)
+    c = _cache.get(path)
+    if c is not None and c[0] == st.st_size and c[1] == st.st_mtime_ns:
+        return dict(c[2])
+
+    with open(path, "rb") as f:
+        lines = [
+            l for l in f.read().decode(errors="replace").splitlines() if l[:1] == ":"
+        ]
+
+    ite = []
+    vals = {}
+    for l in lines:
+        head = l[1:].split(":", 1)[0].split()
+        if len(head) == 0:
+            continue
+        lab = head[0]
+        if lab.startswith("ITE") and lab[3:].isdigit():
+            ite.append(int(lab[3:]))
+            continue
+        try:
+            v = _last_float(l)
+        except (ValueError, IndexError):
+            continue
+        vals.setdefault(lab, {})[len(ite) - 1] = v
+
+    out = {"ITE": np.array(ite, dtype=int)}
+    for lab, d in vals.items():
+        ar = np.full(len(ite), np.nan)
+        ind = np.array([i for i in d if i >= 0], dtype=int)  # before the first :ITE
+        ar[ind] = [d[i] for i in ind]
+        out[lab] = ar
+
+    _cache[path] = (st.st_size, st.st_mtime_ns, out)
+    return dict(out)
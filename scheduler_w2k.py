@@ -0,0 +1,202 @@
+import multiprocessing
+import os
+import queue
+import shutil
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from typing import List
+
+import ledger_w2k
+
+# directory path string must finish with "/"
+
+_worker = None  # W2k instance of the worker process
+
+
+def _init_worker(free) -> None:
+    global _worker
+    _worker = free.get()
+
+
+def _run_job(job: dict, w2k=None) -> bool:
+    if w2k is None:
+        w2k = _worker
+    kwargs = job.get("kwargs", {})
+    names = [name for name, _ in job["lines"]] if "lines" in job else [job["name"]]
+    for name in names:  # outputs left by an earlier run must not count as success
+        if w2k.ledger is None or w2k.ledger.status(job["outfol"] + name) != "done":
+            for p in w2k.band_outputs(job["outfol"], name, kwargs.get("spag", 1)):
+                if os.path.exists(p):
+                    os.remove(p)
+    if "lines" in job:
+        if len(w2k.run_band_batch(job["outfol"], job["lines"], **kwargs)) > 0:
+            return False
+    else:  # raises on a nonzero return code
+        shutil.copy(job["klist"], w2k.filepath(".klist_band"))
+        w2k.run_band(job["outfol"], job["name"], **kwargs)
+    return all(os.path.exists(p) for p in job["expect"])
+
+
+class BandScheduler:
+    def __init__(
+        self,
+        w2k,
+        workers: int = 2,
+        scratch: str = "",
+        retries: int = 2,
+        process: int = 1,
+    ):
+        """独立なバンド計算をプロセスプールで並列に実行する.
+
+        SCF計算の終わったsessionフォルダを workers 個の作業フォルダにコピーし,
+        各プロセスが1つの作業フォルダでジョブを順に実行する.
+        出力は各ジョブの outfol に直接書き込まれる.
+
+        Args:
+            w2k (W2k): SCF計算の終わったsessionのインスタンス
+            workers (int, optional): 並列数. デフォルト値=2.
+            scratch (str, optional): 作業フォルダを作るディレクトリ. デフォルトは case_path + "scratch/".
+            retries (int, optional): 失敗したジョブを再実行する回数. デフォルト値=2.
+            process (int, optional): 1: プロセスプール, 0: スレッドプール. デフォルト値=1.
+        """
+        self.w2k = w2k
+        self.workers = workers
+        self.scratch = scratch if scratch else w2k.case_path + "scratch/"
+        self.retries = retries
+        self.process = process
+        self.worker_ls = []
+
+    def clone(self) -> None:
+        """sessionフォルダを作業フォルダにコピーする."""
+        self.worker_ls = [
+            self.w2k.clone(self.scratch + "w" + str(i) + "/")
+            for i in range(self.workers)
+        ]
+
+    def cleanup(self) -> None:
+        """作業フォルダを削除する. 次の run で再びコピーする."""
+        for i in range(len(self.worker_ls)):
+            shutil.rmtree(self.scratch + "w" + str(i) + "/", ignore_errors=True)
+        self.worker_ls = []
+
+    def band_job(self, klist: str, outfol: str, name: str, **kwargs) -> dict:
+        """run_band 1回分のジョブを作る.
+
+        Args:
+            klist (str): .klist_bandファイルのパス
+            outfol (str): 出力フォルダパス
+            name (str): 計算結果ファイル名
+            **kwargs: run_band に渡す引数
+
+        Returns:
+            dict: ジョブ
+        """
+        outfol = self._outfol(outfol)
+        expect = self.w2k.band_outputs(outfol, name, kwargs.get("spag", 1))
+        return {
+            "klist": klist,
+            "outfol": outfol,
+            "name": name,
+            "kwargs": kwargs,
+            "expect": expect,
+        }
+
+    def batch_job(self, outfol: str, lines: List[List[str]], **kwargs) -> dict:
+        """run_band_batch 1回分のジョブを作る.
+
+        Args:
+            outfol (str): 出力フォルダパス
+            lines (List[List[str]]): [計算結果ファイル名, .klist_bandファイルのパス] のリスト
+            **kwargs: run_band_batch に渡す引数
+
+        Returns:
+            dict: ジョブ
+        """
+        outfol = self._outfol(outfol)
+        expect = []
+        for name, _ in lines:
+            expect += self.w2k.band_outputs(outfol, name, kwargs.get("spag", 1))
+        return {"lines": lines, "outfol": outfol, "kwargs": kwargs, "expect": expect}
+
+    def _outfol(self, outfol: str) -> str:
+        if not os.path.isabs(outfol):
+            outfol = self.w2k.case_path + outfol
+        return outfol
+
+    def run(self, jobs: List[dict]) -> List[dict]:
+        """ジョブを並列に実行する. 失敗したジョブは retries 回まで再実行する.
+
+        Args:
+            jobs (List[dict]): band_job / batch_job で作ったジョブのリスト
+
+        Returns:
+            List[dict]: 最後まで失敗したジョブのリスト. 停止した場合は未実行のジョブも含む.
+        """
+        if len(self.worker_ls) != self.workers:
+            self.clone()
+
+        todo = list(jobs)
+        for n in range(self.retries + 1):
+            if len(todo) == 0 or ledger_w2k.stop_requested():
+                break
+            if n > 0:
+                print("retry " + str(len(todo)) + " jobs (" + str(n) + ")")
+            todo = self._run_round(todo)
+        for job in todo:
+            print("FAILED : " + " ".join(job["expect"]))
+        return todo
+
+    def _run_thread(self, job: dict, free: queue.Queue) -> bool:
+        w2k = free.get()  # each thread borrows one worker directory per job
+        try:
+            return _run_job(job, w2k)
+        finally:
+            free.put(w2k)
+
+    def _run_round(self, jobs: List[dict]) -> List[dict]:
+        if self.process:
+            ctx = multiprocessing.get_context()
+            free = ctx.Queue()
+            for w in self.worker_ls:
+                free.put(w)
+            pool = futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=ctx,
+                initializer=_init_worker,
+                initargs=(free,),
+            )
+        else:
+            free = queue.Queue()
+            for w in self.worker_ls:
+                free.put(w)
+            pool = futures.ThreadPoolExecutor(max_workers=self.workers)
+
+        failed = []
+        with pool:
+            if self.process:
+                fs = {pool.submit(_run_job, job): job for job in jobs}
+            else:
+                fs = {pool.submit(self._run_thread, job, free): job for job in jobs}
+            c = 0
+            for f in futures.as_completed(fs):
+                c += 1
+                if (
+                    ledger_w2k.stop_requested()
+                ):  # let running jobs finish, drop the rest
+                    for g in fs:
+                        g.cancel()
+                if f.cancelled():
+                    failed.append(fs[f])
+                    continue
+                try:
+                    ok = f.result()
+                except BrokenProcessPool as e:  # a worker died, the rest is lost
+                    print("worker lost : " + str(e))
+                    ok = False
+                except Exception as e:
+                    print("job error : " + repr(e))
+                    ok = False
+                if not ok:
+                    failed.append(fs[f])
+                print("jobs : " + str(c) + " / " + str(len(jobs)))
+        return failed
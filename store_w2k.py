@@ -0,0 +1,278 @@
+import numpy as np
+import json
+import os
+import warnings
+from typing import Dict, List
+
+# directory path string must finish with "/"
+
+
+class ChunkStore:
+    def __init__(self, path: str, compress: int = 0) -> None:
+        """追記専用のチャンク型データストアを開く. 存在しない場合は作成する.
+
+        各追記は1つの.npzチャンクとして保存され, チャンクの情報 (ソース名, 行数, 範囲) は
+        chunks.jsonl に1行ずつ追記される. manifest.json は全チャンクの一覧で, flush または
+        close のときだけ書き直す. 開くときは manifest.json の後に追記された行だけを読む.
+
+        Args:
+            path (str): ストアのディレクトリ
+            compress (int, optional): 1の場合, チャンクを圧縮して保存する. デフォルト値=0.
+        """
+        self.path = path
+        self.compress = compress
+        os.makedirs(path, exist_ok=True)
+        self.manifest = {"chunks": [], "index_size": 0}
+        if os.path.exists(self.path + "manifest.json"):
+            with open(self.path + "manifest.json", "r") as f:
+                self.manifest = json.load(f)
+        self.__sources = set(c["source"] for c in self.manifest["chunks"])
+        self.__pending = self._read_index()
+
+    def _read_index(self) -> int:
+        index = self.path + "chunks.jsonl"
+        if not os.path.exists(index):
+            return 0
+        n = 0
+        with open(index, "rb") as f:
+            f.seek(self.manifest["index_size"])
+            pos = f.tell()
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # cut by a crash, overwritten by the next append
+                chunk = json.loads(line)
+                self.manifest["chunks"].append(chunk)
+                self.__sources.add(chunk["source"])
+                pos += len(line)
+                n += 1
+        if pos < os.path.getsize(index):
+            os.truncate(index, pos)
+        return n
+
+    def __len__(self) -> int:
+        return sum(c["n"] for c in self.manifest["chunks"])
+
+    def has(self, source: str) -> bool:
+        """ソースが取り込み済みかどうか."""
+        return source in self.__sources
+
+    def flush(self) -> None:
+        """追記したチャンクがあれば manifest.json を書き直す."""
+        if self.__pending == 0:
+            return
+        index = self.path + "chunks.jsonl"
+        self.manifest["index_size"] = os.path.getsize(index)
+        tmp = self.path + "manifest.json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self.path + "manifest.json")
+        self.__pending = 0
+
+    def close(self) -> None:
+        """manifest.json を書き直して閉じる."""
+        self.flush()
+
+    def append(self, source: str, **columns: np.ndarray) -> None:
+        """1つのソースから得たデータをチャンクとして追記する.
+
+        Args:
+            source (str): ソース名. 取り込み済みとして記録される.
+            **columns (np.ndarray): 列名と配列. 先頭の次元が行数.
+        """
+        n = len(next(iter(columns.values()))) if len(columns) > 0 else 0
+        chunk = {"file": "", "n": n, "source": source}
+        if n > 0:
+            chunk["file"] = "chunk_" + str(len(self.manifest["chunks"])) + ".npz"
+            tmp = self.path + chunk["file"] + ".tmp.npz"
+            if self.compress:
+                np.savez_compressed(tmp, **columns)
+            else:
+                np.savez(tmp, **columns)
+            os.replace(tmp, self.path + chunk["file"])
+            chunk.update(self._stats(columns))
+        with open(self.path + "chunks.jsonl", "a") as f:  # after its chunk file
+            f.write(json.dumps(chunk) + "\n")
+        self.manifest["chunks"].append(chunk)
+        self.__sources.add(source)
+        self.__pending += 1
+
+    def _stats(self, columns: Dict[str, np.ndarray]) -> dict:
+        return {}
+
+    def chunks(self, names: List[str], chunks: List[dict] = None):
+        """チャンクごとに指定した列を読み込むジェネレータ.
+
+        Args:
+            names (List[str]): 読み込む列名
+            chunks (List[dict], optional): 読み込むチャンク. 指定しない場合は全て.
+
+        Yields:
+            Tuple[dict, List[np.ndarray]]: チャンク情報と列のリスト
+        """
+        if chunks is None:
+            chunks = self.manifest["chunks"]
+        for c in chunks:
+            if c["n"] == 0:
+                continue
+            with np.load(self.path + c["file"]) as z:
+                yield c, [z[n] for n in names]
+
+    def read(self, *names: str) -> List[np.ndarray]:
+        """指定した列を全チャンクについて連結して読み込む.
+
+        Args:
+            *names (str): 列名
+
+        Returns:
+            List[np.ndarray]: 列ごとの配列. データが無い場合は None.
+        """
+        cols = [[] for _ in names]
+        for _, vals in self.chunks(list(names)):
+            for i, v in enumerate(vals):
+                cols[i].append(v)
+        return [np.concatenate(c) if len(c) > 0 else None for c in cols]
+
+
+class BandStore(ChunkStore):
+    def __init__(self, path: str, compress: int = 1) -> None:
+        """バンドエネルギーのチャンク型ストアを開く. 存在しない場合は作成する.
+
+        1チャンクは1つのk点ライン (1つの.agrまたは.energyファイル) で,
+        k (k点, 3), e (k点, band), w (k点, band, 重み), spin (k点,) の列を持つ.
+        chunks.jsonl にはチャンクごとのk点の範囲, バンドごとのエネルギーの範囲, spinが
+        記録され, query は条件に合うチャンクだけを読み込む.
+
+        Args:
+            path (str): ストアのディレクトリ
+            compress (int, optional): 1の場合, チャンクを圧縮して保存する. デフォルト値=1.
+        """
+        super().__init__(path, compress)
+
+    def _stats(self, columns: Dict[str, np.ndarray]) -> dict:
+        e = columns["e"]
+        with warnings.catch_warnings():  # all-NaN band of a short line
+            warnings.simplefilter("ignore", RuntimeWarning)
+            e_min = np.nanmin(e, axis=0)
+            e_max = np.nanmax(e, axis=0)
+        return {
+            "k_min": columns["k"].min(axis=0).tolist(),
+            "k_max": columns["k"].max(axis=0).tolist(),
+            "e_min": [None if np.isnan(v) else float(v) for v in e_min],
+            "e_max": [None if np.isnan(v) else float(v) for v in e_max],
+            "spin": np.unique(columns["spin"]).tolist(),
+        }
+
+    def append_band(
+        self,
+        source: str,
+        k: np.ndarray,
+        e: np.ndarray,
+        w: np.ndarray = None,
+        spin: int = 0,
+    ) -> None:
+        """1本のk点ラインのバンドを追記する.
+
+        Args:
+            source (str): ソース名. ファイル名 + spin など.
+            k (np.ndarray): (k点, 3) のk点座標
+            e (np.ndarray): (band, k点) のエネルギー. load_agr などの出力.
+            w (np.ndarray, optional): (band, k点) の重み. 指定しない場合はNaN.
+            spin (int, optional): 0: up または spin無し, 1: dn. デフォルト値=0.
+        """
+        k = np.asarray(k, dtype=float).reshape(-1, 3)
+        e = np.asarray(e, dtype=float).reshape(-1, k.shape[0])
+        if w is None:
+            w = np.full(e.shape, np.nan)
+        self.append(
+            source,
+            k=k,
+            e=e.T,
+            w=np.asarray(w, dtype=float).T,
+            spin=np.full(k.shape[0], spin, dtype=np.int8),
+        )
+
+    def select(
+        self,
+        k_min: List[float] = None,
+        k_max: List[float] = None,
+        band_range: List[int] = None,
+        e_window: List[float] = None,
+        spin: int = None,
+    ) -> List[dict]:
+        """チャンクごとの範囲から, 条件に合う点を含み得るチャンクを選ぶ. 引数は query と同じ."""
+        out = []
+        for c in self.manifest["chunks"]:
+            if c["n"] == 0:
+                continue
+            if spin is not None and spin not in c["spin"]:
+                continue
+            if k_min is not None and np.any(np.array(c["k_max"]) < k_min):
+                continue
+            if k_max is not None and np.any(np.array(c["k_min"]) > k_max):
+                continue
+            if e_window is not None:
+                b0, b1 = band_range if band_range is not None else (0, len(c["e_min"]))
+                lo = [v for v in c["e_min"][b0:b1] if v is not None]
+                hi = [v for v in c["e_max"][b0:b1] if v is not None]
+                if len(lo) == 0 or min(lo) > e_window[1] or max(hi) < e_window[0]:
+                    continue
+            out.append(c)
+        return out
+
+    def query(
+        self,
+        k_min: List[float] = None,
+        k_max: List[float] = None,
+        band_range: List[int] = None,
+        e_window: List[float] = None,
+        spin: int = None,
+        weights: int = 0,
+    ) -> List[np.ndarray]:
+        """条件に合うk点とバンドだけを読み込む.
+
+        Args:
+            k_min (List[float], optional): k点の範囲の下限 [kx, ky, kz].
+            k_max (List[float], optional): k点の範囲の上限 [kx, ky, kz].
+            band_range (List[int], optional): [最初, 最後+1] のバンド番号 (0始まり).
+            e_window (List[float], optional): [下限, 上限] のエネルギー. 範囲外はNaNになり,
+                範囲内のエネルギーが1つも無いk点は除かれる.
+            spin (int, optional): 0: up または spin無し, 1: dn. 指定しない場合は両方.
+            weights (int, optional): 1の場合, 重みも読み込む. デフォルト値=0.
+
+        Returns:
+            List[np.ndarray]: k (N, 3), e (N, band), w (N, band) または None, spin (N,).
+            データが無い場合は全て None.
+        """
+        names = ["k", "e", "spin"] + (["w"] if weights else [])
+        chunks = self.select(k_min, k_max, band_range, e_window, spin)
+        b0, b1 = band_range if band_range is not None else (0, None)
+        parts = []
+        for _, vals in self.chunks(names, chunks):
+            k, e, s = vals[:3]
+            w = vals[3][:, b0:b1] if weights else None
+            e = e[:, b0:b1]
+            m = np.ones(k.shape[0], dtype=bool)
+            if k_min is not None:
+                m &= np.all(k >= k_min, axis=1)
+            if k_max is not None:
+                m &= np.all(k <= k_max, axis=1)
+            if spin is not None:
+                m &= s == spin
+            if e_window is not None:
+                e = np.where((e >= e_window[0]) & (e <= e_window[1]), e, np.nan)
+                m &= np.any(~np.isnan(e), axis=1)
+            parts.append([k[m], e[m], w[m] if weights else None, s[m]])
+        if len(parts) == 0:
+            return [None, None, None, None]
+
+        nb = max(p[1].shape[1] for p in parts)  # lines may have different band numbers
+
+        def pad(a):
+            return np.pad(a, ((0, 0), (0, nb - a.shape[1])), constant_values=np.nan)
+
+        return [
+            np.concatenate([p[0] for p in parts]),
+            np.concatenate([pad(p[1]) for p in parts]),
+            np.concatenate([pad(p[2]) for p in parts]) if weights else None,
+            np.concatenate([p[3] for p in parts]),
+        ]
@@ -0,0 +1,154 @@
+import numpy as np
+import itertools
+from typing import List, Tuple
+
+
+def read_struct_ops(path: str) -> np.ndarray:
+    """case.structファイルから対称操作の回転部分を読み込む.
+
+    Args:
+        path (str): .structファイルのパス
+
+    Returns:
+        np.ndarray: (nsym, 3, 3) の整数行列 (実空間, 格子座標)
+    """
+    with open(path, "r") as f:
+        lines = f.readlines()
+
+    for i, l in enumerate(lines):
+        if "NUMBER OF SYMMETRY OPERATIONS" in l:
+            nsym = int(l.split()[0])
+            break
+    else:
+        raise ValueError("NUMBER OF SYMMETRY OPERATIONS not found in " + path)
+
+    ops = np.zeros((nsym, 3, 3), dtype=int)
+    for s in range(nsym):
+        for r in range(3):
+            l = lines[i + 1 + s * 4 + r]  # format (3I2,F10.8), 4th line is the index
+            ops[s, r] = [int(l[0:2]), int(l[2:4]), int(l[4:6])]
+    return ops
+
+
+def cubic_ops() -> np.ndarray:
+    """立方晶 (Oh) の48個の対称操作を作る.
+
+    Returns:
+        np.ndarray: (48, 3, 3) の整数行列
+    """
+    ops = []
+    for perm in itertools.permutations(range(3)):
+        for sign in itertools.product([1, -1], repeat=3):
+            m = np.zeros((3, 3), dtype=int)
+            m[range(3), perm] = sign
+            ops.append(m)
+    return np.array(ops)
+
+
+def kspace_ops(ops: np.ndarray, time_reversal: int = 1) -> np.ndarray:
+    """実空間の対称操作を逆格子空間の操作 (R^-1)^T に変換する.
+
+    Args:
+        ops (np.ndarray): (nsym, 3, 3) の実空間の対称操作
+        time_reversal (int, optional): 1の場合, k -> -k を加える. デフォルト値=1.
+
+    Returns:
+        np.ndarray: (n, 3, 3) の逆格子空間の操作. 恒等操作が先頭になる.
+    """
+    kops = np.rint(np.linalg.inv(np.asarray(ops, dtype=float))).astype(int)
+    kops = np.transpose(kops, (0, 2, 1))
+    if time_reversal:
+        kops = np.concatenate([kops, -kops])
+    _, ind = np.unique(kops.reshape(kops.shape[0], 9), axis=0, return_index=True)
+    kops = kops[np.sort(ind)]
+    ident = np.all(kops == np.eye(3, dtype=int), axis=(1, 2))
+    return np.concatenate([kops[ident], kops[~ident]])
+
+
+def unique_index(k: np.ndarray, tol: float = 1e-6) -> np.ndarray:
+    """許容誤差 tol で同じとみなせるk点のうち, 最初のもののindexを返す.
+
+    Args:
+        k (np.ndarray): (N, 3) のk点
+        tol (float, optional): 許容誤差
+
+    Returns:
+        np.ndarray: 昇順のindex
+    """
+    q = np.rint(np.asarray(k) / tol).astype(np.int64)
+    if q.shape[0] == 0:
+        return np.zeros(0, dtype=int)
+    q -= q.min(axis=0)
+    bits = int(q.max()).bit_length()
+    if 3 * bits <= 63:  # pack the three integers into a single int64 hash
+        key = (q[:, 0] << (2 * bits)) | (q[:, 1] << bits) | q[:, 2]
+        _, ind = np.unique(key, return_index=True)
+    else:
+        _, ind = np.unique(q, axis=0, return_index=True)
+    return np.sort(ind)
+
+
+def unfold(
+    k: np.ndarray,
+    ops: np.ndarray,
+    values: List[np.ndarray] = [],
+    tol: float = 1e-6,
+    time_reversal: int = 1,
+) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """既約領域のk点を対称操作で展開し, 重複を取り除く.
+
+    Args:
+        k (np.ndarray): (N, 3) のk点 (逆格子の基底)
+        ops (np.ndarray): (nsym, 3, 3) の実空間の対称操作. read_struct_ops や cubic_ops の出力.
+        values (List[np.ndarray], optional): k点ごとの値 (N, ...). k点と一緒に展開される.
+        tol (float, optional): 重複判定の許容誤差
+        time_reversal (int, optional): 1の場合, k -> -k も加える. デフォルト値=1.
+
+    Returns:
+        Tuple[np.ndarray, List[np.ndarray]]: 展開したk点と値
+    """
+    k = np.asarray(k, dtype=float).reshape(-1, 3)
+    kops = kspace_ops(ops, time_reversal)
+    kk = np.einsum("sij,nj->sni", kops, k).reshape(-1, 3)
+    ind = unique_index(kk, tol)
+    n = k.shape[0]
+    out = [np.asarray(v)[ind % n] for v in values]
+    return kk[ind], out
+
+
+def irreducible_grid(
+    n: int, ops: np.ndarray, time_reversal: int = 1
+) -> Tuple[np.ndarray, np.ndarray]:
+    """0からnまでの整数k点格子 (n+1)^3 のうち, 対称操作で移り合わない点だけを選ぶ.
+
+    格子の外に出る像は無視するので, 格子内で移り合う点のみがまとめられる.
+
+    Args:
+        n (int): 格子の分割数
+        ops (np.ndarray): (nsym, 3, 3) の実空間の対称操作
+        time_reversal (int, optional): 1の場合, k -> -k も加える. デフォルト値=1.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: 既約点 (M, 3) [kx, ky, kz] と,
+        各格子点 [kz, ky, kx] に対応する既約点のindex (n+1, n+1, n+1)
+    """
+    m = n + 1
+    kz, ky, kx = np.meshgrid(range(m), range(m), range(m), indexing="ij")
+    k = np.stack([kx.ravel(), ky.ravel(), kz.ravel()], -1)
+    rep = np.arange(m**3)  # smallest key in the orbit of each grid point
+    for op in kspace_ops(ops, time_reversal):
+        kk = k @ op.T
+        ok = np.all((kk >= 0) & (kk <= n), axis=1)
+        key = (kk[:, 2] * m + kk[:, 1]) * m + kk[:, 0]
+        np.minimum(rep, np.where(ok, key, rep), out=rep)
+
+    # orbits are closed under the group, but a chain inside the grid may need
+    # several steps, so follow representatives until they stop changing
+    while True:
+        nrep = rep[rep]
+        if np.array_equal(nrep, rep):
+            break
+        rep = nrep
+
+    irr, gmap = np.unique(rep, return_inverse=True)
+    return k[irr], gmap.reshape(m, m, m)
@@ -0,0 +1,180 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# directory path string must finish with "/"
+
+
+def timed_run(
+    cmd: List[str],
+    input=None,
+    capture_output: bool = False,
+    check: bool = False,
+    **kwargs
+) -> Tuple[subprocess.CompletedProcess, dict]:
+    """コマンドを実行し, 経過時間, CPU時間, 終了コード, 最大メモリを測る.
+
+    CPU時間と最大メモリは os.wait4 で得たそのコマンド自身の値で, コマンドが待った子プロセス
+    (x_lapw から起動される lapw1 など) の分を含む. 他のスレッドから同時に実行したコマンドの分は含まない.
+
+    Args:
+        cmd (List[str]): コマンド
+        input (optional): 標準入力に渡すデータ. デフォルト値=None.
+        capture_output (bool, optional): 標準出力と標準エラー出力を受け取るか. デフォルト値=False.
+        check (bool, optional): 終了コードが0でなければ CalledProcessError を投げるか. デフォルト値=False.
+        **kwargs: subprocess.Popen に渡す引数
+
+    Returns:
+        Tuple[subprocess.CompletedProcess, dict]: 実行結果と測定値
+    """
+    if capture_output:
+        kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+    if input is not None:
+        kwargs["stdin"] = subprocess.PIPE
+
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, **kwargs)
+    # pipes are read by threads, the child itself must be reaped by wait4 to get its rusage
+    out = {}
+    readers = []
+    for name in ("stdout", "stderr"):
+        f = getattr(proc, name)
+        if f is not None:
+            t = threading.Thread(
+                target=lambda n=name, f=f: out.__setitem__(n, f.read())
+            )
+            t.start()
+            readers.append(t)
+    try:
+        if proc.stdin is not None:
+            try:
+                proc.stdin.write(input)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        _, status, ru = os.wait4(proc.pid, 0)
+    except BaseException:  # e.g. KeyboardInterrupt, do not leave the child running
+        proc.kill()
+        proc.wait()
+        raise
+    wall = time.perf_counter() - t0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    for t in readers:
+        t.join()
+    for f in (proc.stdout, proc.stderr):
+        if f is not None:
+            f.close()
+    res = subprocess.CompletedProcess(
+        cmd, proc.returncode, out.get("stdout"), out.get("stderr")
+    )
+
+    maxrss = ru.ru_maxrss  # kB on Linux and bytes on macOS
+    if sys.platform == "darwin":
+        maxrss //= 1024
+    rec = {
+        "wall": wall,
+        "cpu": ru.ru_utime + ru.ru_stime,
+        "rc": res.returncode,
+        "maxrss_kb": maxrss,
+    }
+    if check:
+        res.check_returncode()
+    return res, rec
+
+
+class Telemetry:
+    def __init__(self, path: str) -> None:
+        """WIEN2kの各ステップの測定値を JSON-lines で記録する.
+
+        1ステップが1行になる. 追記するだけなので, 複数のプロセスから同じファイルに書いてもよい.
+
+        Args:
+            path (str): .jsonlファイルのパス
+        """
+        self.path = path
+
+    def record(self, rec: dict) -> None:
+        """1ステップ分の記録を追記する."""
+        rec = dict(rec, time=datetime.datetime.now().isoformat(), pid=os.getpid())
+        with open(self.path, "a") as f:
+            f.write(json.dumps(rec) + "\n")
+
+    def load(self) -> List[dict]:
+        """記録を全て読み込む. 壊れた行は飛ばす."""
+        out = []
+        if not os.path.exists(self.path):
+            return out
+        with open(self.path, "r") as f:
+            for l in f:
+                try:
+                    out.append(json.loads(l))
+                except json.JSONDecodeError:
+                    continue
+        return out
+
+    def summary(
+        self, by: str = "step", percentiles: List[float] = [50, 90, 99]
+    ) -> Dict[str, dict]:
+        """ステップごとの集計.
+
+        Args:
+            by (str, optional): 集計するキー. デフォルト値="step".
+            percentiles (List[float], optional): 経過時間のパーセンタイル. デフォルト値=[50, 90, 99].
+
+        Returns:
+            Dict[str, dict]: キーの値ごとに n, 失敗数, 経過時間とCPU時間の合計,
+            経過時間のパーセンタイル, 1k点あたりの経過時間の中央値, 最大メモリ.
+        """
+        groups = {}
+        for r in self.load():
+            groups.setdefault(str(r.get(by, "")), []).append(r)
+
+        out = {}
+        for key, rs in groups.items():
+            wall = np.array([r["wall"] for r in rs])
+            cpu = np.array([r["cpu"] for r in rs])
+            nk = np.array([r.get("nk", 0) for r in rs])
+            s = {
+                "n": len(rs),
+                "failed": sum(1 for r in rs if r["rc"] != 0),
+                "wall": float(wall.sum()),
+                "cpu": float(cpu.sum()),
+                "maxrss_kb": max(r["maxrss_kb"] for r in rs),
+            }
+            for p in percentiles:
+                s["wall_p" + str(p)] = float(np.percentile(wall, p))
+            if np.any(nk > 0):
+                s["wall_per_k"] = float(np.median(wall[nk > 0] / nk[nk > 0]))
+            out[key] = s
+        return out
+
+    def print_summary(self, by: str = "step") -> None:
+        """summary を表にしてprintする. 合計の経過時間が長い順."""
+        summ = self.summary(by)
+        total = sum(s["wall"] for s in summ.values())
+        print(
+            "%-14s %6s %6s %10s %6s %9s %9s %9s %10s"
+            % (by, "n", "failed", "wall(s)", "%", "p50", "p90", "p99", "s/k")
+        )
+        for key, s in sorted(summ.items(), key=lambda x: -x[1]["wall"]):
+            print(
+                "%-14s %6d %6d %10.1f %6.1f %9.2f %9.2f %9.2f %10.4f"
+                % (
+                    key,
+                    s["n"],
+                    s["failed"],
+                    s["wall"],
+                    100 * s["wall"] / total if total > 0 else 0,
+                    s["wall_p50"],
+                    s["wall_p90"],
+                    s["wall_p99"],
+                    s.get("wall_per_k", np.nan),
+                )
+            )
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+import analyze_w2k as anal
+
+
+def old_load_agr(path):  # line by line parser of the first version, per band lists
+    eng, wei = [], []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.lstrip()
+            if line.startswith("@") or line.startswith("&"):
+                continue
+            if line.startswith("#"):
+                if line.startswith("# bandindex:"):
+                    eng.append([])
+                    wei.append([])
+            elif len(line) > 0:
+                lsf = [float(l) for l in line.split()]
+                if len(lsf) == 3:
+                    eng[-1].append(lsf[1])
+                    wei[-1].append(lsf[2])
+                else:
+                    print("Wrong Data in " + path)
+    return eng, wei
+
+
+def agr(bands):
+    out = ["@with g0", "@    xaxis  label char size 1.500000"]
+    for b, rows in enumerate(bands):
+        out.append("# bandindex:  %d" % (b + 1))
+        out += rows
+        out.append("&")
+    return "\n".join(out) + "\n"
+
+
+def rows(nk, b):
+    return [
+        "  %10.5f  %10.5f  %10.5f" % (i * 0.01, b - 1 + i * 0.1, 0.25)
+        for i in range(nk)
+    ]
+
+
+CASES = {
+    "well_formed": agr([rows(6, b) for b in range(3)]),
+    "blank_lines": agr([[""] + rows(3, 0) + ["", "   "] + rows(3, 0)[:1], rows(4, 1)]),
+    "ragged": agr(
+        [rows(3, 0) + ["  0.03000  1.00000", "  0.04000  2.0  9.9  0.5"], rows(5, 1)]
+    ),
+    "ragged_many": agr(
+        [rows(2, 0) + ["  0.1", "  0.2 0.3 0.4 0.5 0.6"] + rows(2, 0), rows(5, 1)]
+    ),
+    "tabs": agr([[r.replace("  ", "\t") for r in rows(4, b)] for b in range(2)]),
+}
+
+
+@pytest.mark.parametrize("name", list(CASES))
+def test_parse_agr_matches_old_parser(tmp_path, capsys, name):
+    path = str(tmp_path) + "/case.bands.agr"
+    with open(path, "w") as f:
+        f.write(CASES[name])
+    eng, wei = old_load_agr(path)
+    old_msgs = capsys.readouterr().out.count("Wrong Data")
+
+    data = anal._parse_agr(path)
+    assert capsys.readouterr().out.count("Wrong Data") == old_msgs
+    assert [ba for ba, _ in data] == list(range(1, len(eng) + 1))
+    for (_, d), e, w in zip(data, eng, wei):
+        assert d.shape == (len(e), 3)
+        assert np.array_equal(d[:, 1], e) and np.array_equal(d[:, 2], w)
+
+
+def test_load_agr_well_formed(tmp_path):
+    path = str(tmp_path) + "/case.bands.agr"
+    with open(path, "w") as f:
+        f.write(CASES["well_formed"])
+    eng, wei = old_load_agr(path)
+    e, w = anal.load_agr(path, cache=0)
+    assert np.array_equal(e, np.array(eng)) and np.array_equal(w, np.array(wei))
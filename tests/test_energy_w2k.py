@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+
+import energy_w2k as en
+
+HEAD = ["  0.30000000E+00  0.30000000E+00", "  0.30000000E+00  0.30000000E+00"]
+
+
+def write_energy(path, ks, start=0, mtime=None):
+    out = list(HEAD)
+    for i, k in enumerate(ks):
+        ne = 3 + (start + i) % 2  # the number of bands differs between k points
+        name = "K" + str(start + i)
+        out.append("%19.12E%19.12E%19.12E%10s%6d%6d%5.1f" % (*k, name, 0, ne, 2.0))
+        out += [
+            "%12d%25.15E" % (b + 1, 0.1 * b + 0.01 * (start + i)) for b in range(ne)
+        ]
+    with open(path, "w") as f:
+        f.write("\n".join(out) + "\n")
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def kpoints(n):
+    return [(i / 10, 0.5, 0.0) for i in range(n)]
+
+
+def test_split_merge_round_trip(tmp_path):
+    src = str(tmp_path) + "/case.energy"
+    write_energy(src, kpoints(7))
+    parts = [str(tmp_path) + "/line_" + str(i) + ".energy" for i in range(3)]
+    assert en.split_energy(src, parts, [2, 4, 1])
+    assert [len(list(en.iter_energy(p))) for p in parts] == [2, 4, 1]
+    assert [n for _, n, _, _ in en.iter_energy(parts[1])] == ["K2", "K3", "K4", "K5"]
+
+    dst = str(tmp_path) + "/merged.energy"
+    en.merge_energy(parts, dst)
+    with open(src) as f, open(dst) as g:
+        assert f.read() == g.read()
+    k, e, w = en.load_energy(dst, trim=0)
+    assert k.shape == (7, 3) and e.shape == (4, 7) and np.all(w == 2)
+    assert np.isnan(e[3, 0]) and np.isclose(e[3, 1], 0.31)
+
+
+def test_split_wrong_counts(tmp_path, capsys):
+    src = str(tmp_path) + "/case.energy"
+    write_energy(src, kpoints(3))
+    dst = str(tmp_path) + "/a.energy"
+    assert not en.split_energy(src, [dst], [4])
+    assert "ERROR" in capsys.readouterr().out
+    assert not os.path.exists(dst)
+
+
+def test_energy_files_skips_stale_fragments(tmp_path):
+    path = str(tmp_path) + "/case.energy"
+    write_energy(path, kpoints(3), mtime=1000)
+    for i in range(3):  # a previous run with 3 jobs
+        write_energy(path + "_" + str(i + 1), kpoints(1), start=i, mtime=2000)
+    assert en.energy_files(path) == [path + "_" + str(i + 1) for i in range(3)]
+    assert en.energy_files(path, since=3000) == [path]
+
+    for i in range(2):  # this run with 2 jobs, _3 is left over
+        write_energy(path + "_" + str(i + 1), kpoints(2), start=2 * i, mtime=4000)
+    assert en.energy_files(path, since=3000) == [path + "_1", path + "_2"]
+    k, e, _ = en.load_energy(path, since=3000)
+    assert k.shape == (4, 3) and e.shape == (3, 4)
+
+    os.utime(path, (5000, 5000))  # merged after the run: fragments are older
+    assert en.energy_files(path) == [path]
@@ -0,0 +1,56 @@
+import numpy as np
+
+import octree_w2k as oc
+
+CENTER = np.array([0.5, 0.5, 0.5])
+RADIUS = 0.3
+
+
+def sphere(kint, d):  # two bands crossing on a sphere, the gap is 1-Lipschitz
+    k = kint / d
+    gap = np.abs(np.linalg.norm(k - CENTER, axis=1) - RADIUS)
+    return np.zeros(k.shape[0]), gap
+
+
+def fine_surface(d, cutoff):  # every fine grid point of [0, 1]^3 with a gap < cutoff
+    x = np.arange(d + 1)
+    kint = np.array(np.meshgrid(x, x, x, indexing="ij")).reshape(3, -1).T
+    return kint[sphere(kint, d)[1] < cutoff]
+
+
+def test_refinement_concentrates_on_crossing(tmp_path):
+    n, depth, cutoff = 8, 3, 0.01
+    tree = oc.Octree(str(tmp_path) + "/", n, depth, cutoff, lipschitz=1.0)
+    x = np.arange(n + 1)
+    tree.seed(np.array(np.meshgrid(x, x, x)).reshape(3, -1).T)
+    tree.run(sphere)
+
+    k, e, g = tree.hits()
+    assert np.all(g < cutoff)
+    assert np.allclose(np.abs(np.linalg.norm(k - CENTER, axis=1) - RADIUS), g)
+
+    # no crossing point of the fine grid is missed
+    want = fine_surface(tree.d, cutoff)
+    got = np.rint(k * tree.d).astype(np.int64)
+    assert set(map(tuple, want)) <= set(map(tuple, got))
+
+    # far fewer points than the full fine grid, all of them close to the surface
+    ka, _, ga = tree.hits(evaluated=1)
+    assert ka.shape[0] < 0.25 * (tree.d + 1) ** 3
+    fine = ka[ga < cutoff]
+    assert fine.shape[0] == k.shape[0]
+    assert np.mean(ga < 2 * np.sqrt(3) / n) > 0.9
+
+
+def test_resume_from_saved_state(tmp_path):
+    path = str(tmp_path) + "/"
+    tree = oc.Octree(path, 8, 2, 0.01, lipschitz=1.0)
+    tree.seed(np.array([[2, 4, 4], [6, 4, 4]]))
+    tree.step(sphere)
+    rounds, queue = tree.rounds, tree.queue.copy()
+
+    again = oc.Octree(path, 8, 2, 0.01, lipschitz=1.0)
+    assert again.rounds == rounds and np.array_equal(again.queue, queue)
+    again.run(sphere)
+    tree.run(sphere)
+    assert np.array_equal(again.hits()[0], tree.hits()[0])
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+import qtl_w2k as qt
+
+NCOL = [4, 1]  # atom 1: tot s p d, last atom (interstitial): tot
+
+
+def make_qtl(nband=3, nk=4, seed=0):
+    rng = np.random.default_rng(seed)
+    ene = np.sort(rng.uniform(-1, 1, (nband, nk)), axis=0).round(6)
+    qtl = np.full((nband, nk, len(NCOL), max(NCOL)), np.nan)
+    for a, n in enumerate(NCOL):
+        qtl[:, :, a, :n] = rng.uniform(0, 1, (nband, nk, n)).round(5)
+    return ene, qtl
+
+
+def write_qtl(path, ene, qtl, drop=0):
+    out = ["Co2MnGa", "LATTICE CONST.=   10.9  FERMI ENERGY=  0.51234"]
+    out += [" JATOM  1 MULT= 2", " JATOM  2 INTERSTITIAL"]
+    for b in range(ene.shape[0]):
+        out.append(" BAND:  %d" % (b + 1))
+        for k in range(ene.shape[1]):
+            for a, n in enumerate(NCOL):
+                cols = " ".join("%8.5f" % v for v in qtl[b, k, a, :n])
+                out.append("%12.6f %3d %s" % (ene[b, k], a + 1, cols))
+    with open(path, "w") as f:
+        f.write("\n".join(out[: len(out) - drop]) + "\n")
+
+
+def test_load_qtl_round_trip(tmp_path):
+    ene, qtl = make_qtl()
+    path = str(tmp_path) + "/case.qtlup"
+    write_qtl(path, ene, qtl)
+    e, q, ef = qt.load_qtl(path)
+    assert ef == 0.51234
+    assert np.array_equal(e, ene)
+    assert q.shape == qtl.shape
+    assert np.array_equal(np.isnan(q), np.isnan(qtl))
+    assert np.array_equal(np.nan_to_num(q), np.nan_to_num(qtl))
+
+
+def test_load_qtl_wrong_shape(tmp_path):
+    path = str(tmp_path) + "/case.qtl"
+    write_qtl(path, *make_qtl(), drop=1)  # last atom line of the last k point missing
+    with pytest.raises(ValueError):
+        qt.load_qtl(path)
+
+
+def write_agr(path, ene, nk=None):
+    out = ["@with g0"]
+    for b in range(ene.shape[0]):
+        out.append("# bandindex:  %d" % (b + 1))
+        for k in range(ene.shape[1] if nk is None else nk):
+            out.append(
+                "  %10.5f  %10.5f  %10.5f" % (k * 0.1, ene[b, k % ene.shape[1]], 0)
+            )
+        out.append("&")
+    with open(path, "w") as f:
+        f.write("\n".join(out) + "\n")
+
+
+def test_write_weighted_agr(tmp_path):
+    ene, qtl = make_qtl()
+    agr = str(tmp_path) + "/case.bands.agr"
+    write_agr(agr, ene)
+    outs = [str(tmp_path) + "/d.agr", str(tmp_path) + "/int.agr"]
+    qt.write_weighted_agr(agr, qtl, [[1, 4], [2, 1]], outs)
+    for out, w in zip(outs, [qtl[:, :, 0, 3], qtl[:, :, 1, 0]]):
+        with open(out) as f:
+            rows = [l.split() for l in f if l[:1] == " "]
+        got = np.array(rows, dtype=float).reshape(ene.shape + (3,))
+        assert np.allclose(got[:, :, 1], ene, atol=1e-5)
+        assert np.allclose(got[:, :, 2], w, atol=1e-5)
+
+
+def test_write_weighted_agr_errors(tmp_path):
+    ene, qtl = make_qtl()
+    agr = str(tmp_path) + "/case.bands.agr"
+    out = [str(tmp_path) + "/out.agr"]
+    write_agr(agr, ene)
+    for sel in [[3, 1], [0, 1], [1, 5]]:  # no such atom or column
+        with pytest.raises(ValueError):
+            qt.write_weighted_agr(agr, qtl, [sel], out)
+    write_agr(agr, ene, nk=ene.shape[1] + 1)  # more k points than the qtl
+    with pytest.raises(ValueError):
+        qt.write_weighted_agr(agr, qtl, [[1, 1]], out)
+    write_agr(agr, np.vstack([ene, ene[-1:] + 1]))  # more bands than the qtl
+    with pytest.raises(ValueError):
+        qt.write_weighted_agr(agr, qtl, [[1, 1]], out)
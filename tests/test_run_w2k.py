@@ -0,0 +1,121 @@
+import os
+
+import run_w2k
+import telemetry_w2k as tm
+
+
+def make_case(tmp_path):
+    w2k = run_w2k.W2k("case")
+    w2k.case_path = str(tmp_path) + "/case/"
+    (tmp_path / "case").mkdir()
+    for ext in [".struct", ".in0", ".in1", ".in2", ".klist"]:
+        (tmp_path / "case" / ("case" + ext)).write_text(ext + "\n")
+    return w2k
+
+
+def test_scf_digest_follows_active_inputs(tmp_path):
+    w2k = make_case(tmp_path)
+    scf = lambda: w2k._digest(w2k._scf_inputs(), {}, scf=0)
+    for orb, so, ext in [(1, 0, ".inorb"), (1, 0, ".indm"), (0, 1, ".inso")]:
+        w2k.orb, w2k.so = orb, so
+        before = scf()
+        with open(w2k.filepath(ext), "a") as f:
+            f.write("changed\n")
+        assert scf() != before
+    before = scf()
+    with open(w2k.filepath(".inc"), "a") as f:
+        f.write("changed\n")
+    assert scf() != before
+
+
+def test_band_steps_count_klist_band(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    (bindir / "x_lapw").write_text("#!/bin/sh\nexit 0\n")
+    (bindir / "x_lapw").chmod(0o755)
+    monkeypatch.setenv("PATH", str(bindir) + os.pathsep + os.environ["PATH"])
+    w2k = make_case(tmp_path)
+    w2k.input(".klist").set_lines(["k"] * 3 + ["END"])
+    w2k.input(".klist_band").set_lines(["k"] * 5 + ["END"])
+    w2k.telemetry = tm.Telemetry(str(tmp_path) + "/telemetry.jsonl")
+    w2k._run(["x_lapw", "lapwso", "-up"])
+    w2k._run(["x_lapw", "lapwso", "-up"], band=1)
+    w2k._run(["x_lapw", "spaghetti"], band=1)
+    assert [r["nk"] for r in w2k.telemetry.load()] == [3, 5, 5]
+
+
+def read_machines(path):  # job lines and the key:value settings of a .machines
+    jobs, keys = [], {}
+    with open(path) as f:
+        for l in f.read().split("\n"):
+            if l == "":
+                continue
+            head, rest = l.split(":", 1)
+            if head.isdigit():
+                jobs.append([int(head)] + rest.split(":"))
+            else:
+                keys[head] = rest
+    return jobs, keys
+
+
+def test_write_machines_mpi_omp(tmp_path):
+    w2k = make_case(tmp_path)
+    w2k.write_machines(hosts={"a": 8, "b": 4}, omp=2, weights={"b": 2}, mpi=2)
+    jobs, keys = read_machines(w2k.case_path + ".machines")
+    assert jobs == [[1, "a", "2"], [1, "a", "2"], [2, "b", "2"]]
+    assert keys["lapw0"] == "a:8"
+    assert keys["omp_global"] == keys["omp_lapw1"] == "2"
+    assert keys["granularity"] == "1" and keys["extrafine"] == "1"
+    assert (w2k.parallel, w2k.omp) == (3, 2)
+    assert w2k.env()["OMP_NUM_THREADS"] == "2"
+
+
+def test_write_machines_auto_omp(tmp_path):
+    w2k = make_case(tmp_path)
+    w2k.write_machines(cores=8, nk=3, extrafine=0)  # 3 k points: 4 jobs x 2 threads
+    jobs, keys = read_machines(w2k.case_path + ".machines")
+    assert jobs == [[1, "localhost"]] * 4
+    assert "lapw0" not in keys and "extrafine" not in keys
+    assert keys["omp_global"] == "2" and (w2k.parallel, w2k.omp) == (4, 2)
+
+    w2k.input(".klist_band").set_lines(["k"] * 20 + ["END"])
+    w2k.write_machines(cores=8)  # counted from .klist_band, enough k points
+    jobs, keys = read_machines(w2k.case_path + ".machines")
+    assert len(jobs) == 8 and keys["omp_global"] == "1"
+
+
+def test_input_file_round_trip(tmp_path):
+    path = str(tmp_path) + "/case.in1"
+    with open(path, "w") as f:
+        f.write("WFFIL\n  7.00   10   4  (R-MT*K-MAX; MAX L IN WF, V-NMT\n")
+    f = run_w2k.InputFile(path)
+    assert f.set_token("R-MT*K-MAX", 0, "8.50") == 1
+    f.flush()
+    assert not f.dirty
+    with open(path) as g:
+        assert (
+            g.read().split("\n")[1]
+            == "  8.50   10   4  (R-MT*K-MAX; MAX L IN WF, V-NMT"
+        )
+    assert run_w2k.InputFile(path).lines == f.lines
+
+
+def test_input_file_external_change_wins(tmp_path, capsys):
+    path = str(tmp_path) + "/case.klist_band"
+    with open(path, "w") as f:
+        f.write("old\nEND\n")
+    f = run_w2k.InputFile(path)
+    f.replace("old", "edited")
+    with open(path + ".new", "w") as g:  # cp of another klist over the file
+        g.write("copied k point\nEND\n")
+    os.replace(path + ".new", path)
+    f.flush()
+    assert "discarded" in capsys.readouterr().out
+    assert not f.dirty
+    with open(path) as g:
+        assert g.read() == "copied k point\nEND\n"
+    assert f.lines == ["copied k point", "END"]
+
+    with open(path, "w") as g:  # unchanged in memory: read again
+        g.write("third\nEND\n")
+    assert f.lines == ["third", "END"]
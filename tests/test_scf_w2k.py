@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+import scf_w2k as scf
+
+LABELS = [":ENE", ":ENERGY", ":FER", ":DIS", ":MMT001", ":ITE"]
+
+
+def naive(text, label):  # the last line starting with label and not more of a word
+    for l in reversed(text.split("\n")):
+        rest = l[len(label) : len(label) + 1]
+        if l.startswith(label) and not (rest.isalnum() and rest.isascii()):
+            return l
+    return ""
+
+
+def write(tmp_path, text):
+    p = tmp_path / "case.scf"
+    p.write_bytes(text.encode())
+    return str(p)
+
+
+SCF = (
+    ":ENE  : ********** TOTAL ENERGY IN Ry =       -1.0\n"
+    ":ITE001:  1. ITERATION\n"
+    ":FER  : F E R M I - ENERGY(TETRAH.M.)=   0.51\n"
+    ":ENERGY convergence:  0 0.0001 .0012\n"
+    "    :ENE inside a line, not at its start\n"
+    ":ENE  : ********** TOTAL ENERGY IN Ry =       -2.5\n"
+    ":DIS  :  CHARGE DISTANCE       ( 0.0010000 for atom    1 spin 1)    0.0010000\n"
+    ":ITE002:  2. ITERATION\n"
+    ":FER  : F E R M I - ENERGY(TETRAH.M.)=   0.52\n"
+    ":ENERGY convergence:  1 0.0001 .0003\n"
+)
+
+
+@pytest.mark.parametrize("block", list(range(1, 40)) + [65536])
+def test_last_line_matches_naive_for_every_block(tmp_path, block):
+    for text in [SCF, SCF.rstrip("\n"), ":ENE only line", "\n" + SCF, ""]:
+        path = write(tmp_path, text)
+        for label in LABELS + [":MISSING", ":EN"]:
+            assert scf.last_line(path, label, block) == naive(text, label)
+
+
+def test_last_line_labels(tmp_path):
+    path = write(tmp_path, SCF)
+    assert scf.last_line(path, ":ENE").endswith("-2.5")
+    assert scf.last_line(path, ":ENERGY").endswith(".0003")
+    assert scf.last_line(path, ":MISSING") == ""
+    assert scf.last_value(path, ":FER") == 0.52
+    with pytest.raises(ValueError):
+        scf.last_value(path, ":MISSING")
+
+
+def test_last_line_on_first_line_of_long_file(tmp_path):
+    text = ":FER  : first  0.5\n" + "".join(":DIS  : x %d\n" % i for i in range(5000))
+    path = write(tmp_path, text)
+    for block in [7, 100, 4096]:
+        assert scf.last_line(path, ":FER", block) == ":FER  : first  0.5"
+
+
+def test_load_scf(tmp_path):
+    d = scf.load_scf(write(tmp_path, SCF))
+    assert list(d["ITE"]) == [1, 2]
+    assert np.allclose(d["FER"], [0.51, 0.52])
+    assert d["ENE"][0] == -2.5 and np.isnan(d["ENE"][1])
+    assert np.isnan(d["DIS"][1])
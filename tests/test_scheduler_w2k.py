@@ -0,0 +1,131 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import analyze_w2k as anal
+import ledger_w2k as lg
+import make_klist_band as kb
+import run_w2k
+import scheduler_w2k as sc
+
+STUB = """#!%s
+# x_lapw stub: spaghetti writes an .agr from case.klist_band, other steps do nothing
+import os, sys
+args = sys.argv[1:]
+with open(os.environ["STUB_LOG"], "a") as f:
+    f.write(args[0] + "\\n")
+if args[0] != "spaghetti":
+    sys.exit(0)
+if os.environ.get("STUB_FAIL_ALL"):
+    sys.exit(3)
+try:  # the first spaghetti after the marker is created fails
+    os.remove(os.environ["STUB_FAIL_ONCE"])
+    sys.exit(2)
+except FileNotFoundError:
+    pass
+case = os.path.basename(os.getcwd())
+ks = [l for l in open(case + ".klist_band") if not l.startswith("END")]
+with open(case + ".bands.agr", "w") as f:
+    for b in range(2):
+        f.write("# bandindex:  %%d\\n" %% (b + 1))
+        for i, l in enumerate(ks):
+            f.write("  %%10.5f  %%10.5f  %%10.5f\\n" %% (i * 0.01, b + int(l[10:15]) / 10, 0.5))
+        f.write("&\\n")
+"""
+
+
+@pytest.fixture
+def case(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    stub = bindir / "x_lapw"
+    stub.write_text(STUB % sys.executable)
+    stub.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bindir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("STUB_LOG", str(tmp_path / "stub.log"))
+    monkeypatch.setenv("STUB_FAIL_ONCE", str(tmp_path / "fail_once"))
+
+    w2k = run_w2k.W2k("case")
+    w2k.case_path = str(tmp_path) + "/case/"
+    w2k.spol = 0
+    os.makedirs(w2k.case_path)
+    open(w2k.filepath(".insp"), "w").close()
+
+    klists = []
+    for i in range(4):
+        path = str(tmp_path) + "/ky_" + str(i) + ".klist_band"
+        kb.write_klist(path, np.array([[j, i, 0] for j in range(5)]), 10)
+        klists.append(["ky_" + str(i), path])
+    return w2k, klists, str(tmp_path) + "/"
+
+
+def spaghetti_calls(root):
+    with open(root + "stub.log") as f:
+        return sum(1 for l in f if l.strip() == "spaghetti")
+
+
+@pytest.mark.parametrize("process", [0, 1])
+def test_failed_job_is_retried(case, process):
+    w2k, klists, root = case
+    open(root + "fail_once", "w").close()
+    sch = sc.BandScheduler(w2k, 2, retries=1, process=process)
+    jobs = [sch.band_job(k, root + "out/", name) for name, k in klists]
+    assert sch.run(jobs) == []
+    assert spaghetti_calls(root) == len(klists) + 1
+    e, _ = anal.load_agr(root + "out/ky_2.bands.agr", cache=0)
+    assert np.allclose(e, [np.arange(5) / 10, 1 + np.arange(5) / 10])
+    # every worker got its own scratch
+    assert len(set(w.env()["SCRATCH"] for w in sch.worker_ls)) == 2
+
+
+def test_failed_batch_is_retried(case):
+    w2k, klists, root = case
+    open(root + "fail_once", "w").close()
+    sch = sc.BandScheduler(w2k, 2, retries=1, process=0)
+    jobs = [sch.batch_job(root + "out/", klists[i : i + 2], max_k=10) for i in (0, 2)]
+    assert sch.run(jobs) == []
+    assert all(os.path.exists(root + "out/" + n + ".bands.agr") for n, _ in klists)
+
+
+def test_ledger_skips_done_jobs(case):
+    w2k, klists, root = case
+    w2k.ledger = lg.Ledger(root + "ledger.sqlite")
+    sch = sc.BandScheduler(w2k, 2, process=0)
+    jobs = [sch.band_job(k, root + "out/", name) for name, k in klists]
+    assert sch.run(jobs) == []
+    n = spaghetti_calls(root)
+    assert sch.run(jobs) == []
+    assert spaghetti_calls(root) == n
+    assert all(w2k.ledger.status(root + "out/" + n) == "done" for n, _ in klists)
+
+
+@pytest.mark.parametrize("ledger", [0, 1])
+def test_stale_output_is_not_success(case, monkeypatch, ledger):
+    w2k, klists, root = case
+    os.makedirs(root + "out/")
+    for name, _ in klists:
+        with open(root + "out/" + name + ".bands.agr", "w") as f:
+            f.write("stale\n")
+    open(w2k.filepath(".bands.agr"), "w").close()  # left in the session folder
+    monkeypatch.setenv("STUB_FAIL_ALL", "1")
+    if ledger:
+        w2k.ledger = lg.Ledger(root + "ledger.sqlite")
+    sch = sc.BandScheduler(w2k, 2, retries=1, process=0)
+    jobs = [sch.band_job(klists[0][1], root + "out/", klists[0][0])]
+    jobs.append(sch.batch_job(root + "out/", klists[1:], max_k=10))
+    assert len(sch.run(jobs)) == 2
+    assert not any(os.path.exists(root + "out/" + n + ".bands.agr") for n, _ in klists)
+    if ledger:
+        assert all(w2k.ledger.status(root + "out/" + n) == "failed" for n, _ in klists)
+
+
+def test_cleanup_removes_clones(case):
+    w2k, klists, root = case
+    sch = sc.BandScheduler(w2k, 2, process=0)
+    for name, k in klists[:2]:  # the case is copied only for the first run
+        assert sch.run([sch.band_job(k, root + "out/", name)]) == []
+    assert os.path.isdir(sch.scratch + "w1/")
+    sch.cleanup()
+    assert not os.path.exists(sch.scratch + "w0/") and sch.worker_ls == []
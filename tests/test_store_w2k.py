@@ -0,0 +1,70 @@
+import json
+import os
+
+import numpy as np
+
+import analyze_w2k as anal
+import store_w2k as st
+
+
+def lines(n, nk=11, nband=4):  # k point lines along kx with crossing bands
+    kx = np.linspace(0, 1, nk)
+    for i in range(n):
+        k = np.column_stack([kx, np.full(nk, i / max(n - 1, 1)), np.zeros(nk)])
+        e = np.array([np.cos(np.pi * (kx + i / n)) + b for b in range(nband)])
+        e[1] = 1.5 - kx  # crosses band 0 at some k
+        yield "line_" + str(i), k, e
+
+
+def test_reopen_reads_index_after_manifest(tmp_path):
+    path = str(tmp_path) + "/store/"
+    store = st.BandStore(path)
+    data = list(lines(5))
+    for name, k, e in data[:3]:
+        store.append_band(name, k, e)
+    store.close()
+    for name, k, e in data[3:]:  # not flushed, only in chunks.jsonl
+        store.append_band(name, k, e)
+    with open(path + "manifest.json") as f:
+        assert len(json.load(f)["chunks"]) == 3
+
+    again = st.BandStore(path)
+    assert all(again.has(name) for name, _, _ in data)
+    assert len(again) == len(store) == 55
+    k, e, _, _ = again.query()
+    assert np.allclose(k, np.concatenate([d[1] for d in data]))
+    assert np.allclose(e, np.concatenate([d[2].T for d in data]))
+
+
+def test_torn_index_line_is_dropped(tmp_path):
+    path = str(tmp_path) + "/store/"
+    store = st.BandStore(path)
+    for name, k, e in lines(2):
+        store.append_band(name, k, e)
+    with open(path + "chunks.jsonl", "a") as f:
+        f.write('{"file": "chunk_2.npz", "n"')
+    size = os.path.getsize(path + "chunks.jsonl")
+
+    again = st.BandStore(path)
+    assert len(again.manifest["chunks"]) == 2
+    assert os.path.getsize(path + "chunks.jsonl") < size
+    name, k, e = next(lines(1))
+    again.append_band("new", k, e)
+    assert st.BandStore(path).has("new")
+
+
+def test_get_NL_store_matches_get_NL_list(tmp_path):
+    store = st.BandStore(str(tmp_path) + "/store/")
+    data = list(lines(6))
+    for name, k, e in data:
+        store.append_band(name, k, e)
+    store.close()
+
+    ch = np.stack([e for _, _, e in data])[:, None, :, :]  # (kz, ky, band, kx)
+    ch = ch.transpose(1, 0, 2, 3)
+    np.save(str(tmp_path) + "/data.npy", ch)
+    nl = anal.get_NL_list(str(tmp_path) + "/data.npy", [1, 2], 0.2)
+    ns = anal.get_NL_store(store, [1, 2], 0.2)
+    for ba in [1, 2]:
+        assert nl[ba].shape[0] > 0
+        assert np.allclose(ns[ba], nl[ba] / [10, 5, 1])
@@ -0,0 +1,43 @@
+import numpy as np
+
+import symmetry_w2k as sym
+
+
+def test_unique_index_tolerance():
+    k = np.array([[0.1, 0.2, 0.3], [0.5, 0, 0], [0.1 + 1e-9, 0.2, 0.3], [0.5, 0, 0]])
+    assert sym.unique_index(k).tolist() == [0, 1]
+    assert sym.unique_index(k, tol=1e-12).tolist() == [0, 1, 2]
+    assert sym.unique_index(np.zeros((0, 3))).shape == (0,)
+
+
+def test_unique_index_wide_range():  # too many bits for the packed int64 key
+    k = np.array([[0, 0, 0], [1e6, 0, 0], [0, 0, 0], [0, 0, 1e6]])
+    assert sym.unique_index(k).tolist() == [0, 1, 3]
+
+
+def test_unfold_star_sizes():
+    ops = sym.cubic_ops()
+    k = np.array([[0.1, 0.2, 0.3], [0.5, 0, 0], [0.25, 0.25, 0.25], [0, 0, 0]])
+    for kp, n in zip(k, [48, 6, 8, 1]):
+        out, _ = sym.unfold(kp[None, :], ops)
+        assert out.shape == (n, 3)
+        # every image has the same length and is one of the ±permutations
+        assert np.allclose(np.linalg.norm(out, axis=1), np.linalg.norm(kp))
+        assert np.allclose(np.sort(np.abs(out), axis=1), np.sort(np.abs(kp)))
+
+
+def test_unfold_values_follow_points():
+    ops = sym.cubic_ops()
+    k = np.array([[0.1, 0.2, 0.3], [0.5, 0, 0]])
+    out, (e, g) = sym.unfold(k, ops, [np.array([1.0, 2.0]), np.array([10, 20])])
+    generic = np.isclose(np.sort(np.abs(out), axis=1), [0.1, 0.2, 0.3]).all(axis=1)
+    assert out.shape[0] == 54 and generic.sum() == 48
+    assert np.all(e[generic] == 1.0) and np.all(e[~generic] == 2.0)
+    assert np.all(g[generic] == 10) and np.all(g[~generic] == 20)
+
+
+def test_unfold_without_time_reversal():
+    ops = sym.cubic_ops()[:1]  # identity only
+    k = np.array([[0.1, 0.2, 0.3]])
+    assert sym.unfold(k, ops, time_reversal=0)[0].shape == (1, 3)
+    assert sym.unfold(k, ops, time_reversal=1)[0].shape == (2, 3)
@@ -0,0 +1,30 @@
+import os
+import subprocess
+
+import pytest
+
+import telemetry_w2k as tm
+
+
+def test_timed_run_kills_child_when_interrupted(monkeypatch):
+    procs = []
+    popen = subprocess.Popen
+
+    def record(*args, **kwargs):
+        procs.append(popen(*args, **kwargs))
+        return procs[-1]
+
+    def interrupt(pid, options):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(subprocess, "Popen", record)
+    monkeypatch.setattr(os, "wait4", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        tm.timed_run(["sleep", "30"])
+    assert procs[0].returncode is not None  # killed and reaped
+
+
+def test_timed_run_measures():
+    res, rec = tm.timed_run(["sh", "-c", "echo hi; exit 3"], capture_output=True)
+    assert res.returncode == 3 and res.stdout == b"hi\n"
+    assert rec["rc"] == 3 and rec["wall"] >= 0